@@ -0,0 +1,78 @@
+import argparse
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import ocr
+
+# Сравнение OCR-движков (ocr.ENGINES) на наборе фото чеков:
+#   - задержка на чек в одном процессе (предобработка + все проходы OCR_PSM_MODES);
+#   - пропускная способность пула из N процессов, как в боте (ocr.create_worker_pool).
+# Запуск:
+#   python bench_ocr.py img/receipt1.jpg img/receipt2.jpg --repeat 3 --workers 4
+#   python bench_ocr.py img/*.jpg --engines pytesseract
+
+
+def _ocr_only(image_path):
+    processed = ocr.preprocess_image(image_path)
+    return ocr.run_ocr_passes(processed)
+
+
+def _timed(image_path):
+    started = time.perf_counter()
+    _ocr_only(image_path)
+    return time.perf_counter() - started
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, round(p / 100 * (len(values) - 1))))
+    return values[k]
+
+
+def bench_latency(engine_name, images, repeat):
+    ocr.init_worker(engine_name)
+    # первый вызов прогревает движок (загрузка traineddata) и в замер не входит
+    _ocr_only(images[0])
+    latencies = [_timed(path) for _ in range(repeat) for path in images]
+    return latencies
+
+
+def bench_throughput(engine_name, images, repeat, workers):
+    jobs = [path for _ in range(repeat) for path in images]
+    with ProcessPoolExecutor(max_workers=workers, initializer=ocr.init_worker, initargs=(engine_name,)) as pool:
+        # прогрев: по одному чеку на воркер
+        list(pool.map(_ocr_only, [images[0]] * workers))
+        started = time.perf_counter()
+        list(pool.map(_ocr_only, jobs))
+        elapsed = time.perf_counter() - started
+    return len(jobs) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк OCR-движков на фото чеков')
+    parser.add_argument('images', nargs='+', help='пути к фото чеков')
+    parser.add_argument('--engines', default='pytesseract,tesserocr', help='движки через запятую')
+    parser.add_argument('--repeat', type=int, default=3, help='сколько раз прогнать каждый чек')
+    parser.add_argument('--workers', type=int, default=2, help='размер пула процессов для замера пропускной способности')
+    args = parser.parse_args()
+
+    for engine_name in args.engines.split(','):
+        engine_name = engine_name.strip()
+        try:
+            latencies = bench_latency(engine_name, args.images, args.repeat)
+        except ImportError as e:
+            print(f'{engine_name}: недоступен ({e})')
+            continue
+        throughput = bench_throughput(engine_name, args.images, args.repeat, args.workers)
+        print(
+            f'{engine_name}: чеков {len(latencies)}, '
+            f'задержка mean {statistics.mean(latencies) * 1000:.0f} мс, '
+            f'p50 {_percentile(latencies, 50) * 1000:.0f} мс, '
+            f'p95 {_percentile(latencies, 95) * 1000:.0f} мс; '
+            f'пул x{args.workers}: {throughput:.2f} чеков/с'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import argparse
+import random
+import statistics
+import time
+
+import debts_optimizer
+
+# Бенчмарк расчёта балансов debts_optimizer: цикл на Python против NumPy на синтетических строках
+# get_unpaid_rows (доли в нескольких валютах, суммы с копейками), с проверкой, что результаты совпадают.
+# Запуск:
+#   python bench_optimizer.py --shares 100000 1000000 --users 40 --repeat 3
+
+
+def make_rows(shares, users, currencies, seed=1):
+    rnd = random.Random(seed)
+    user_ids = [100_000_000 + rnd.randrange(10 ** 9) for _ in range(users)]
+    # в базе валюта уже нормализована запросом, но и сырые значения должны давать тот же результат
+    currency_values = [c for cur in currencies for c in (cur, cur.lower(), f' {cur} ')] + [None]
+    rows = []
+    for ep_id in range(1, shares + 1):
+        debtor, creditor = rnd.choice(user_ids), rnd.choice(user_ids)
+        amount = round(rnd.uniform(0.01, 5000), 2)
+        rows.append((ep_id, debtor, creditor, amount, rnd.choice(currency_values), ep_id // 4 + 1))
+    return rows
+
+
+def _best(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings), statistics.median(timings), result
+
+
+def bench(rows, repeat):
+    py_best, py_median, py_result = _best(lambda: debts_optimizer.currency_balances(rows, use_numpy=False), repeat)
+    np_best, np_median, np_result = _best(lambda: debts_optimizer.currency_balances(rows, use_numpy=True), repeat)
+    py_balances = {cur: {uid: c for uid, c in bal.items() if c} for cur, bal in py_result.items()}
+    if py_balances != np_result or list(py_result) != list(np_result):
+        raise SystemExit('Балансы NumPy не совпадают с Python')
+    py_transfers = [t for cur, bal in py_result.items() for t in debts_optimizer.settle_balances(bal, cur)]
+    np_transfers = [t for cur, bal in np_result.items() for t in debts_optimizer.settle_balances(bal, cur)]
+    if py_transfers != np_transfers:
+        raise SystemExit('Переводы NumPy не совпадают с Python')
+    return py_best, py_median, np_best, np_median
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк расчёта балансов оптимизатора долгов')
+    parser.add_argument('--shares', type=int, nargs='+', default=[100_000, 1_000_000], help='число строк долей')
+    parser.add_argument('--users', type=int, default=40, help='число участников')
+    parser.add_argument('--currencies', default='RUB,USD,EUR', help='валюты через запятую')
+    parser.add_argument('--repeat', type=int, default=3, help='сколько раз повторить замер')
+    args = parser.parse_args()
+
+    if debts_optimizer.np is None:
+        raise SystemExit('NumPy не установлен: pip install numpy')
+    print(f"{'строк':>10} {'python, с':>12} {'numpy, с':>12} {'ускорение':>10}")
+    for shares in args.shares:
+        rows = make_rows(shares, args.users, args.currencies.split(','))
+        py_best, _, np_best, _ = bench(rows, args.repeat)
+        print(f'{shares:>10} {py_best:>12.3f} {np_best:>12.3f} {py_best / np_best:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+# Замер старта бота для текстовой нагрузки (без фото чеков): время импорта по python -X importtime
+# и память процесса (RSS) после инициализации — import bot, подключение к временной базе и создание схемы.
+# Режим lazy — как работает бот: стек распознавания (ocr.OCR_STACK) не загружается, пока не пришло фото;
+# режим eager — то же, но стек загружается сразу (ocr.load_ocr_stack), как было при импорте cv2 в ocr.py.
+# Каждый замер — отдельный чистый процесс, чтобы не мешал кэш уже импортированных модулей.
+# Запуск:
+#   python bench_startup.py --repeat 5
+
+CHILD = r'''
+import asyncio, json, sys, time, types
+started = time.perf_counter()
+try:
+    import config
+except ImportError:
+    config = types.ModuleType('config')
+    config.BOT_TOKEN = '123456:BENCH'
+    sys.modules['config'] = config
+config.DB_BACKEND = 'sqlite'
+config.DB_PATH = sys.argv[2]
+import bot, ocr
+if sys.argv[1] == 'eager':
+    ocr.load_ocr_stack()
+imported = time.perf_counter() - started
+
+async def init():
+    await bot.db.connect()
+    await bot.db.init_schema()
+    await bot.db.close()
+asyncio.run(init())
+
+rss_kb = 0
+with open('/proc/self/status') as f:
+    for line in f:
+        if line.startswith('VmRSS:'):
+            rss_kb = int(line.split()[1])
+print(json.dumps({
+    'import_seconds': imported,
+    'init_seconds': time.perf_counter() - started,
+    'rss_kb': rss_kb,
+    'modules': len(sys.modules),
+    'ocr_stack': [name for name in ocr.OCR_STACK if name in sys.modules],
+}))
+'''
+
+
+def parse_importtime(stderr, max_depth=1):
+    """Строки 'import time: self [us] | cumulative | imported package' -> {модуль: мкс} до глубины max_depth.
+
+    Глубина 0 — то, что импортировал сам процесс (bot), 1 — то, что импортировали они (storage, telegram, ocr, ...).
+    """
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # вложенность в выводе importtime — по два пробела отступа на уровень
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth <= max_depth:
+            modules[name.strip()] = modules.get(name.strip(), 0) + int(cumulative)
+    return modules
+
+
+def run_once(mode, db_path):
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', CHILD, mode, db_path],
+                          capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if proc.returncode != 0:
+        raise SystemExit(f'Замер {mode} завершился с ошибкой:\n{proc.stderr[-2000:]}')
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result['imports'] = parse_importtime(proc.stderr)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Время старта и память бота без фото чеков')
+    parser.add_argument('--repeat', type=int, default=3, help='сколько раз повторить замер (берётся лучший)')
+    parser.add_argument('--top', type=int, default=10, help='сколько самых медленных импортов показать')
+    args = parser.parse_args()
+
+    if not sys.platform.startswith('linux'):
+        raise SystemExit('RSS читается из /proc/self/status, нужен Linux')
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ('lazy', 'eager'):
+            runs = [run_once(mode, os.path.join(tmp, f'{mode}{i}.db')) for i in range(args.repeat)]
+            results[mode] = min(runs, key=lambda r: r['init_seconds'])
+
+    print(f"{'режим':>6} {'импорт, с':>10} {'старт, с':>10} {'RSS, МБ':>9} {'модулей':>8}  стек OCR")
+    for mode, r in results.items():
+        print(f"{mode:>6} {r['import_seconds']:>10.3f} {r['init_seconds']:>10.3f} {r['rss_kb'] / 1024:>9.1f} "
+              f"{r['modules']:>8}  {', '.join(r['ocr_stack']) or '—'}")
+    lazy, eager = results['lazy'], results['eager']
+    print(f"\nlazy против eager: старт быстрее на {eager['init_seconds'] - lazy['init_seconds']:.3f} с, "
+          f"RSS меньше на {(eager['rss_kb'] - lazy['rss_kb']) / 1024:.1f} МБ")
+    for mode, r in results.items():
+        print(f'\nСамые медленные импорты ({mode}, -X importtime, cumulative):')
+        for name, us in sorted(r['imports'].items(), key=lambda item: -item[1])[:args.top]:
+            print(f'  {us / 1000:>8.1f} мс  {name}')
+
+
+if __name__ == '__main__':
+    main()
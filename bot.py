@@ -1,8 +1,24 @@
 import config
+import asyncio
+import functools
 import logging
-import sqlite3
 import html
+import io
+import time
 import debts_optimizer
+import diagnostics
+import export
+import importer
+import journal
+import live_plan
+import maintenance
+import messaging
+import metrics
+import scheduler
+import search
+import storage
+import shares
+import stats
 from datetime import datetime
 from telegram import (
     Update,
@@ -28,121 +44,73 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 BOT_TOKEN = config.BOT_TOKEN
+# при уверенности распознавания суммы чека не ниже порога шаг "Проверьте данные" пропускается
+OCR_CONFIRM_THRESHOLD = getattr(config, 'OCR_CONFIRM_THRESHOLD', 0.8)
+# распознавание чеков идёт в пуле процессов, у каждого свой постоянно живущий движок Tesseract
+OCR_WORKERS = getattr(config, 'OCR_WORKERS', 2)
+OCR_ENGINE = getattr(config, 'OCR_ENGINE', 'auto')
+# распознавание начинается с наименьшего размера фото с длинной стороной не меньше порога, см. ocr.photo_ladder
+OCR_LADDER_MIN_SIDE = getattr(config, 'OCR_LADDER_MIN_SIDE', 800)
+# сколько ждать остальные фото альбома (media group) после первого, секунд
+MEDIA_GROUP_DELAY = getattr(config, 'MEDIA_GROUP_DELAY', 1.5)
+
+# эндпоинт метрик Prometheus (см. metrics.py); без METRICS_PORT метрики не собираются
+METRICS_PORT = getattr(config, 'METRICS_PORT', None)
+METRICS_HOST = getattr(config, 'METRICS_HOST', '127.0.0.1')
+if METRICS_PORT:
+    metrics.enable()
+# разные чаты обрабатываются параллельно (до UPDATE_WORKERS), апдейты одного чата — по порядку, см. scheduler.py
+UPDATE_WORKERS = getattr(config, 'UPDATE_WORKERS', 8)
+CHAT_QUEUE_LIMIT = getattr(config, 'CHAT_QUEUE_LIMIT', 50)
+# журнал медленных запросов и /profile, см. diagnostics.py
+SLOW_QUERY_MS = getattr(config, 'SLOW_QUERY_MS', None)
+ADMIN_IDS = set(getattr(config, 'ADMIN_IDS', []))
+PROFILE_MAX_SECONDS = 300
+# обслуживание базы (слияние оплаченных долей, архив, ANALYZE/VACUUM), см. maintenance.py
+COMPACT_INTERVAL_HOURS = getattr(config, 'COMPACT_INTERVAL_HOURS', 24)
+VACUUM_FREE_RATIO = getattr(config, 'VACUUM_FREE_RATIO', maintenance.VACUUM_FREE_RATIO)
+# снимки SQLite-базы через online backup API, см. maintenance.snapshot
+SNAPSHOT_INTERVAL_HOURS = getattr(config, 'SNAPSHOT_INTERVAL_HOURS', 6)
+SNAPSHOT_DIR = getattr(config, 'SNAPSHOT_DIR', maintenance.SNAPSHOT_DIR)
+SNAPSHOT_KEEP = getattr(config, 'SNAPSHOT_KEEP', maintenance.SNAPSHOT_KEEP)
+# /optimize по умолчанию: 'net' — минимум переводов, 'direct' — только между теми, кто уже должен друг другу,
+# см. debts_optimizer.SETTLEMENT_MODES; разово — /optimize direct или /optimize net
+SETTLEMENT_MODE = getattr(config, 'SETTLEMENT_MODE', 'net')
+# живой закреплённый план (/live on): изменения долгов объединяются в окне LIVE_PLAN_DELAY секунд, см. live_plan.py
+LIVE_PLAN_DELAY = getattr(config, 'LIVE_PLAN_DELAY', live_plan.LIVE_PLAN_DELAY)
+LIVE_PLAN_TITLE = 'План переводов (обновляется автоматически):'
+# /import: Telegram отдаёт ботам файлы до 20 МБ
+IMPORT_MAX_BYTES = 20 * 1024 * 1024
+diagnostics.configure(SLOW_QUERY_MS)
+
+# хранилище (sqlite/postgres) выбирается в config.py, см. storage.create_storage
+db = storage.create_storage(config)
+live_plans = live_plan.LivePlan(db.ledger, lambda transfers: build_plan_text(transfers, LIVE_PLAN_TITLE),
+                                LIVE_PLAN_DELAY, SETTLEMENT_MODE)
 
 user_states = {}
+ocr_pool = None
+compaction_task = None
+snapshot_task = None
+# альбомы фото, которые ещё собираются: media_group_id -> список сообщений
+media_groups = {}
+# /find: запросы для листания результатов кнопками, {ключ: SearchQuery}; хранятся последние FIND_CACHE_SIZE
+find_queries = {}
+find_query_seq = 0
+FIND_CACHE_SIZE = 500
 
 # =========================
 # DB INIT & HELPERS
 # =========================
 
-def init_database():
-    conn = sqlite3.connect('expenses.db')
-    cursor = conn.cursor()
+async def get_or_create_user(user_id, user_name, username=None):
+    return await db.users.get_or_create(user_id, user_name, username)
 
-    # events
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS event (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL
-        )
-    ''')
-
-    # users
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS user (
-            id INTEGER PRIMARY KEY,
-            name TEXT NOT NULL,
-            payment_credentials TEXT
-        )
-    ''')
+async def get_categories_from_db():
+    return await db.expenses.get_categories()  # list of (id, name)
 
-    # categories
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS category (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL UNIQUE
-        )
-    ''')
-
-    # expenses
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS expense (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            amount REAL NOT NULL,
-            currency TEXT NOT NULL DEFAULT 'RUB',
-            event_id INTEGER NOT NULL,
-            name TEXT NOT NULL,
-            paid_date TEXT,
-            user_id INTEGER NOT NULL,
-            message_id INTEGER NOT NULL,
-            category_id INTEGER,
-            FOREIGN KEY (event_id) REFERENCES event (id),
-            FOREIGN KEY (user_id) REFERENCES user (id),
-            FOREIGN KEY (category_id) REFERENCES category (id)
-        )
-    ''')
-
-    # add category_id to expense if missing (migration)
-    cursor.execute("PRAGMA table_info(expense)")
-    cols = [r[1] for r in cursor.fetchall()]
-    if 'category_id' not in cols:
-        try:
-            cursor.execute("ALTER TABLE expense ADD COLUMN category_id INTEGER")
-        except Exception as e:
-            logger.warning("ALTER TABLE expense add category_id failed: %s", e)
-
-    # participants
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS expense_participant (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            amount REAL NOT NULL,
-            expense_id INTEGER NOT NULL,
-            is_paid BOOLEAN,
-            user_id INTEGER NOT NULL,
-            FOREIGN KEY (expense_id) REFERENCES expense (id),
-            FOREIGN KEY (user_id) REFERENCES user (id)
-        )
-    ''')
-
-    # default event
-    cursor.execute('SELECT id FROM event WHERE id = 1')
-    if not cursor.fetchone():
-        cursor.execute('INSERT INTO event (id, name) VALUES (1, "Основное мероприятие")')
-
-    # default categories
-    default_categories = ["Еда", "Транспорт", "Жилье", "Развлечения", "Прочее"]
-    cursor.execute('SELECT COUNT(*) FROM category')
-    cnt = cursor.fetchone()[0]
-    if cnt == 0:
-        cursor.executemany('INSERT INTO category (name) VALUES (?)', [(n,) for n in default_categories])
-
-    conn.commit()
-    conn.close()
-
-def get_or_create_user(user_id, user_name):
-    conn = sqlite3.connect('expenses.db')
-    cursor = conn.cursor()
-
-    cursor.execute('SELECT id FROM user WHERE id = ?', (user_id,))
-    user = cursor.fetchone()
-
-    if not user:
-        cursor.execute('INSERT INTO user (id, name) VALUES (?, ?)', (user_id, user_name))
-        conn.commit()
-
-    conn.close()
-    return user_id
-
-def get_categories_from_db():
-    conn = sqlite3.connect('expenses.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT id, name FROM category ORDER BY id')
-    rows = cursor.fetchall()
-    conn.close()
-    return rows  # list of (id, name)
-
-def get_category_keyboard():
-    cats = get_categories_from_db()
+async def get_category_keyboard():
+    cats = await get_categories_from_db()
     # по одному в ряд для наглядности
     keyboard = [[InlineKeyboardButton(name, callback_data=f"category_{cid}")]
                 for cid, name in cats]
@@ -162,7 +130,7 @@ def get_main_keyboard():
         [KeyboardButton("Мой долг"), KeyboardButton("Общий долг")],
         [KeyboardButton("Мой долг по категориям"), KeyboardButton("Общий долг по категориям")],
         [KeyboardButton("Указать данные для оплаты"), KeyboardButton("Мои данные для оплаты")],
-        [KeyboardButton("История платежей")],
+        [KeyboardButton("История платежей"), KeyboardButton("Статистика")],
         [KeyboardButton("Оптимизация долгов")]
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
@@ -176,73 +144,27 @@ def get_confirmation_keyboard():
     ]
     return InlineKeyboardMarkup(keyboard)
 
-def save_payment_to_db(payment_data, message_id=None):
-    conn = sqlite3.connect('expenses.db')
-    cursor = conn.cursor()
-
-    cursor.execute('''
-        INSERT INTO expense (event_id, name, user_id, paid_date, amount, currency, message_id, category_id)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (
-        1,
-        payment_data['description'],
-        payment_data['user_id'],
-        payment_data['timestamp'],
-        payment_data['amount'],
-        payment_data.get('currency', 'RUB'),
-        message_id,
-        payment_data.get('category_id')
-    ))
-
-    payment_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
-    return payment_id
-
-def save_share_to_db(payment_id, user_id, user_name, amount):
-    conn = sqlite3.connect('expenses.db')
-    cursor = conn.cursor()
-
-    get_or_create_user(user_id, user_name)
-
-    cursor.execute('''
-        INSERT INTO expense_participant (expense_id, user_id, amount, is_paid)
-        VALUES (?, ?, ?, ?)
-    ''', (payment_id, user_id, amount, 0))
+async def save_payment_to_db(payment_data, message_id=None):
+    await db.users.get_or_create(payment_data['user_id'], payment_data.get('created_by') or str(payment_data['user_id']))
+    return await db.expenses.create(payment_data, message_id)
 
-    conn.commit()
-    conn.close()
+async def save_share_to_db(payment_id, user_id, user_name, amount):
+    await db.expenses.add_shares(payment_id, [(user_id, user_name, amount)])
 
-def get_payments_from_db(limit=5):
-    conn = sqlite3.connect('expenses.db')
-    cursor = conn.cursor()
+async def save_shares_to_db(payment_id, participant_shares):
+    await db.expenses.add_shares(payment_id, participant_shares)
 
-    cursor.execute('''
-        SELECT e.*, u.name, c.name
-        FROM expense e
-        JOIN user u ON e.user_id = u.id
-        LEFT JOIN category c ON e.category_id = c.id
-        ORDER BY e.paid_date DESC LIMIT ?
-    ''', (limit,))
+def format_receipt_items(items):
+    return "\n".join(
+        f"#{pos}. {it['name']}: {it['quantity']:g} × {it['price']:.2f} = {it['amount']:.2f}"
+        for pos, it in enumerate(items, start=1)
+    )
 
-    payments = cursor.fetchall()
-    conn.close()
-    return payments
+async def get_payments_from_db(limit=5):
+    return await db.expenses.get_recent(limit)
 
-def get_shares_for_payment(payment_id):
-    conn = sqlite3.connect('expenses.db')
-    cursor = conn.cursor()
-
-    cursor.execute('''
-        SELECT ep.*, u.name
-        FROM expense_participant ep
-        JOIN user u ON ep.user_id = u.id
-        WHERE ep.expense_id = ?
-    ''', (payment_id,))
-
-    shares = cursor.fetchall()
-    conn.close()
-    return shares
+async def get_shares_for_payment(payment_id):
+    return await db.expenses.get_shares(payment_id)
 
 # =========================
 # HANDLERS
@@ -250,7 +172,7 @@ def get_shares_for_payment(payment_id):
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
-    get_or_create_user(user.id, user.first_name)
+    await get_or_create_user(user.id, user.first_name, user.username)
 
     if user.id in user_states:
         del user_states[user.id]
@@ -285,6 +207,8 @@ async def handle_main_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE
         await request_payment_credentials(update, context)
     elif text == "Мои данные для оплаты":
         await show_my_payment_credentials(update, context)
+    elif text == "Статистика":
+        await show_stats(update, context)
 
 async def create_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
@@ -320,7 +244,7 @@ async def handle_payment_input(update: Update, context: ContextTypes.DEFAULT_TYP
 
     elif user_states.get(user.id) == "waiting_amount":
         try:
-            amount = float(text.replace(",", ".").strip())
+            amount = shares.parse_amount(text)
             if amount <= 0:
                 await update.message.reply_text("Сумма должна быть больше 0. Попробуйте снова:")
                 return
@@ -342,13 +266,16 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     callback_data = query.data
     user = query.from_user
 
-    if callback_data == "confirm_payment":
+    if callback_data.startswith('find_'):
+        await find_callback(query)
+
+    elif callback_data == "confirm_payment":
         if 'pending_payment' in context.user_data:
             payment_data = context.user_data['pending_payment']
             if payment_data.get('user_id') == user.id:
                 await query.edit_message_text(
                     "Платеж подтвержден! Выберите категорию:",
-                    reply_markup=get_category_keyboard()
+                    reply_markup=await get_category_keyboard()
                 )
             else:
                 await query.edit_message_text("Этот платеж принадлежит другому пользователю")
@@ -373,7 +300,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         # получим имя категории для отображения
-        cats = dict(get_categories_from_db())
+        cats = dict(await get_categories_from_db())
         cat_name = cats.get(cat_id, 'Категория')
 
         if 'pending_payment' in context.user_data:
@@ -382,17 +309,24 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 payment_data['category_id'] = cat_id
                 payment_data['type'] = cat_name
 
-                sent = await query.message.reply_text(
+                created_text = (
                     f"Платеж создан!\n\n"
                     f"Название: {payment_data['description']}\n"
                     f"Сумма: {payment_data['amount']} {payment_data.get('currency', 'RUB')}\n"
                     f"Категория: {payment_data['type']}\n"
                     f"Создал: {payment_data['created_by']}\n"
                     f"Время: {payment_data['timestamp']}\n\n"
-                    f"Участники могут ответить на это сообщение числом — их долю в платеже."
+                    f"Участники могут ответить на это сообщение числом — их долю в платеже, "
+                    f"или списком: @anna 500, @boris 700, @vova x2, я (без суммы — остаток поровну или по весам x2)."
                 )
+                if payment_data.get('items'):
+                    created_text += (
+                        "\n\nПозиции чека:\n" + format_receipt_items(payment_data['items']) +
+                        "\n\nЧтобы забрать позиции, ответьте их номерами: #1 #3"
+                    )
+                sent = await query.message.reply_text(created_text)
 
-                save_payment_to_db(payment_data, sent.message_id)
+                await save_payment_to_db(payment_data, sent.message_id)
 
                 del context.user_data['pending_payment']
                 await query.edit_message_text("Платёж сохранён.")
@@ -417,52 +351,140 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             await query.edit_message_text("Данные платежа не найдены")
 
+async def resolve_share_targets(message, items):
+    """Сопоставляет целям из shares.parse_share_text пользователей: я / @username / упоминание без username.
+
+    Возвращает (resolved, unknown): resolved = [((user_id, user_name), amount, weight)], unknown = [target].
+    """
+    sender = message.from_user
+    # упоминания пользователей без username (text_mention) — цель задаётся отображаемым текстом
+    text_mentions = {}
+    for entity, text in message.parse_entities(['text_mention']).items():
+        if entity.user:
+            text_mentions[text.strip().lower()] = (entity.user.id, entity.user.first_name)
+
+    usernames = [t for t, _, _ in items if t.startswith('@')]
+    known = await db.users.find_by_usernames(usernames)
+
+    resolved, unknown = [], []
+    for target, amount, weight in items:
+        if target == shares.SELF:
+            resolved.append(((sender.id, sender.first_name), amount, weight))
+        elif target.startswith('@') and target[1:].lower() in known:
+            resolved.append((known[target[1:].lower()], amount, weight))
+        elif target.lower() in text_mentions:
+            resolved.append((text_mentions[target.lower()], amount, weight))
+        else:
+            unknown.append(target)
+    return resolved, unknown
+
 async def handle_reply_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Пользователь отвечает числом на сообщение 'Платеж создан!' — записываем его долю к нужному платежу по message_id."""
-    if update.message.reply_to_message:
+    """Пользователь отвечает на сообщение 'Платеж создан!' — записываем доли к нужному платежу по message_id.
+
+    Ответ числом — своя доля; ответ вида "@anna 500, @boris 700, @vova x2, я" — доли нескольких участников
+    (без суммы — делят остаток по весам, по умолчанию поровну), все записываются одной транзакцией.
+    """
+    if not update.message.reply_to_message:
+        return
+
+    user = update.message.from_user
+    text = update.message.text
+    replied_id = update.message.reply_to_message.message_id
+
+    try:
+        positions = shares.parse_item_claims(text)
+    except shares.ShareParseError as e:
+        await update.message.reply_text(f"Ошибка! {e}")
+        return
+    if positions:
+        await claim_receipt_items(update, replied_id, positions)
+        return
+
+    if shares.is_single_amount(text):
+        share_amount = shares.parse_amount(text)
+        if share_amount <= 0:
+            await update.message.reply_text("Сумма долга должна быть больше 0. Попробуйте ещё раз.")
+            return
+        items = [(shares.SELF, share_amount, 1)]
+    else:
         try:
-            share_amount = float(update.message.text.replace(",", ".").strip())
-            if share_amount <= 0:
-                await update.message.reply_text("Сумма долга должна быть больше 0. Попробуйте ещё раз.")
-                return
+            items = shares.parse_share_text(text)
+        except shares.ShareParseError as e:
+            await update.message.reply_text(
+                f"Ошибка! {e}\n\nОтветьте числом - вашей долей в платеже, "
+                f"или списком вида: @anna 500, @boris 700, @vova, я"
+            )
+            return
 
-            user = update.message.from_user
-            replied_id = update.message.reply_to_message.message_id
+    row = await db.expenses.find_by_message_id(replied_id)
+    if not row:
+        await update.message.reply_text("Не удалось найти платеж по этому сообщению")
+        return
+    payment_id, currency, total = row
 
-            conn = sqlite3.connect('expenses.db')
-            cursor = conn.cursor()
+    await get_or_create_user(user.id, user.first_name, user.username)
+    resolved, unknown = await resolve_share_targets(update.message, items)
+    if unknown:
+        await update.message.reply_text(
+            "Не знаю участников: " + ", ".join(unknown) + "\n"
+            "Им нужно один раз написать боту /start или упомяните их через выбор пользователя."
+        )
+        return
+    if len({uid for (uid, _), _, _ in resolved}) != len(resolved):
+        await update.message.reply_text("Участник указан несколько раз")
+        return
 
-            cursor.execute('SELECT id, currency FROM expense WHERE message_id = ? LIMIT 1', (replied_id,))
-            row = cursor.fetchone()
+    try:
+        existing = 0
+        if any(amount is None for _, amount, _ in resolved):
+            existing = await db.expenses.get_shares_total(payment_id)
+        amounts = shares.resolve_amounts(resolved, total, existing)
+        await save_shares_to_db(payment_id, [(uid, name, amount) for (uid, name), amount in amounts])
+        live_plans.touch(currency)
+    except shares.ShareLimitError as e:
+        await update.message.reply_text(
+            f"Доли превышают сумму платежа {total:.2f} {currency}. "
+            f"Свободно: {e.available_cents / 100:.2f} {currency}"
+        )
+        return
 
-            if row:
-                payment_id, currency = row
-                save_share_to_db(payment_id, user.id, user.first_name, share_amount)
-                await update.message.reply_text(f"Записан ваш долг: {share_amount:.2f} {currency}")
-            else:
-                await update.message.reply_text("Не удалось найти платеж по этому сообщению")
+    if len(amounts) == 1 and amounts[0][0][0] == user.id:
+        await update.message.reply_text(f"Записан ваш долг: {amounts[0][1]:.2f} {currency}")
+    else:
+        lines = ["Записаны доли:"]
+        for (uid, name), amount in amounts:
+            lines.append(f"{name}: {amount:.2f} {currency}")
+        await update.message.reply_text("\n".join(lines))
 
-            conn.close()
-        except ValueError:
-            await update.message.reply_text("Ошибка! Введите число - вашу долю в платеже")
+async def claim_receipt_items(update: Update, replied_id, positions):
+    """Ответ "#1 #3" на платёж по чеку — участник забирает позиции, его доля равна их сумме."""
+    user = update.message.from_user
+    row = await db.expenses.find_by_message_id(replied_id)
+    if not row:
+        await update.message.reply_text("Не удалось найти платеж по этому сообщению")
+        return
+    payment_id, currency, total = row
+
+    try:
+        claimed = await db.expenses.claim_items(payment_id, positions, user.id, user.first_name)
+    except shares.ItemClaimError as e:
+        await update.message.reply_text(str(e))
+        return
+    except shares.ShareLimitError as e:
+        await update.message.reply_text(
+            f"Доли превышают сумму платежа {total:.2f} {currency}. "
+            f"Свободно: {e.available_cents / 100:.2f} {currency}"
+        )
+        return
+
+    live_plans.touch(currency)
+    lines = [f"{name}: {amount:.2f}" for _, name, amount in claimed]
+    share = sum(amount for _, _, amount in claimed)
+    await update.message.reply_text("Вы забрали:\n" + "\n".join(lines) + f"\n\nЗаписан ваш долг: {share:.2f} {currency}")
 
 async def show_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
-    conn = sqlite3.connect('expenses.db')
-    cursor = conn.cursor()
-
-    cursor.execute('''
-        SELECT e.currency,
-               SUM(CASE WHEN e.user_id = ? THEN e.amount ELSE 0 END) as paid_total,
-               SUM(CASE WHEN ep.user_id = ? THEN ep.amount ELSE 0 END) as debt_total
-        FROM expense e
-        LEFT JOIN expense_participant ep ON e.id = ep.expense_id AND ep.is_paid = 0
-        WHERE e.event_id = 1
-        GROUP BY e.currency
-    ''', (user.id, user.id))
-
-    results = cursor.fetchall()
-    conn.close()
+    results = await db.ledger.get_balance(user.id)
 
     if not results:
         await update.message.reply_text("Нет данных о платежах")
@@ -485,19 +507,7 @@ async def show_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def show_my_debt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Все НЕоплаченные долги пользователя по каждому платежу с указанием кому должен."""
     user = update.message.from_user
-    conn = sqlite3.connect('expenses.db')
-    cursor = conn.cursor()
-
-    cursor.execute('''
-        SELECT e.name, ep.amount, e.currency, u_payer.name, u_payer.payment_credentials
-        FROM expense_participant ep
-        JOIN expense e ON ep.expense_id = e.id
-        JOIN user u_payer ON e.user_id = u_payer.id
-        WHERE ep.user_id = ? AND ep.is_paid = 0
-        ORDER BY e.paid_date DESC, e.id DESC
-    ''', (user.id,))
-    debts = cursor.fetchall()
-    conn.close()
+    debts = await db.ledger.get_user_debts(user.id)
 
     if debts:
         debt_text = f"Ваши долги, {user.first_name}:\n\n"
@@ -516,26 +526,11 @@ async def show_my_debt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         debt_text = "У вас нет долгов"
 
-    await update.message.reply_text(debt_text)
+    await messaging.reply_long(update.message, debt_text)
 
 async def show_total_debt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Отображает долги всех пользователей: Должник -> Кредитор: сумма валюта (только активные долги)."""
-    conn = sqlite3.connect('expenses.db')
-    cursor = conn.cursor()
-
-    cursor.execute('''
-        SELECT u_debtor.name, u_payer.name, u_payer.payment_credentials, SUM(ep.amount) as total_debt, e.currency
-        FROM expense_participant ep
-        JOIN user u_debtor ON ep.user_id = u_debtor.id
-        JOIN expense e ON ep.expense_id = e.id
-        JOIN user u_payer ON e.user_id = u_payer.id
-        WHERE ep.is_paid = 0
-        GROUP BY u_debtor.id, u_debtor.name, u_payer.id, u_payer.name, e.currency
-        ORDER BY u_debtor.name, u_payer.name
-    ''')
-
-    debts = cursor.fetchall()
-    conn.close()
+    debts = await db.ledger.get_total_debts()
 
     if debts:
         debt_text = "Общие долги:\n\n"
@@ -547,25 +542,12 @@ async def show_total_debt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         debt_text = "Нет активных долгов"
 
-    await update.message.reply_text(debt_text)
+    await messaging.reply_long(update.message, debt_text)
 
 async def show_my_debt_by_category(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Мои долги, сгруппированные по категориям и валютам."""
     user = update.message.from_user
-    conn = sqlite3.connect('expenses.db')
-    cursor = conn.cursor()
-
-    cursor.execute('''
-        SELECT COALESCE(c.name, 'Без категории') as cat_name, e.currency, SUM(ep.amount)
-        FROM expense_participant ep
-        JOIN expense e ON ep.expense_id = e.id
-        LEFT JOIN category c ON e.category_id = c.id
-        WHERE ep.user_id = ? AND ep.is_paid = 0
-        GROUP BY cat_name, e.currency
-        ORDER BY cat_name, e.currency
-    ''', (user.id,))
-    rows = cursor.fetchall()
-    conn.close()
+    rows = await db.ledger.get_user_debts_by_category(user.id)
 
     if not rows:
         await update.message.reply_text("У вас нет активных долгов по категориям")
@@ -578,24 +560,11 @@ async def show_my_debt_by_category(update: Update, context: ContextTypes.DEFAULT
             lines.append(f"\n— {cat_name} —")
             cur_cat = cat_name
         lines.append(f"{currency}: {float(total):.2f}")
-    await update.message.reply_text("\n".join(lines))
+    await messaging.reply_long(update.message, "\n".join(lines))
 
 async def show_total_debt_by_category(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Долги всех пользователей, сгруппированные по категориям и валютам."""
-    conn = sqlite3.connect('expenses.db')
-    cursor = conn.cursor()
-
-    cursor.execute('''
-        SELECT COALESCE(c.name, 'Без категории') as cat_name, e.currency, SUM(ep.amount)
-        FROM expense_participant ep
-        JOIN expense e ON ep.expense_id = e.id
-        LEFT JOIN category c ON e.category_id = c.id
-        WHERE ep.is_paid = 0
-        GROUP BY cat_name, e.currency
-        ORDER BY cat_name, e.currency
-    ''')
-    rows = cursor.fetchall()
-    conn.close()
+    rows = await db.ledger.get_total_debts_by_category()
 
     if not rows:
         await update.message.reply_text("Нет активных долгов по категориям")
@@ -608,15 +577,32 @@ async def show_total_debt_by_category(update: Update, context: ContextTypes.DEFA
             lines.append(f"\n— {cat_name} —")
             cur_cat = cat_name
         lines.append(f"{currency}: {float(total):.2f}")
-    await update.message.reply_text("\n".join(lines))
+    await messaging.reply_long(update.message, "\n".join(lines))
+
+async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/stats [все] [7d | с [по]] — траты по категориям и по дням из дневных сводок."""
+    user = update.message.from_user
+    try:
+        everyone, date_from, date_to = stats.parse_period(context.args or [])
+    except ValueError as e:
+        await update.message.reply_text(
+            f"{e}\nИспользование: /stats [все] [7d | 01.07 [15.07]]",
+            reply_markup=get_main_keyboard()
+        )
+        return
+    rows = await db.stats.get_daily(user_id=None if everyone else user.id, date_from=date_from, date_to=date_to)
+    categories = dict(await get_categories_from_db())
+    title = "Траты всех участников" if everyone else f"Ваши траты, {user.first_name}"
+    title += stats.format_period(date_from, date_to)
+    await messaging.reply_long(update.message, stats.build_report(rows, categories, title), reply_markup=get_main_keyboard())
 
 async def show_payment_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    payments = get_payments_from_db()
+    payments = await get_payments_from_db()
     if not payments:
         await update.message.reply_text("История платежей пуста")
         return
 
-    # e.* = [0:id,1:amount,2:currency,3:event_id,4:name,5:paid_date,6:user_id,7:message_id,8:category_id]
+    # e = [0:id,1:amount,2:currency,3:event_id,4:name,5:paid_date,6:user_id,7:message_id,8:category_id]
     # затем JOIN user u.name -> index 9, LEFT JOIN category c.name -> index 10
     history_text = "Последние платежи:\n\n"
     for p in payments:
@@ -634,8 +620,8 @@ async def show_payment_history(update: Update, context: ContextTypes.DEFAULT_TYP
         )
 
         # Подтянем должников по этому платежу (только активные долги)
-        shares = get_shares_for_payment(payment_id)
-        # shares: ep.* + u.name => [0:id,1:amount,2:expense_id,3:is_paid,4:user_id,5:user_name]
+        shares = await get_shares_for_payment(payment_id)
+        # shares: ep + u.name => [0:id,1:amount,2:expense_id,3:is_paid,4:user_id,5:user_name]
         debtors_lines = []
         for s in shares:
             is_paid = s[3]
@@ -650,7 +636,62 @@ async def show_payment_history(update: Update, context: ContextTypes.DEFAULT_TYP
 
         history_text += "\n"
 
-    await update.message.reply_text(history_text)
+    await messaging.reply_long(update.message, history_text)
+
+def get_find_keyboard(key, page, has_next):
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("« Назад", callback_data=f"find_{key}_{page - 1}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Дальше »", callback_data=f"find_{key}_{page + 1}"))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+async def find_page(query, page):
+    """Страница результатов: (текст, есть ли следующая)."""
+    rows = await db.expenses.search(query.terms, limit=search.PAGE_SIZE + 1, offset=page * search.PAGE_SIZE,
+                                    **query.filters())
+    has_next = len(rows) > search.PAGE_SIZE
+    return search.format_results(rows[:search.PAGE_SIZE], page, has_next), has_next
+
+async def find_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/find такси вт >500 — поиск платежей по названию, категории и плательщику с фильтрами, см. search.py."""
+    global find_query_seq
+    try:
+        query = search.parse_query(' '.join(context.args or []))
+    except ValueError as e:
+        await update.message.reply_text(f'Ошибка! {e}')
+        return
+    if query.is_empty():
+        await update.message.reply_text(
+            'Что искать? Например: /find такси, /find такси вт, /find ужин 01.07-15.07 >1000\n'
+            'Слова ищутся по названию, категории и плательщику (можно начало слова), '
+            'даты — 14.07 или 01.07-15.07, день недели — пн...вс, сумма — >500, <1000, 500-1000'
+        )
+        return
+
+    text, has_next = await find_page(query, 0)
+    key = None
+    if has_next:
+        find_query_seq += 1
+        key = find_query_seq
+        find_queries[key] = query
+        while len(find_queries) > FIND_CACHE_SIZE:
+            del find_queries[next(iter(find_queries))]
+    await update.message.reply_text(text, reply_markup=get_find_keyboard(key, 0, has_next))
+
+async def find_callback(query):
+    """Кнопки "Назад"/"Дальше" под результатами /find: callback_data find_<ключ>_<страница>."""
+    try:
+        _, key, page = query.data.split('_')
+        key, page = int(key), max(int(page), 0)
+    except ValueError:
+        return
+    search_query = find_queries.get(key)
+    if search_query is None:
+        await query.edit_message_text('Результаты поиска устарели, повторите /find')
+        return
+    text, has_next = await find_page(search_query, page)
+    await query.edit_message_text(text, reply_markup=get_find_keyboard(key, page, has_next))
 
 async def handle_unknown_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
@@ -667,13 +708,25 @@ async def handle_unknown_message(update: Update, context: ContextTypes.DEFAULT_T
         await update.message.reply_text("Выберите действие из меню ниже:", reply_markup=get_main_keyboard())
 
 async def get_payment_from_photo(update, context):
-    photo = update.message.photo[-1]
-    file_id = photo.file_id
-    file = await context.bot.get_file(file_id)
-    file_url = file.file_path
     description = 'Данные из чека'
-    amount = ocr.get_total_by_url(file_url)
-    return description, amount
+    receipt = await recognize_receipt(update.message.photo, context)
+    return description, receipt
+
+async def recognize_receipt(photo_sizes, context):
+    """Распознаёт чек, начиная с небольшого размера фото и переходя к большему только при неуверенном результате."""
+    receipt = None
+    ladder = ocr.photo_ladder(photo_sizes, OCR_LADDER_MIN_SIDE)
+    for step, photo in enumerate(ladder):
+        file = await context.bot.get_file(photo.file_id)
+        candidate = await ocr.get_receipt_by_url_async(file.file_path, get_ocr_pool())
+        if candidate and candidate['total'] is not None and (receipt is None or candidate['confidence'] >= receipt['confidence']):
+            receipt = candidate
+        if receipt and receipt['confidence'] >= OCR_CONFIRM_THRESHOLD:
+            break
+    if ladder:
+        ocr.record_ladder(step, photo)
+        logger.info('Чек: размер %sx%s, ступень %s из %s', photo.width, photo.height, step + 1, len(ladder))
+    return receipt or {'total': None, 'confidence': 0.0, 'items': []}
 
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
@@ -681,30 +734,100 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     state = user_states.get(user.id)
     photos = update.message.photo
+    if state == "waiting_title" and photos and update.message.media_group_id:
+        collect_media_group(update, context)
+        return
     if state == "waiting_title" and photos:
         wait_message = await update.message.reply_text(
             f"Обрабатываю изображение..."
         )
-        description, amount = await get_payment_from_photo(update, context)
+        description, receipt = await get_payment_from_photo(update, context)
         await context.bot.deleteMessage(message_id=wait_message.message_id, chat_id=update.message.chat_id)
+        amount = receipt['total']
+        items = receipt['items']
+        logger.info('Чек распознан через %s: сумма %s, уверенность %.2f', receipt.get('source'), amount, receipt['confidence'])
         if amount is not None:
+            # у чека с фискальным QR-кодом время покупки известно точно
+            paid_at = receipt.get('timestamp') or datetime.now()
             payment = {
                 'description': description,
                 'user_id': user.id,
                 'created_by': user.first_name,
                 'chat_id': update.message.chat.id,
-                'timestamp': datetime.now().strftime("%d.%m.%Y %H:%M"),
+                'timestamp': paid_at.strftime("%d.%m.%Y %H:%M"),
                 'amount': float(amount),
+                'items': items,
             }
             context.user_data['pending_payment'] = payment
             del user_states[user.id]
+            items_text = f"\n\nПозиции:\n{format_receipt_items(items)}" if items else ""
+            if receipt['confidence'] >= OCR_CONFIRM_THRESHOLD:
+                # сумма распознана уверенно — сразу к выбору категории, как после "Подтвердить"
+                await update.message.reply_text(
+                    f"Распознано:\n\nНазвание: {payment['description']}\nСумма: {payment['amount']:.2f} руб.\nСоздал: {payment['created_by']}{items_text}\n\nВыберите категорию:",
+                    reply_markup=await get_category_keyboard()
+                )
+                return
             await update.message.reply_text(
-                f"Проверьте данные:\n\nНазвание: {payment['description']}\nСумма: {payment['amount']:.2f} руб.\nСоздал: {payment['created_by']}\n\nПодтвердить создание платежа?",
+                f"Проверьте данные:\n\nНазвание: {payment['description']}\nСумма: {payment['amount']:.2f} руб.\nСоздал: {payment['created_by']}{items_text}\n\nПодтвердить создание платежа?",
                 reply_markup=get_confirmation_keyboard()
             )
         else:
             await update.message.reply_text("Не удалось распознать данные из чека, напишите текстом")
 
+def collect_media_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Фото альбома приходят отдельными сообщениями с общим media_group_id: копим их и обрабатываем разом."""
+    group_id = update.message.media_group_id
+    if group_id not in media_groups:
+        media_groups[group_id] = []
+        context.application.create_task(process_media_group(group_id, update.message.from_user, context))
+    media_groups[group_id].append(update.message)
+
+async def process_media_group(group_id, user, context: ContextTypes.DEFAULT_TYPE):
+    """Распознаёт все чеки альбома параллельно в пуле и предлагает один общий платёж с суммами по каждому чеку."""
+    await asyncio.sleep(MEDIA_GROUP_DELAY)
+    messages = sorted(media_groups.pop(group_id, []), key=lambda m: m.message_id)
+    if not messages:
+        return
+    first = messages[0]
+
+    wait_message = await first.reply_text(f"Обрабатываю чеки: {len(messages)} шт....")
+    receipts = await asyncio.gather(*(recognize_receipt(m.photo, context) for m in messages))
+    await context.bot.deleteMessage(message_id=wait_message.message_id, chat_id=first.chat_id)
+
+    recognized = [r for r in receipts if r['total'] is not None]
+    if not recognized:
+        await first.reply_text("Не удалось распознать данные из чеков, напишите текстом")
+        return
+
+    lines = []
+    for i, r in enumerate(receipts, start=1):
+        if r['total'] is None:
+            lines.append(f"Чек {i}: не распознан")
+        else:
+            lines.append(f"Чек {i}: {r['total']:.2f} руб.")
+    # позиции показываем, только если они есть у всех распознанных чеков — иначе часть суммы нельзя забрать
+    items = []
+    if all(r['items'] for r in recognized):
+        items = [it for r in recognized for it in r['items']]
+
+    payment = {
+        'description': f'Чеки ({len(recognized)} шт.)',
+        'user_id': user.id,
+        'created_by': user.first_name,
+        'chat_id': first.chat.id,
+        'timestamp': datetime.now().strftime("%d.%m.%Y %H:%M"),
+        'amount': round(sum(r['total'] for r in recognized), 2),
+        'items': items,
+    }
+    context.user_data['pending_payment'] = payment
+    user_states.pop(user.id, None)
+    await first.reply_text(
+        f"Проверьте данные:\n\n" + "\n".join(lines) +
+        f"\n\nНазвание: {payment['description']}\nСумма: {payment['amount']:.2f} руб.\nСоздал: {payment['created_by']}\n\nПодтвердить создание платежа?",
+        reply_markup=get_confirmation_keyboard()
+    )
+
 async def request_payment_credentials(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
     user_states[user.id] = 'waiting_payment_credentials'
@@ -717,67 +840,96 @@ async def set_payment_credentials(update: Update, context: ContextTypes.DEFAULT_
 
     del user_states[user.id]
 
-    conn = sqlite3.connect('expenses.db')
-    cursor = conn.cursor()
-
-    cursor.execute('''
-        INSERT INTO user (id, name, payment_credentials) VALUES (?, ?, ?)
-        ON CONFLICT DO UPDATE
-        SET payment_credentials = ?
-    ''', (user.id, user.first_name, payment_credentials, payment_credentials))
-
-    conn.commit()
-    conn.close()
+    await db.users.set_payment_credentials(user.id, user.first_name, payment_credentials)
 
     await update.message.reply_text("Платежные данные установлены:\n" + payment_credentials)
 
 async def show_my_payment_credentials(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
+    credentials = await db.users.get_payment_credentials(user.id)
 
-    conn = sqlite3.connect('expenses.db')
-    cursor = conn.cursor()
-
-    cursor.execute('''
-        SELECT payment_credentials
-        FROM user
-        WHERE id = ?
-    ''', (user.id,))
-
-    credentials = cursor.fetchall()
-
-    conn.commit()
-    conn.close()
-
-    if not credentials or credentials[0][0] is None:
+    if credentials is None:
         await update.message.reply_text("У вас не указаны платежные данные")
     else:
-        await update.message.reply_text("Ваши платежные данные:\n" + credentials[0][0])
+        await update.message.reply_text("Ваши платежные данные:\n" + credentials)
 
 
 # =========================
-# OPTIMIZER
+# EXPORT
 # =========================
 
-async def optimize_debts(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Запустить оптимизацию долгов: получить план переводов, отправить и закрепить сообщение с упоминаниями, затем пометить старые долги как оплаченные."""
-    if update.effective_chat.type == 'private':
-        await update.message.reply_text('Оптимизация долгов доступна только в групповых чатах.')
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/export [csv|jsonl] — все платежи мероприятия с долями и план переводов файлами."""
+    fmt = (context.args[0].lower() if context.args else 'csv')
+    if fmt not in export.FORMATS:
+        await update.message.reply_text('Использование: /export [csv|jsonl]')
+        return
+    status = messaging.StatusMessage(update.message)
+    await status.set('Готовлю выгрузку...')
+    try:
+        files, count = await export.export_event(db, fmt)
+    except Exception as e:
+        logger.exception('Ошибка выгрузки: %s', e)
+        await status.set('Не удалось подготовить выгрузку. Смотрите логи.')
         return
+    try:
+        for filename, buf in files:
+            # PTB всё равно читает загружаемый файл целиком; у буфера в памяти нет имени, поэтому передаём байты
+            await update.message.reply_document(document=buf.read(), filename=filename)
+    finally:
+        for _, buf in files:
+            buf.close()
+    await status.set(f'Выгрузка готова: {count} строк о платежах и долях')
 
-    chat_id = update.effective_chat.id
-    await update.message.reply_text('Формирую план переводов...')
+# =========================
+# IMPORT
+# =========================
 
+async def import_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/import — CSV-файл в подписи или ответом на сообщение с файлом: expenses.csv из /export или экспорт Splitwise.
+
+    Участников Splitwise можно сопоставить в той же строке: /import Anna=@anna, Bob=@boris
+    """
+    message = update.message
+    document = message.document or (message.reply_to_message and message.reply_to_message.document)
+    if document is None:
+        await message.reply_text(
+            'Пришлите CSV-файл с подписью /import или ответьте /import на сообщение с файлом.\n'
+            'Поддерживаются expenses.csv из /export и экспорт Splitwise '
+            '(участников можно сопоставить так: /import Anna=@anna, Bob=@boris)'
+        )
+        return
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        await message.reply_text(f'Файл слишком большой: не больше {IMPORT_MAX_BYTES // (1024 * 1024)} МБ')
+        return
+    command_text = message.caption if message.document else message.text
+    mapping_text = (command_text or '').partition(' ')[2]
+    status = messaging.StatusMessage(message)
+    await status.set('Загружаю файл...')
+    data = io.BytesIO()
     try:
-        transfers = debts_optimizer.optimize_transfers_with_allocations('expenses.db')
+        file = await document.get_file()
+        await file.download_to_memory(data)
+        data.seek(0)
+        await status.set('Импортирую платежи...')
+        result = await importer.import_csv(db, data, mapping_text)
+    except importer.ImportFormatError as e:
+        await status.set(str(e))
+        return
     except Exception as e:
-        logger.exception('Ошибка при запуске оптимизатора: %s', e)
-        await update.message.reply_text('Ошибка при формировании плана переводов. Смотрите логи.')
+        logger.exception('Ошибка импорта: %s', e)
+        await status.set('Не удалось импортировать файл. Смотрите логи.')
         return
+    if result.shares:
+        live_plans.touch()
+    await status.set(result.summary())
 
-    if not transfers:
-        await update.message.reply_text('Нет активных задолженностей для оптимизации.')
-        return
+# =========================
+# OPTIMIZER
+# =========================
 
+async def build_plan_text(transfers, title):
+    """HTML-текст плана: переводы {from, to, amount, currency} по валютам с реквизитами получателей и упоминаниями."""
     by_currency = {}
     involved = set()
     for t in transfers:
@@ -788,12 +940,14 @@ async def optimize_debts(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         users = dict()
-        for id, name, payment_credentials in debts_optimizer.get_all_users('expenses.db'):
+        for id, name, payment_credentials in await debts_optimizer.get_all_users(db.users):
             users[id] = (name, payment_credentials)
     except Exception:
         users = {}
 
-    lines = ['План переводов (оптимизация):']
+    lines = [title]
+    if not transfers:
+        lines.append('Непогашенных долгов нет')
     currency_labels = {'RUB': 'RUB ₽', 'USD': 'USD $', 'EUR': 'EUR €'}
 
     for cur in sorted(by_currency.keys()):
@@ -831,13 +985,70 @@ async def optimize_debts(update: Update, context: ContextTypes.DEFAULT_TYPE):
     full_text = "\n".join(lines)
     if mentions:
         full_text += "\n\nУчастники: " + ", ".join(mentions)
+    return full_text
+
+async def optimize_debts(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Запустить оптимизацию долгов: получить план переводов, отправить и закрепить сообщение с упоминаниями, затем пометить старые долги как оплаченные."""
+    if update.effective_chat.type == 'private':
+        await update.message.reply_text('Оптимизация долгов доступна только в групповых чатах.')
+        return
+
+    mode = (context.args[0].lower() if context.args else SETTLEMENT_MODE)
+    if mode not in debts_optimizer.SETTLEMENT_MODES:
+        await update.message.reply_text('Режим расчёта: /optimize net (минимум переводов) '
+                                        'или /optimize direct (только между теми, кто уже должен друг другу)')
+        return
+
+    chat_id = update.effective_chat.id
+    # статусы операции — правки одного сообщения, а не отдельные ответы
+    status = messaging.StatusMessage(update.message)
+    await status.set('Формирую план переводов...')
 
     try:
-        sent = await context.bot.send_message(chat_id=chat_id, text=full_text, parse_mode='HTML', disable_web_page_preview=True)
+        transfers = await debts_optimizer.optimize_transfers_with_allocations(db.ledger, mode)
+    except Exception as e:
+        logger.exception('Ошибка при запуске оптимизатора: %s', e)
+        await status.set('Ошибка при формировании плана переводов. Смотрите логи.')
+        return
+
+    if not transfers:
+        await status.set('Нет активных задолженностей для оптимизации.')
+        return
+
+    # запуск пишется в журнал расчётов до отправки плана: после сбоя journal.recover знает, что было сделано
+    try:
+        run_id = await db.ledger.journal_planned(mode, transfers, chat_id=chat_id)
+    except Exception as e:
+        logger.exception('Не удалось записать план в журнал расчётов: %s', e)
+        await status.set('Ошибка при формировании плана переводов. Смотрите логи.')
+        return
+
+    # записи с нулевой суммой — взаимозачёт: в план не попадают, но их доли тоже помечаются оплаченными
+    payments = [t for t in transfers if t['amount'] > 0]
+    if not payments:
+        try:
+            await debts_optimizer.mark_allocations_paid(db.ledger, transfers, run_id)
+        except Exception as e:
+            logger.exception('Ошибка при взаимозачёте долгов: %s', e)
+            await db.ledger.journal_append(run_id, journal.FAILED, detail=str(e))
+            await status.set('Не удалось зачесть взаимные долги. Смотрите логи.')
+            return
+        live_plans.touch()
+        await status.set('Переводы не нужны: взаимные долги зачтены и помечены как оплаченные')
+        return
+
+    title = 'План переводов (оптимизация):' if mode == 'net' else 'План переводов (только между должниками и их кредиторами):'
+    full_text = await build_plan_text(payments, title)
+
+    try:
+        # в больших группах план длиннее 4096 символов — делится на несколько сообщений, закрепляется первое
+        sent = (await messaging.send_long(context.bot, chat_id, full_text, parse_mode='HTML', disable_web_page_preview=True))[0]
     except Exception as e:
         logger.exception('Не удалось отправить сообщение с планом: %s', e)
-        await update.message.reply_text('Не удалось отправить план переводов. Смотрите логи.')
+        await db.ledger.journal_append(run_id, journal.FAILED, detail=f'план не отправлен: {e}')
+        await status.set('Не удалось отправить план переводов. Смотрите логи.')
         return
+    await db.ledger.journal_append(run_id, journal.POSTED, message_id=sent.message_id)
 
     try:
         await context.bot.pin_chat_message(chat_id=chat_id, message_id=sent.message_id)
@@ -845,50 +1056,275 @@ async def optimize_debts(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.warning('Не удалось закрепить сообщение: %s', e)
 
     try:
-        debts_optimizer.mark_allocations_paid('expenses.db', transfers)
+        await debts_optimizer.mark_allocations_paid(db.ledger, transfers, run_id)
     except Exception as e:
         logger.exception('Ошибка при пометке аллокаций как оплаченных: %s', e)
-        await update.message.reply_text('План сформирован, но не удалось пометить задействованные доли как оплаченные. Смотрите логи.')
+        await db.ledger.journal_append(run_id, journal.FAILED, detail=str(e))
+        await status.set('План сформирован, но не удалось пометить задействованные доли как оплаченные. Смотрите логи.')
+        return
+
+    live_plans.touch()
+    await status.set('План сформирован, задействованные долги помечены как оплаченные')
+
+async def live_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/live on — закрепить план переводов, который бот сам обновляет после новых долей; /live off — выключить."""
+    if update.effective_chat.type == 'private':
+        await update.message.reply_text('Живой план доступен только в групповых чатах.')
         return
+    chat_id = update.effective_chat.id
+    arg = context.args[0].lower() if context.args else ''
+    if arg not in ('on', 'off'):
+        state = 'включён' if live_plans.enabled(chat_id) else 'выключен'
+        await update.message.reply_text(f'Живой план {state}. /live on — включить, /live off — выключить')
+        return
+
+    if arg == 'off':
+        message_id = live_plans.disable(chat_id)
+        if message_id is None:
+            await update.message.reply_text('Живой план и так выключен')
+            return
+        try:
+            await context.bot.unpin_chat_message(chat_id=chat_id, message_id=message_id)
+        except Exception as e:
+            logger.warning('Не удалось открепить живой план: %s', e)
+        await update.message.reply_text('Живой план выключен')
+        return
+
+    if live_plans.enabled(chat_id):
+        await update.message.reply_text('Живой план уже включён — он закреплён в чате')
+        return
+    try:
+        await live_plans.enable(context.bot, chat_id)
+    except Exception as e:
+        logger.exception('Не удалось включить живой план: %s', e)
+        await update.message.reply_text('Не удалось отправить план переводов. Смотрите логи.')
+
+# =========================
+# DIAGNOSTICS
+# =========================
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/profile N — статистический профиль всех потоков бота на N секунд (только для ADMIN_IDS)."""
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    try:
+        seconds = int(context.args[0]) if context.args else 30
+    except ValueError:
+        await update.message.reply_text('Использование: /profile <секунд>')
+        return
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    try:
+        diagnostics.start_profiling()
+    except ValueError as e:
+        await update.message.reply_text(str(e))
+        return
+    await update.message.reply_text(f'Профилирую {seconds} с...')
+    # ждём в отдельной задаче, чтобы профилировать обработку остальных апдейтов, а не блокировать её
+    context.application.create_task(finish_profiling(update, seconds))
+
+async def finish_profiling(update: Update, seconds):
+    await asyncio.sleep(seconds)
+    path, sampler = await asyncio.to_thread(diagnostics.stop_profiling)
+    lines = [f'Профиль: {path} ({sampler.samples} сэмплов)', 'Чаще всего на вершине стека:']
+    for (thread, frame), count in sampler.top_functions(10):
+        lines.append(f'{count * 100 / (sampler.samples or 1):.1f}% [{thread}] {frame}')
+    await update.message.reply_text('\n'.join(lines))
+
+async def slow_queries_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/slow_queries — последние медленные SQL-запросы (только для ADMIN_IDS)."""
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    if not diagnostics.slow_query_enabled():
+        await update.message.reply_text('Журнал медленных запросов выключен (SLOW_QUERY_MS в config.py)')
+        return
+    await update.message.reply_text(diagnostics.format_slow_queries()[-4000:])
+
+async def compact_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/compact — обслуживание базы сейчас (только для ADMIN_IDS)."""
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    status = messaging.StatusMessage(update.message)
+    await status.set('Обслуживание базы...')
+    try:
+        stats = await maintenance.compact(db, VACUUM_FREE_RATIO)
+    except Exception as e:
+        logger.exception('Ошибка обслуживания базы: %s', e)
+        await status.set('Не удалось выполнить обслуживание базы. Смотрите логи.')
+        return
+    await status.set(maintenance.format_report(stats))
+
+async def snapshot_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/snapshot — снимок базы сейчас (только для ADMIN_IDS)."""
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    if not isinstance(db, storage.SqliteStorage):
+        await update.message.reply_text('Снимки PostgreSQL делаются средствами сервера: pg_dump или pg_basebackup')
+        return
+    status = messaging.StatusMessage(update.message)
+    await status.set('Снимок базы...')
+    try:
+        stats = await maintenance.snapshot(db, SNAPSHOT_DIR, SNAPSHOT_KEEP)
+    except Exception as e:
+        logger.exception('Ошибка снимка базы: %s', e)
+        await status.set('Не удалось сделать снимок базы. Смотрите логи.')
+        return
+    await status.set(maintenance.format_snapshot_report(stats))
+
+async def journal_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/journal [N] — последние N запусков /optimize и их состояние (только для ADMIN_IDS)."""
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    try:
+        limit = min(int(context.args[0]), 50) if context.args else 10
+    except ValueError:
+        await update.message.reply_text('Использование: /journal [N]')
+        return
+    text = journal.format_runs(await db.ledger.get_recent_runs(limit))
+    await messaging.send_long(context.bot, update.effective_chat.id, text)
 
-    await update.message.reply_text('Задействованные долги помечены как оплаченные')
+async def close_event_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/close_event ID — закрыть мероприятие: его погашенные платежи уйдут в архив (только для ADMIN_IDS)."""
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    try:
+        event_id = int(context.args[0])
+    except (IndexError, ValueError):
+        await update.message.reply_text('Использование: /close_event ID')
+        return
+    if await db.expenses.close_event(event_id):
+        await update.message.reply_text(
+            f'Мероприятие {event_id} закрыто: погашенные платежи уйдут в архив при следующем обслуживании (/compact)')
+    else:
+        await update.message.reply_text(f'Мероприятие {event_id} не найдено')
 
 # =========================
 # MAIN
 # =========================
 
-def main():
-    init_database()
-    application = Application.builder().token(BOT_TOKEN).build()
-
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("balance", show_balance))
-    application.add_handler(CommandHandler("my_debt", show_my_debt))
-    application.add_handler(CommandHandler("total_debt", show_total_debt))
-    application.add_handler(CommandHandler("my_debt_by_category", show_my_debt_by_category))
-    application.add_handler(CommandHandler("total_debt_by_category", show_total_debt_by_category))
-    application.add_handler(CommandHandler("optimize", optimize_debts))
-    application.add_handler(CommandHandler("optimize_debts", optimize_debts))
-    application.add_handler(CommandHandler("history", show_payment_history))
+async def on_startup(application):
+    global compaction_task, snapshot_task
+    await db.connect()
+    await db.init_schema()
+    # до приёма апдейтов: завершить расчёты, прерванные прошлым падением бота
+    await journal.recover(db.ledger)
+    if METRICS_PORT:
+        metrics.start_server(METRICS_PORT, METRICS_HOST)
+        logger.info('Метрики: http://%s:%s/metrics', METRICS_HOST, METRICS_PORT)
+    if COMPACT_INTERVAL_HOURS:
+        # не application.create_task: Application.stop ждёт такие задачи, а цикл бесконечный
+        compaction_task = asyncio.create_task(
+            maintenance.compaction_loop(db, COMPACT_INTERVAL_HOURS * 3600, VACUUM_FREE_RATIO))
+    if SNAPSHOT_INTERVAL_HOURS and isinstance(db, storage.SqliteStorage):
+        snapshot_task = asyncio.create_task(
+            maintenance.snapshot_loop(db, SNAPSHOT_INTERVAL_HOURS * 3600, SNAPSHOT_DIR, SNAPSHOT_KEEP))
+
+async def on_shutdown(application):
+    if compaction_task is not None:
+        compaction_task.cancel()
+    if snapshot_task is not None:
+        snapshot_task.cancel()
+    live_plans.close()
+    metrics.stop_server()
+    await db.close()
+    if ocr_pool is not None:
+        ocr_pool.shutdown(wait=False, cancel_futures=True)
+
+def get_ocr_pool():
+    """Пул OCR создаётся при первом фото чека: без фото бот не запускает воркеры и не грузит стек распознавания."""
+    global ocr_pool
+    if ocr_pool is None:
+        ocr_pool = ocr.create_worker_pool(OCR_WORKERS, OCR_ENGINE)
+    return ocr_pool
+
+def timed_handler(callback):
+    """Обёртка обработчика для метрики bot_handler_seconds; у callback-кнопок тип — префикс callback_data."""
+    @functools.wraps(callback)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        kind = ''
+        if update.callback_query and update.callback_query.data:
+            kind = update.callback_query.data.split('_', 1)[0]
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            metrics.inc('bot_handler_errors_total', handler=callback.__name__, callback=kind)
+            raise
+        finally:
+            metrics.observe('bot_handler_seconds', time.perf_counter() - started, handler=callback.__name__, callback=kind)
+    return wrapper
+
+def register_queue_gauges(application):
+    metrics.register_gauge('bot_update_queue_depth', 'Апдейты, ожидающие обработки', application.update_queue.qsize)
+    metrics.register_gauge('ocr_queue_depth', 'Чеки, отправленные в пул OCR и ещё не распознанные', lambda: ocr.OCR_IN_FLIGHT)
+    metrics.register_gauge('media_group_queue_depth', 'Альбомы фото, которые ещё собираются', lambda: len(media_groups))
+    processor = application.update_processor
+    if isinstance(processor, scheduler.FairUpdateProcessor):
+        metrics.register_gauge('scheduler_pending_updates', 'Апдейты в очередях чатов планировщика', lambda: processor.pending)
+        metrics.register_gauge('scheduler_chats', 'Чаты с ожидающими или выполняемыми апдейтами', lambda: processor.chats)
+    metrics.register_gauge('user_states_size', 'Пользователи в середине диалога (ввод платежа, реквизитов)', lambda: len(user_states))
+
+def build_application(builder=None, rate_limit=True):
+    """Собирает Application со всеми обработчиками; builder можно передать свой (например, с фейковым request в loadtest.py).
+
+    rate_limit — ограничивать частоту исходящих запросов под лимиты Telegram (messaging.TokenBucketRateLimiter).
+    """
+    if builder is None:
+        builder = Application.builder().token(BOT_TOKEN)
+    builder = builder.concurrent_updates(scheduler.FairUpdateProcessor(UPDATE_WORKERS, CHAT_QUEUE_LIMIT))
+    if rate_limit:
+        builder = builder.rate_limiter(messaging.TokenBucketRateLimiter())
+    application = builder.post_init(on_startup).post_shutdown(on_shutdown).build()
+    # при выключенных метриках обработчики не оборачиваются вовсе
+    wrap = (lambda callback: callback)
+    if metrics.enabled():
+        register_queue_gauges(application)
+        wrap = timed_handler
+
+    application.add_handler(CommandHandler("start", wrap(start)))
+    application.add_handler(CommandHandler("balance", wrap(show_balance)))
+    application.add_handler(CommandHandler("my_debt", wrap(show_my_debt)))
+    application.add_handler(CommandHandler("total_debt", wrap(show_total_debt)))
+    application.add_handler(CommandHandler("my_debt_by_category", wrap(show_my_debt_by_category)))
+    application.add_handler(CommandHandler("total_debt_by_category", wrap(show_total_debt_by_category)))
+    application.add_handler(CommandHandler("optimize", wrap(optimize_debts)))
+    application.add_handler(CommandHandler("optimize_debts", wrap(optimize_debts)))
+    application.add_handler(CommandHandler("live", wrap(live_command)))
+    application.add_handler(CommandHandler("history", wrap(show_payment_history)))
+    application.add_handler(CommandHandler("stats", wrap(show_stats)))
+    application.add_handler(CommandHandler("find", wrap(find_command)))
+    application.add_handler(CommandHandler("export", wrap(export_command)))
+    application.add_handler(CommandHandler("import", wrap(import_command)))
+    application.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r'^/import\b'), wrap(import_command)))
+    application.add_handler(CommandHandler("profile", wrap(profile_command)))
+    application.add_handler(CommandHandler("slow_queries", wrap(slow_queries_command)))
+    application.add_handler(CommandHandler("compact", wrap(compact_command)))
+    application.add_handler(CommandHandler("snapshot", wrap(snapshot_command)))
+    application.add_handler(CommandHandler("journal", wrap(journal_command)))
+    application.add_handler(CommandHandler("close_event", wrap(close_event_command)))
 
     application.add_handler(MessageHandler(
         filters.Text([
             "Создать платеж", "Баланс", "Мой долг", "Общий долг",
             "История платежей", "Оптимизация долгов",
             "Мой долг по категориям", "Общий долг по категориям",
-            "Указать данные для оплаты", "Мои данные для оплаты"
+            "Указать данные для оплаты", "Мои данные для оплаты",
+            "Статистика"
         ]),
-        handle_main_buttons
+        wrap(handle_main_buttons)
     ))
 
-    application.add_handler(CallbackQueryHandler(button_callback))
+    application.add_handler(CallbackQueryHandler(wrap(button_callback)))
     # порядок важен: ответ на сообщение -> попытка записать долю
-    application.add_handler(MessageHandler(filters.TEXT & filters.REPLY, handle_reply_message))
+    application.add_handler(MessageHandler(filters.TEXT & filters.REPLY, wrap(handle_reply_message)))
     # "непонятные" личные сообщения
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_unknown_message))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, wrap(handle_unknown_message)))
     # фото для чеков
-    application.add_handler(MessageHandler(filters.PHOTO & ~filters.COMMAND, handle_photo))
+    application.add_handler(MessageHandler(filters.PHOTO & ~filters.COMMAND, wrap(handle_photo)))
+
+    return application
 
+def main():
+    application = build_application()
     application.run_polling()
 
 if __name__ == '__main__':
@@ -1,6 +1,20 @@
-import sqlite3
+import argparse
+import asyncio
+import heapq
+import json
+import logging
 import os
+import sys
 from collections import defaultdict
+from operator import itemgetter
+
+import journal
+import metrics
+
+try:
+    import numpy as np
+except ImportError:  # NumPy необязателен: без него балансы считаются циклом на Python
+    np = None
 
 # Новый модуль-оптимизатор долгов.
 # Подход:
@@ -11,7 +25,49 @@ from collections import defaultdict
 #    Для точности и избежания ошибок с float работаем в целых копейках (amount_cents = round(amount*100)).
 # 4) Произвести аллокации — сопоставить переводам конкретные строки expense_participant должника (по id возрастанию) и вернуть структуру
 #    с allocs = [(ep_id, used_amount, expense_id, original_amount), ...]
-# 5) mark_allocations_paid выполняет все изменения в одной транзакции (BEGIN IMMEDIATE), проверяет согласованность и либо коммитит, либо откатывает.
+# 5) mark_allocations_paid выполняет все изменения в одной транзакции, проверяет согласованность и либо коммитит, либо откатывает.
+#
+# Сам модуль SQL не содержит: строки читаются и изменения применяются через LedgerRepository (storage.py),
+# а compute_* / plan_allocation_updates — чистые функции над списками строк. Async-обёртки (optimize_transfers*)
+# считают план в потоке (asyncio.to_thread): расчёт большого мероприятия не задерживает ответы боту в других чатах.
+#
+# Балансы (шаг 2) на больших списках строк (от NUMPY_MIN_ROWS, например пересчёт крупного мероприятия)
+# считаются через NumPy, если он установлен: суммы, должники, кредиторы и коды валют загружаются в массивы,
+# id пользователей факторизуются, балансы в копейках собираются np.add.at по ключу (валюта, пользователь).
+# Результат совпадает с циклом на Python до копейки (см. bench_optimizer.py). DEBTS_NUMPY=0 в окружении
+# отключает NumPy-путь.
+#
+# Режимы расчёта (SETTLEMENT_MODES):
+#   net    — неттинг балансов (шаги 2-4): переводов меньше всего, но можно получить перевод человеку,
+#            с которым не было общих платежей (A должен B, B должен C -> A платит C);
+#   direct — переводы только между парами, у которых уже есть долг (compute_direct_settlement):
+#            граф долгов должник -> кредитор по парам, встречные долги пары взаимно зачитываются,
+#            затем min-cost flow (стоимость 1 за копейку на каждом ребре, пропускная способность ребра —
+#            чистый долг пары) находит потоки с теми же балансами и минимальным суммарным объёмом переводов:
+#            циклы долгов гасятся (поток по циклу только увеличивал бы стоимость), а кратчайшие пути
+#            дают мало рёбер. Точный минимум числа переводов — NP-трудная задача, здесь не ищется.
+#            Каждая пара гасит все свои строки целиком: сумма перевода (или 0 при полном взаимозачёте)
+#            плюс встречные строки. Перевод никогда не больше чистого долга пары.
+# Промежуточные результаты пишутся в лог на уровне DEBUG; DEBTS_DEBUG=1 в окружении включает его для этого модуля.
+#
+# Пакетный запуск без бота (ночные расчёты, разбор жалоб на копии базы):
+#   python -m debts_optimizer --db expenses.db --event 1 --event 2 --strategy direct --dry-run --json
+#   python -m debts_optimizer --db expenses.db --all-events
+# Все мероприятия считаются в одном процессе через одно соединение (SqliteStorage(shared_connection=True));
+# у каждого мероприятия свой план и своя транзакция пометки долей. --json — строка JSON на мероприятие
+# с переводами и аллокациями; --dry-run — только план, без пометки оплаченными; база при этом открывается
+# только для чтения и схема не обновляется. Запуски без --dry-run пишутся в журнал расчётов (journal.py)
+# с source='cli'.
+#
+# Валюта, балансы которой уже сошлись в ноль (только взаимные или циклические долги), в режиме net
+# тоже закрывается через compute_direct_settlement: переводов нет, строки помечаются оплаченными как зачёт.
+
+logger = logging.getLogger(__name__)
+if os.environ.get('DEBTS_DEBUG'):
+    logger.setLevel(logging.DEBUG)
+
+NUMPY_MIN_ROWS = 1000
+SETTLEMENT_MODES = ('net', 'direct')
 
 
 def _to_cents(x):
@@ -29,125 +85,280 @@ def _normalize_currency(cur):
     return s if s else 'RUB'
 
 
-def _read_unpaid_rows(conn):
-    cur = conn.cursor()
-    cur.execute('''
-        SELECT ep.id as ep_id, ep.user_id as debtor_id, e.user_id as creditor_id, ep.amount, COALESCE(UPPER(TRIM(e.currency)), 'RUB') as currency, ep.expense_id
-        FROM expense_participant ep
-        JOIN expense e ON ep.expense_id = e.id
-        WHERE ep.is_paid = 0
-    ''')
-    return cur.fetchall()
-
-
-def optimize_transfers(db_path='expenses.db'):
+@metrics.timed('optimizer_stage_seconds', stage='compute_transfers')
+def compute_transfers(rows):
     """Возвращает список кортежей (from_id, to_id, amount, currency).
 
+    rows — строки (ep_id, debtor_id, creditor_id, amount, currency, expense_id), см. LedgerRepository.get_unpaid_rows.
     Алгоритм: по каждой валюте собрать балансы и затем сопоставить должников и кредиторов жадно.
+    Валюты с нулевыми балансами переводов не дают — их взаимные долги зачитывает compute_direct_settlement.
     """
-    conn = sqlite3.connect(db_path)
-    rows = _read_unpaid_rows(conn)
-    conn.close()
-
     if not rows:
         return []
 
-    by_currency = defaultdict(list)
-    for ep_id, debtor_id, creditor_id, amount, currency, expense_id in rows:
-        cur = _normalize_currency(currency)
-        # сохраняем id строки и сумму — понадобится для reciprocal matching
-        by_currency[cur].append((ep_id, debtor_id, creditor_id, amount, expense_id))
+    transfers = []
+    for cur, bal in currency_balances(rows).items():
+        transfers.extend(settle_balances(bal, cur))
+
+    logger.debug('optimize_transfers -> %s', transfers)
+    return transfers
+
+
+def currency_balances(rows, use_numpy=None):
+    """Балансы в копейках: {валюта: {uid: копейки}}, валюты — в порядке первого появления в rows.
+
+    Пользователи с нулевым балансом могут отсутствовать. use_numpy=None — NumPy, если он установлен,
+    не отключён DEBTS_NUMPY=0 и строк не меньше NUMPY_MIN_ROWS.
+    """
+    if use_numpy is None:
+        use_numpy = np is not None and len(rows) >= NUMPY_MIN_ROWS and os.environ.get('DEBTS_NUMPY') != '0'
+    return _balances_numpy(rows) if use_numpy else _balances_python(rows)
+
+
+def _balances_python(rows):
+    balances = {}
+    for _, debtor, creditor, amount, currency, _ in rows:
+        bal = balances.setdefault(_normalize_currency(currency), defaultdict(int))
+        if debtor == creditor:
+            continue
+        cents = _to_cents(amount)
+        bal[debtor] -= cents
+        bal[creditor] += cents
+    return balances
+
+
+def _balances_numpy(rows):
+    n = len(rows)
+    if n == 0:
+        return {}
+    # коды валют: сырое значение -> код нормализованной валюты; коды — в порядке первого появления,
+    # dict.fromkeys и map работают на уровне C, без цикла Python по строкам
+    currency_codes = {}
+    raw_codes = {}
+    for raw in dict.fromkeys(map(itemgetter(4), rows)):
+        raw_codes[raw] = currency_codes.setdefault(_normalize_currency(raw), len(currency_codes))
+
+    debtors = np.fromiter(map(itemgetter(1), rows), dtype=np.int64, count=n)
+    creditors = np.fromiter(map(itemgetter(2), rows), dtype=np.int64, count=n)
+    # как _to_cents: float(x) * 100 и округление половины к чётному (round и np.rint совпадают)
+    cents = np.rint(np.fromiter(map(itemgetter(3), rows), dtype=np.float64, count=n) * 100).astype(np.int64)
+    currencies = np.fromiter(map(raw_codes.__getitem__, map(itemgetter(4), rows)), dtype=np.int64, count=n)
+
+    uids, inverse = np.unique(np.concatenate([debtors, creditors]), return_inverse=True)
+    users = len(uids)
+    mask = debtors != creditors
+    debtor_keys = currencies[mask] * users + inverse[:n][mask]
+    creditor_keys = currencies[mask] * users + inverse[n:][mask]
+    cents = cents[mask]
+
+    # целочисленный np.add.at точен при любых суммах (bincount с весами считал бы во float64)
+    flat = np.zeros(len(currency_codes) * users, dtype=np.int64)
+    np.add.at(flat, debtor_keys, -cents)
+    np.add.at(flat, creditor_keys, cents)
+    flat = flat.reshape(len(currency_codes), users)
+
+    balances = {}
+    for cur, k in currency_codes.items():
+        nonzero = np.flatnonzero(flat[k])
+        balances[cur] = dict(zip(uids[nonzero].tolist(), flat[k][nonzero].tolist()))
+    return balances
+
+
+def settle_balances(bal, cur):
+    """Жадно сопоставляет должников и кредиторов: bal — {uid: копейки} одной валюты, возвращает переводы."""
+    # отдельные списки должников и кредиторов (id, cents)
+    debtors = [(uid, -amt) for uid, amt in bal.items() if amt < 0]
+    creditors = [(uid, amt) for uid, amt in bal.items() if amt > 0]
+
+    # сортировка не обязательна, но стабилизирует результат
+    debtors.sort(key=lambda x: x[0])
+    creditors.sort(key=lambda x: x[0])
+
+    transfers = []
+    i = 0
+    j = 0
+    while i < len(debtors) and j < len(creditors):
+        deb_id, deb_amt = debtors[i]
+        cred_id, cred_amt = creditors[j]
+        take = min(deb_amt, cred_amt)
+        if take > 0:
+            transfers.append((deb_id, cred_id, _from_cents(take), cur))
+            deb_amt -= take
+            cred_amt -= take
+            # обновим
+            debtors[i] = (deb_id, deb_amt)
+            creditors[j] = (cred_id, cred_amt)
+        if debtors[i][1] == 0:
+            i += 1
+        if j < len(creditors) and creditors[j][1] == 0:
+            j += 1
+    return transfers
+
 
+def compute_net_transfers(totals):
+    """План переводов по суммам долгов между парами: totals — (debtor_id, creditor_id, amount, currency).
+
+    В отличие от compute_transfers не нужны отдельные строки долей (память — по числу пар, а не долей),
+    но и взаимозачёт без чистых переводов не строится: это план для показа/выгрузки, а не для пометки оплат.
+    """
+    balances = defaultdict(lambda: defaultdict(int))
+    for debtor, creditor, amount, currency in totals:
+        if debtor == creditor:
+            continue
+        bal = balances[_normalize_currency(currency)]
+        cents = _to_cents(amount)
+        bal[debtor] -= cents
+        bal[creditor] += cents
     transfers = []
-    for cur, recs in by_currency.items():
-        # баланс в копейках
-        bal = defaultdict(int)
-        for rec in recs:
-            # rec: (ep_id, debtor, creditor, amount, expense_id)
-            _, debtor, creditor, amount, _ = rec
-            cents = _to_cents(amount)
-            if debtor == creditor:
+    for cur, bal in balances.items():
+        transfers.extend(settle_balances(bal, cur))
+    return transfers
+
+
+# =========================
+# DIRECT SETTLEMENT
+# =========================
+
+def pair_debts(rows):
+    """Строки долей по парам: {валюта: {(debtor, creditor): [строки rows]}}, валюты — в порядке появления."""
+    pairs = {}
+    for row in rows:
+        _, debtor, creditor, _, currency, _ = row
+        if debtor == creditor:
+            continue
+        pairs.setdefault(_normalize_currency(currency), defaultdict(list))[(debtor, creditor)].append(row)
+    return pairs
+
+
+def min_cost_flow(capacities, supply):
+    """Потоки минимальной стоимости в копейках: {(u, v): копейки}.
+
+    capacities — {(u, v): копейки}, рёбра со стоимостью 1 за копейку; supply — {uid: копейки}:
+    > 0 — сколько узел должен отдать, < 0 — получить (сумма — 0). Последовательные кратчайшие пути
+    (Дейкстра с потенциалами) от фиктивного источника к фиктивному стоку.
+    """
+    nodes = sorted({u for edge in capacities for u in edge} | set(supply))
+    index = {uid: i for i, uid in enumerate(nodes)}
+    source, sink = len(nodes), len(nodes) + 1
+    graph = [[] for _ in range(len(nodes) + 2)]  # ребро: [куда, остаток, стоимость, индекс обратного]
+
+    def add_edge(u, v, cap, cost):
+        graph[u].append([v, cap, cost, len(graph[v])])
+        graph[v].append([u, 0, -cost, len(graph[u]) - 1])
+        return graph[u][-1]
+
+    edges = {(u, v): (add_edge(index[u], index[v], cap, 1), cap) for (u, v), cap in sorted(capacities.items())}
+    need = 0
+    for uid, amount in sorted(supply.items()):
+        if amount > 0:
+            add_edge(source, index[uid], amount, 0)
+            need += amount
+        elif amount < 0:
+            add_edge(index[uid], sink, -amount, 0)
+
+    potential = [0] * len(graph)
+    while need > 0:
+        dist = [None] * len(graph)
+        prev = [None] * len(graph)
+        dist[source] = 0
+        heap = [(0, source)]
+        while heap:
+            d, u = heapq.heappop(heap)
+            if d > dist[u]:
                 continue
-            bal[debtor] -= cents
-            bal[creditor] += cents
-
-        # отдельные списки должников и кредиторов (id, cents)
-        debtors = [(uid, -amt) for uid, amt in bal.items() if amt < 0]
-        creditors = [(uid, amt) for uid, amt in bal.items() if amt > 0]
-
-        # сортировка не обязательна, но стабилизирует результат
-        debtors.sort(key=lambda x: x[0])
-        creditors.sort(key=lambda x: x[0])
-
-        i = 0
-        j = 0
-        while i < len(debtors) and j < len(creditors):
-            deb_id, deb_amt = debtors[i]
-            cred_id, cred_amt = creditors[j]
-            take = min(deb_amt, cred_amt)
-            if take > 0:
-                transfers.append((deb_id, cred_id, _from_cents(take), cur))
-                deb_amt -= take
-                cred_amt -= take
-                # обновим
-                debtors[i] = (deb_id, deb_amt)
-                creditors[j] = (cred_id, cred_amt)
-            if debtors[i][1] == 0:
-                i += 1
-            if j < len(creditors) and creditors[j][1] == 0:
-                j += 1
-
-    # Если нет чистых переводов (балансы по валюте компенсируются),
-    # попробуем найти взаимные непогашенные записи (A->B и B->A) и сформировать
-    # переводы для взаимного зачёта — это пометит соответствующие expense_participant как оплаченные.
-    if not transfers:
-        for cur, recs in by_currency.items():
-            # постоим словарь пар (debtor, creditor) -> список [ep_id, available_cents]
-            edges = defaultdict(list)
-            for ep_id, debtor, creditor, amount, expense_id in recs:
-                if debtor == creditor:
-                    continue
-                edges[(debtor, creditor)].append([ep_id, _to_cents(amount)])
-
-            # для каждой пары (u,v) и (v,u) попытаемся попарно сопоставить суммы
-            seen = set()
-            for (u, v) in list(edges.keys()):
-                if (u, v) in seen:
-                    continue
-                if (v, u) not in edges:
-                    continue
-                a_list = edges[(u, v)]
-                b_list = edges[(v, u)]
-                # индексы для прохода по спискам
-                ia = 0
-                ib = 0
-                while ia < len(a_list) and ib < len(b_list):
-                    a_id, a_amt = a_list[ia]
-                    b_id, b_amt = b_list[ib]
-                    take = min(a_amt, b_amt)
-                    if take > 0:
-                        # создаём два зеркальных перевода — один для списания долга u->v, и один v->u
-                        transfers.append((u, v, _from_cents(take), cur))
-                        transfers.append((v, u, _from_cents(take), cur))
-                        a_list[ia][1] -= take
-                        b_list[ib][1] -= take
-                    if a_list[ia][1] == 0:
-                        ia += 1
-                    if b_list[ib][1] == 0:
-                        ib += 1
-                seen.add((u, v))
-                seen.add((v, u))
-
-    if os.environ.get('DEBTS_DEBUG'):
-        print('optimize_transfers ->', transfers)
+            for i, (v, cap, cost, _) in enumerate(graph[u]):
+                nd = d + cost + potential[u] - potential[v]
+                if cap > 0 and (dist[v] is None or nd < dist[v]):
+                    dist[v] = nd
+                    prev[v] = (u, i)
+                    heapq.heappush(heap, (nd, v))
+        if dist[sink] is None:
+            raise Exception(f'Не удалось распределить долги по существующим парам: осталось {_from_cents(need)}')
+        for v, d in enumerate(dist):
+            if d is not None:
+                potential[v] += d
+
+        push = need
+        v = sink
+        while v != source:
+            u, i = prev[v]
+            push = min(push, graph[u][i][1])
+            v = u
+        v = sink
+        while v != source:
+            u, i = prev[v]
+            edge = graph[u][i]
+            edge[1] -= push
+            graph[v][edge[3]][1] += push
+            v = u
+        need -= push
+
+    return {pair: cap - edge[1] for pair, (edge, cap) in edges.items() if cap - edge[1] > 0}
+
+
+def _direct_flows(owed):
+    """owed — {(debtor, creditor): копейки} одной валюты -> (чистые долги пар, потоки min_cost_flow)."""
+    capacities = {}
+    supply = defaultdict(int)
+    for (debtor, creditor), cents in owed.items():
+        net = cents - owed.get((creditor, debtor), 0)
+        if net > 0:
+            capacities[(debtor, creditor)] = net
+            supply[debtor] += net
+            supply[creditor] -= net
+    return capacities, min_cost_flow(capacities, supply)
+
+
+def compute_direct_transfers(totals):
+    """План режима direct по суммам долгов между парами, как compute_net_transfers: (from_id, to_id, amount, currency).
+
+    Для показа плана; взаимозачёты (пары без перевода) сюда не попадают.
+    """
+    owed = {}
+    for debtor, creditor, amount, currency in totals:
+        if debtor == creditor:
+            continue
+        by_pair = owed.setdefault(_normalize_currency(currency), defaultdict(int))
+        by_pair[(debtor, creditor)] += _to_cents(amount)
+    transfers = []
+    for cur, by_pair in owed.items():
+        _, flows = _direct_flows(by_pair)
+        transfers.extend((frm, to, _from_cents(cents), cur) for (frm, to), cents in sorted(flows.items()))
     return transfers
 
 
-def optimize_transfers_with_allocations(db_path='expenses.db'):
+@metrics.timed('optimizer_stage_seconds', stage='compute_direct_settlement')
+def compute_direct_settlement(rows):
+    """Расчёт только по существующим парам должник -> кредитор (режим direct).
+
+    Возвращает список dict как compute_allocations: {from, to, amount, currency, allocs}; на каждую пару
+    с долгами — одна запись, allocs гасят все строки пары в обе стороны. amount = 0 — пара закрывается
+    взаимозачётом без перевода (встречные долги или цикл).
+    """
+    detailed = []
+    for cur, pairs in pair_debts(rows).items():
+        owed = {pair: sum(_to_cents(r[3]) for r in recs) for pair, recs in pairs.items()}
+        capacities, flows = _direct_flows(owed)
+        for u, v in sorted({tuple(sorted(pair)) for pair in pairs}):
+            frm, to = (v, u) if flows.get((v, u)) or capacities.get((v, u)) else (u, v)
+            recs = sorted(pairs.get((frm, to), []) + pairs.get((to, frm), []), key=lambda r: r[0])
+            detailed.append({
+                'from': frm, 'to': to, 'amount': _from_cents(flows.get((frm, to), 0)), 'currency': cur,
+                'allocs': [(ep_id, float(amount), expense_id, float(amount))
+                           for ep_id, _, _, amount, _, expense_id in recs],
+            })
+
+    logger.debug('compute_direct_settlement -> %s', detailed)
+    return detailed
+
+
+@metrics.timed('optimizer_stage_seconds', stage='compute_allocations')
+def compute_allocations(transfers, rows):
     """Возвращает список dict: {from, to, amount, currency, allocs}
     allocs = [(ep_id, used_amount, expense_id, original_amount), ...]
+
+    Строки должника берутся из тех же rows, что и для compute_transfers, в порядке возрастания ep_id.
     """
-    transfers = optimize_transfers(db_path)
     if not transfers:
         return []
 
@@ -156,117 +367,236 @@ def optimize_transfers_with_allocations(db_path='expenses.db'):
     for frm, to, amt, cur in transfers:
         agg[(frm, to, _normalize_currency(cur))] += _to_cents(amt)
 
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    # свободные записи должника по (user_id, currency): list of [ep_id, available_cents, expense_id, original_amount]
+    debtor_rows = defaultdict(list)
+    for ep_id, debtor_id, creditor_id, amount, currency, expense_id in sorted(rows, key=lambda r: r[0]):
+        debtor_rows[(debtor_id, _normalize_currency(currency))].append([ep_id, _to_cents(amount), expense_id, float(amount)])
 
     detailed = []
-    # кеш свободных записей должника по (user_id, currency): list of [ep_id, available_cents, expense_id, original_amount]
-    debtor_cache = {}
+    # позиция в списке строк должника — следующие переводы того же должника продолжают с неё
+    positions = defaultdict(int)
 
     for (frm, to, cur), total_cents in agg.items():
         remaining = total_cents
         allocs = []
         cache_key = (frm, cur)
-        if cache_key not in debtor_cache:
-            cursor.execute('''
-                SELECT ep.id, ep.amount, ep.expense_id
-                FROM expense_participant ep
-                JOIN expense e ON ep.expense_id = e.id
-                WHERE ep.is_paid = 0 AND ep.user_id = ? AND COALESCE(UPPER(TRIM(e.currency)), 'RUB') = ?
-                ORDER BY ep.id ASC
-            ''', (frm, cur))
-            rows = cursor.fetchall()
-            # представим в копейках
-            debtor_cache[cache_key] = [[r[0], _to_cents(r[1]), r[2], float(r[1])] for r in rows]
-
-        rows = debtor_cache[cache_key]
-        idx = 0
-        while remaining > 0 and idx < len(rows):
-            ep_id, avail, expense_id, orig = rows[idx]
+        recs = debtor_rows.get(cache_key, [])
+        idx = positions[cache_key]
+        while remaining > 0 and idx < len(recs):
+            ep_id, avail, expense_id, orig = recs[idx]
             if avail <= 0:
                 idx += 1
                 continue
             take = min(avail, remaining)
-            if take <= 0:
-                idx += 1
-                continue
             allocs.append((ep_id, _from_cents(take), expense_id, orig))
             remaining -= take
-            rows[idx][1] = avail - take
-            if rows[idx][1] <= 0:
+            recs[idx][1] = avail - take
+            if recs[idx][1] <= 0:
                 idx += 1
+        positions[cache_key] = idx
 
         if remaining > 0:
-            conn.close()
             raise Exception(f"Не удалось собрать сумму {frm}->{to} { _from_cents(total_cents) } {cur}: осталось {_from_cents(remaining)}")
 
         detailed.append({'from': frm, 'to': to, 'amount': _from_cents(total_cents), 'currency': cur, 'allocs': allocs})
 
-    if os.environ.get('DEBTS_DEBUG'):
-        print('optimize_transfers_with_allocations ->', detailed)
+    logger.debug('optimize_transfers_with_allocations -> %s', detailed)
 
-    conn.close()
     return detailed
 
 
-def mark_allocations_paid(db_path, transfers_with_allocs):
-    """Применяет аллокации атомарно.
+@metrics.timed('optimizer_stage_seconds', stage='plan_allocation_updates')
+def plan_allocation_updates(current, transfers_with_allocs):
+    """Переводит аллокации в набор изменений expense_participant.
 
+    current — {ep_id: (amount, is_paid, user_id)} для всех задействованных строк.
     Для каждой аллокации (ep_id, used, expense_id, original_amount):
       - проверяем, что запись существует, is_paid = 0 и в ней достаточно amount
-      - если used >= cur_amount - 1 копейка: помечаем запись is_paid = 1
-      - иначе: уменьшаем текущую запись на used (UPDATE amount = remaining) и вставляем новую запись с is_paid=1 на used
+      - если used >= cur_amount: помечаем запись is_paid = 1
+      - иначе: уменьшаем текущую запись на used и добавляем новую запись с is_paid=1 на used
+    Возвращает (updates, inserts):
+      updates = [(amount, is_paid, ep_id), ...] — итоговое состояние каждой затронутой строки
+      inserts = [(expense_id, user_id, amount), ...] — новые оплаченные записи
     """
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    try:
-        conn.execute('BEGIN IMMEDIATE')
-        for t in transfers_with_allocs:
-            allocs = t.get('allocs', [])
-            for ep_id, used_amount, expense_id, original in allocs:
-                used_cents = _to_cents(used_amount)
-                cursor.execute('SELECT amount, is_paid, user_id FROM expense_participant WHERE id = ?', (ep_id,))
-                row = cursor.fetchone()
+    state = {}
+    inserts = []
+    for t in transfers_with_allocs:
+        allocs = t.get('allocs', [])
+        for ep_id, used_amount, expense_id, original in allocs:
+            used_cents = _to_cents(used_amount)
+            if ep_id not in state:
+                row = current.get(ep_id)
                 if not row:
                     raise Exception(f'Запись expense_participant id={ep_id} не найдена')
                 cur_amount, cur_is_paid, cur_user_id = row
-                cur_cents = _to_cents(cur_amount)
-                if cur_is_paid:
-                    raise Exception(f'Запись expense_participant id={ep_id} уже помечена как оплаченная')
-                if cur_cents < used_cents:
-                    raise Exception(f'Недостаточно средств в записи id={ep_id}: доступно {_from_cents(cur_cents)}, требуется {_from_cents(used_cents)}')
-
-                # полное списание
-                if used_cents >= cur_cents:
-                    # помечаем как оплачено
-                    cursor.execute('UPDATE expense_participant SET is_paid = 1 WHERE id = ?', (ep_id,))
-                else:
-                    # частичное списание: уменьшаем существующую запись и создаём новую помеченную
-                    remaining_cents = cur_cents - used_cents
-                    cursor.execute('UPDATE expense_participant SET amount = ? WHERE id = ?', (_from_cents(remaining_cents), ep_id))
-                    cursor.execute('INSERT INTO expense_participant (expense_id, user_id, amount, is_paid) VALUES (?, ?, ?, ?)',
-                                   (expense_id, cur_user_id, _from_cents(used_cents), 1))
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        print('mark_allocations_paid error:', e)
-        raise
-    finally:
-        conn.close()
+                state[ep_id] = [_to_cents(cur_amount), bool(cur_is_paid), cur_user_id]
+            cur_cents, cur_is_paid, cur_user_id = state[ep_id]
+            if cur_is_paid:
+                raise Exception(f'Запись expense_participant id={ep_id} уже помечена как оплаченная')
+            if cur_cents < used_cents:
+                raise Exception(f'Недостаточно средств в записи id={ep_id}: доступно {_from_cents(cur_cents)}, требуется {_from_cents(used_cents)}')
+
+            # полное списание
+            if used_cents >= cur_cents:
+                state[ep_id][1] = True
+            else:
+                # частичное списание: уменьшаем существующую запись и создаём новую помеченную
+                state[ep_id][0] = cur_cents - used_cents
+                inserts.append((expense_id, cur_user_id, _from_cents(used_cents)))
+
+    updates = [(_from_cents(cents), is_paid, ep_id) for ep_id, (cents, is_paid, _) in sorted(state.items())]
+    return updates, inserts
+
+
+async def optimize_transfers(ledger):
+    """Возвращает список кортежей (from_id, to_id, amount, currency) по всем непогашенным долгам."""
+    with metrics.timer('optimizer_stage_seconds', stage='fetch_rows'):
+        rows = await ledger.get_unpaid_rows()
+    return await asyncio.to_thread(compute_transfers, rows)
+
+
+async def optimize_transfers_with_allocations(ledger, mode='net', event_id=None):
+    """Возвращает список dict: {from, to, amount, currency, allocs}, читая строки один раз.
+
+    mode — 'net' или 'direct' (см. SETTLEMENT_MODES). Записи с amount = 0 — взаимозачёт без перевода:
+    их allocs тоже нужно применить, но показывать в плане нечего. event_id — только долги этого мероприятия.
+    """
+    if mode not in SETTLEMENT_MODES:
+        raise ValueError(f'Неизвестный режим расчёта: {mode}')
+    with metrics.timer('optimizer_stage_seconds', stage='fetch_rows'):
+        rows = await ledger.get_unpaid_rows(event_id)
+    return await asyncio.to_thread(plan_settlement, rows, mode)
 
 
-def mark_all_unpaid_as_paid(db_path='expense.db'):
-    conn = sqlite3.connect(db_path)
-    cur = conn.cursor()
-    cur.execute('UPDATE expense_participant SET is_paid = 1 WHERE is_paid = 0')
-    conn.commit()
-    conn.close()
+def plan_settlement(rows, mode='net'):
+    """План с аллокациями по строкам get_unpaid_rows: [{from, to, amount, currency, allocs}]."""
+    if mode == 'direct':
+        return compute_direct_settlement(rows)
+    transfers = compute_transfers(rows)
+    # валюты без чистых переводов: долги только взаимные или по кругу — закрываются взаимозачётом
+    netted = {cur for _, _, _, cur in transfers}
+    balanced = [r for r in rows if _normalize_currency(r[4]) not in netted]
+    return compute_allocations(transfers, rows) + compute_direct_settlement(balanced)
 
 
-def get_all_users(db_path='expenses.db'):
-    conn = sqlite3.connect(db_path)
-    cur = conn.cursor()
-    cur.execute('SELECT id, name, payment_credentials FROM user')
-    rows = cur.fetchall()
-    conn.close()
-    return [(r[0], r[1], r[2]) for r in rows]
+async def mark_allocations_paid(ledger, transfers_with_allocs, run_id=None):
+    """Применяет аллокации атомарно (см. plan_allocation_updates); run_id — запуск в журнале расчётов."""
+    await ledger.apply_allocations(transfers_with_allocs, run_id)
+
+
+async def mark_all_unpaid_as_paid(ledger):
+    await ledger.mark_all_paid()
+
+
+async def get_all_users(users):
+    return await users.get_all()
+
+
+# =========================
+# CLI
+# =========================
+
+def _json_record(event_id, mode, dry_run, transfers):
+    return {
+        'event_id': event_id,
+        'strategy': mode,
+        'dry_run': dry_run,
+        'applied': bool(transfers) and not dry_run,
+        'transfers': [{
+            'from': t['from'], 'to': t['to'], 'amount': t['amount'], 'currency': t['currency'],
+            'allocs': [{'ep_id': ep_id, 'amount': used, 'expense_id': expense_id, 'share': original}
+                       for ep_id, used, expense_id, original in t['allocs']],
+        } for t in transfers],
+    }
+
+
+def _text_record(record, names):
+    payments = [t for t in record['transfers'] if t['amount'] > 0]
+    offsets = len(record['transfers']) - len(payments)
+    state = ('без изменений (--dry-run)' if record['dry_run']
+             else 'доли помечены оплаченными' if record['applied'] else 'долгов нет')
+    lines = [f"Мероприятие {record['event_id']} ({record['strategy']}): переводов {len(payments)}, "
+             f"взаимозачётов {offsets}; {state}"]
+    for t in payments:
+        lines.append(f"  {names.get(t['from'], t['from'])} -> {names.get(t['to'], t['to'])}: "
+                     f"{t['amount']:.2f} {t['currency']}")
+    return '\n'.join(lines)
+
+
+async def settle_events(storage, event_ids, mode='net', dry_run=False):
+    """Асинхронный генератор: по каждому мероприятию план с аллокациями и, без dry_run, пометка долей оплаченными.
+
+    Выдаёт (event_id, transfers, error); ошибка одного мероприятия не останавливает остальные.
+    """
+    for event_id in event_ids:
+        run_id = None
+        try:
+            transfers = await optimize_transfers_with_allocations(storage.ledger, mode, event_id)
+            if transfers and not dry_run:
+                run_id = await storage.ledger.journal_planned(mode, transfers, event_id, source='cli')
+                await mark_allocations_paid(storage.ledger, transfers, run_id)
+        except Exception as e:
+            logger.exception('Мероприятие %s: ошибка расчёта: %s', event_id, e)
+            if run_id is not None:
+                await storage.ledger.journal_append(run_id, journal.FAILED, detail=str(e))
+            yield event_id, [], e
+            continue
+        yield event_id, transfers, None
+
+
+async def _run(args):
+    import storage  # storage сам импортирует этот модуль
+
+    # --dry-run только читает: база открывается только для чтения и не мигрирует (init_schema включил бы WAL,
+    # создал бы таблицы и триггеры и мог бы перестроить сводки)
+    if args.postgres:
+        st = storage.PostgresStorage(args.postgres, min_size=1, max_size=1, read_only=args.dry_run)
+    elif os.path.exists(args.db):
+        st = storage.SqliteStorage(args.db, shared_connection=True, read_only=args.dry_run)
+    else:
+        raise SystemExit(f'Файл базы не найден: {args.db}')
+    await st.connect()
+    try:
+        if args.dry_run:
+            missing = await st.missing_tables()
+            if missing:
+                raise SystemExit(f'В базе нет таблиц {", ".join(missing)}: запустите бота или расчёт без --dry-run, '
+                                 f'чтобы создать схему')
+        else:
+            await st.init_schema()
+        event_ids = args.event or await st.ledger.get_unpaid_event_ids()
+        names = {} if args.json else {uid: name for uid, name, _ in await st.users.get_all()}
+        failed = 0
+        async for event_id, transfers, error in settle_events(st, event_ids, args.strategy, args.dry_run):
+            if error is not None:
+                failed += 1
+                record = {'event_id': event_id, 'strategy': args.strategy, 'error': str(error)}
+                print(json.dumps(record, ensure_ascii=False) if args.json else f'Мероприятие {event_id}: ошибка: {error}')
+                continue
+            record = _json_record(event_id, args.strategy, args.dry_run, transfers)
+            print(json.dumps(record, ensure_ascii=False) if args.json else _text_record(record, names))
+        return 1 if failed else 0
+    finally:
+        await st.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m debts_optimizer', description='Пакетный расчёт переводов по долгам')
+    parser.add_argument('--db', default='expenses.db', help='файл базы SQLite')
+    parser.add_argument('--postgres', metavar='DSN', help='PostgreSQL вместо SQLite')
+    parser.add_argument('--event', type=int, action='append', help='id мероприятия; можно указать несколько раз')
+    parser.add_argument('--all-events', action='store_true', help='все мероприятия с неоплаченными долями')
+    parser.add_argument('--strategy', choices=SETTLEMENT_MODES, default='net', help='режим расчёта (см. SETTLEMENT_MODES)')
+    parser.add_argument('--dry-run', action='store_true', help='только показать план, доли не помечать')
+    parser.add_argument('--json', action='store_true', help='JSON-строка на мероприятие с переводами и аллокациями')
+    parser.add_argument('--verbose', action='store_true', help='подробный лог в stderr')
+    args = parser.parse_args(argv)
+    if bool(args.event) == args.all_events:
+        parser.error('укажите --event ID (можно несколько) или --all-events')
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING, stream=sys.stderr,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    return asyncio.run(_run(args))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,240 @@
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+
+# Диагностика "бот завис" в продакшене.
+# 1) Журнал медленных запросов: каждый SQL-запрос дольше порога пишется в лог (логгер 'slow_query')
+#    с текстом, формой параметров (количество и типы, без значений), длительностью и планом
+#    (EXPLAIN QUERY PLAN для SQLite). Последние записи хранятся в SLOW_QUERIES для команды /slow_queries.
+#    Порог задаётся в config.py: SLOW_QUERY_MS = 200 (None — журнал выключен).
+#    Для SQLite замеряется cursor.execute: для агрегирующих запросов бота это почти всё время запроса,
+#    дочитывание строк (fetchall) не учитывается. Для PostgreSQL используется query logger asyncpg (>= 0.29).
+# 2) Профилирование по требованию: /profile N (только ADMIN_IDS из config.py) на N секунд запускает
+#    статистический профайлер — поток, который каждые несколько миллисекунд снимает стеки всех потоков процесса:
+#    основного (цикл событий, обработчики) и рабочих asyncio.to_thread (запросы SQLite, расчёт планов /optimize).
+#    Результат пишется в profiles/ в формате "folded stacks" (строка "поток;f1;f2;f3 <число сэмплов>",
+#    первым элементом — имя потока), который понимают flamegraph.pl и speedscope.
+#    Распознавание чеков идёт в процессах пула OCR и в профиль не попадает — для него есть bench_ocr.py;
+#    в профиле основного потока видно только ожидание результата пула.
+
+logger = logging.getLogger('slow_query')
+
+SLOW_QUERIES = deque(maxlen=50)
+PROFILE_DIR = 'profiles'
+
+_slow_query_seconds = None
+
+
+def configure(slow_query_ms=None):
+    global _slow_query_seconds
+    _slow_query_seconds = slow_query_ms / 1000.0 if slow_query_ms is not None else None
+
+
+def slow_query_enabled():
+    return _slow_query_seconds is not None
+
+
+# =========================
+# SLOW QUERY LOG
+# =========================
+
+def _normalize_sql(sql):
+    return re.sub(r'\s+', ' ', sql).strip()
+
+
+def params_shape(params):
+    """Форма параметров без значений: '(int, str, float)', '{user_id: int}' или 'executemany x120 (int, float)'."""
+    if params is None:
+        return '()'
+    if isinstance(params, dict):
+        return '{' + ', '.join(f'{k}: {type(v).__name__}' for k, v in params.items()) + '}'
+    return '(' + ', '.join(type(v).__name__ for v in params) + ')'
+
+
+def record_slow_query(sql, params, seconds, plan=None):
+    entry = {
+        'time': datetime.now(),
+        'sql': _normalize_sql(sql),
+        'params': params,
+        'seconds': seconds,
+        'plan': plan or [],
+    }
+    SLOW_QUERIES.append(entry)
+    logger.warning(
+        'Медленный запрос %.1f мс: %s params=%s plan=%s',
+        seconds * 1000, entry['sql'], params, ' | '.join(entry['plan']) or '-'
+    )
+    return entry
+
+
+def _explain(conn, sql, params):
+    """EXPLAIN QUERY PLAN тем же соединением; сам запрос при этом не выполняется."""
+    try:
+        # обычный курсор, чтобы сам EXPLAIN не попадал в журнал
+        cursor = sqlite3.Connection.cursor(conn, sqlite3.Cursor)
+        return [row[-1] for row in cursor.execute('EXPLAIN QUERY PLAN ' + sql, params or ()).fetchall()]
+    except sqlite3.Error as e:
+        return [f'нет плана: {e}']
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    def execute(self, sql, params=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            seconds = time.perf_counter() - started
+            if _slow_query_seconds is not None and seconds >= _slow_query_seconds:
+                record_slow_query(sql, params_shape(params), seconds, _explain(self.connection, sql, params))
+
+    def executemany(self, sql, seq_of_params):
+        if _slow_query_seconds is None:
+            return super().executemany(sql, seq_of_params)
+        # для журнала нужны только число наборов параметров и первый из них: вход не копируется в список
+        count = 0
+        first = None
+
+        def counted():
+            nonlocal count, first
+            for params in seq_of_params:
+                if count == 0:
+                    first = params
+                count += 1
+                yield params
+
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, counted())
+        finally:
+            seconds = time.perf_counter() - started
+            if seconds >= _slow_query_seconds:
+                shape = f'executemany x{count} ' + (params_shape(first) if count else '()')
+                plan = _explain(self.connection, sql, first) if count else []
+                record_slow_query(sql, shape, seconds, plan)
+
+
+class ProfiledConnection(sqlite3.Connection):
+    """sqlite3.connect(path, factory=ProfiledConnection): все курсоры соединения пишут журнал медленных запросов."""
+
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+
+def asyncpg_query_logger(record):
+    """Колбэк для asyncpg Connection.add_query_logger: record — LoggedQuery(query, args, elapsed, ...)."""
+    if _slow_query_seconds is not None and record.elapsed >= _slow_query_seconds:
+        record_slow_query(record.query, params_shape(record.args), record.elapsed)
+
+
+def format_slow_queries(limit=10):
+    if not SLOW_QUERIES:
+        return 'Медленных запросов не было'
+    lines = []
+    for entry in list(SLOW_QUERIES)[-limit:]:
+        text = (
+            f"{entry['time']:%d.%m %H:%M:%S} — {entry['seconds'] * 1000:.1f} мс\n"
+            f"{entry['sql'][:300]}\nпараметры: {entry['params']}"
+        )
+        if entry['plan']:
+            text += '\nплан: ' + ' | '.join(entry['plan'])
+        lines.append(text)
+    return '\n\n'.join(lines)
+
+
+# =========================
+# SAMPLING PROFILER
+# =========================
+
+class StackSampler:
+    """Статистический профайлер: раз в interval секунд снимает стеки всех потоков (или только thread_ids).
+
+    samples — число снимков; стеки считаются по каждому потоку, поэтому в stacks их может быть больше.
+    """
+
+    def __init__(self, thread_ids=None, interval=0.005):
+        self.thread_ids = thread_ids
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _folded(frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own or (self.thread_ids is not None and thread_id not in self.thread_ids):
+                    continue
+                self.stacks[f'{names.get(thread_id, thread_id)};{self._folded(frame)}'] += 1
+            self.samples += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self.stacks
+
+    def write_folded(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+    def top_functions(self, limit=10):
+        """(поток, функция), чаще всего бывшие на вершине стека (собственное время)."""
+        own = Counter()
+        for stack, count in self.stacks.items():
+            thread, _, rest = stack.partition(';')
+            own[(thread, rest.rsplit(';', 1)[-1])] += count
+        return own.most_common(limit)
+
+
+_active_sampler = None
+
+
+def start_profiling(thread_ids=None, interval=0.005):
+    """Запускает профайлер всех потоков (или только thread_ids); ValueError, если он уже запущен."""
+    global _active_sampler
+    if _active_sampler is not None:
+        raise ValueError('Профилирование уже идёт')
+    _active_sampler = StackSampler(thread_ids, interval)
+    _active_sampler.start()
+    return _active_sampler
+
+
+def stop_profiling(directory=PROFILE_DIR):
+    """Останавливает профайлер и пишет профиль в directory; возвращает (путь, sampler)."""
+    global _active_sampler
+    sampler, _active_sampler = _active_sampler, None
+    if sampler is None:
+        raise ValueError('Профилирование не запущено')
+    sampler.stop()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'profile-{datetime.now():%Y%m%d-%H%M%S}.folded')
+    sampler.write_folded(path)
+    return path, sampler
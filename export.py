@@ -0,0 +1,108 @@
+import asyncio
+import codecs
+import csv
+import io
+import json
+import tempfile
+
+import debts_optimizer
+from storage import DEFAULT_EVENT_ID
+
+# Выгрузка мероприятия (/export): все платежи с долями и статусом оплаты плюс текущий план переводов.
+# Строки идут конвейером генераторов: курсор хранилища (ExpenseRepository.iter_export_rows, пачками)
+# -> записи-словари -> строки CSV/JSON -> байты во временный буфер. В памяти одновременно только
+# одна пачка строк; буфер (SpooledTemporaryFile) до SPOOL_MAX_SIZE живёт в памяти, дальше — на диске.
+# Форматы:
+#   csv   — два файла: expenses.csv (строка на долю; платёж без долей — одна строка с пустым участником)
+#           и transfers.csv (план переводов); UTF-8 с BOM, чтобы Excel открывал кириллицу
+#   jsonl — один файл export.jsonl, у каждой записи поле "type": "share" или "transfer"
+
+SPOOL_MAX_SIZE = 1024 * 1024
+
+SHARE_FIELDS = [
+    'expense_id', 'date', 'name', 'category', 'currency', 'amount', 'payer_id', 'payer',
+    'participant_id', 'participant', 'share', 'is_paid',
+]
+TRANSFER_FIELDS = ['from_id', 'from', 'to_id', 'to', 'amount', 'currency']
+FORMATS = ('csv', 'jsonl')
+
+
+async def iter_share_records(expenses, event_id=DEFAULT_EVENT_ID):
+    async for row in expenses.iter_export_rows(event_id):
+        yield dict(zip(SHARE_FIELDS, row))
+
+
+async def iter_transfer_records(ledger, users):
+    """План переводов по непогашенным долгам (как в /optimize, но без пометки долей оплаченными).
+
+    Считается по суммам долгов между парами, поэтому не зависит от числа долей в истории.
+    """
+    transfers = await asyncio.to_thread(debts_optimizer.compute_net_transfers, await ledger.get_unpaid_totals())
+    names = {uid: name for uid, name, _ in await users.get_all()} if transfers else {}
+    for frm, to, amount, currency in transfers:
+        yield {
+            'from_id': frm, 'from': names.get(frm, str(frm)),
+            'to_id': to, 'to': names.get(to, str(to)),
+            'amount': amount, 'currency': currency,
+        }
+
+
+async def write_csv(records, fields, buffer):
+    """Пишет записи в бинарный buffer построчно; возвращает число записей."""
+    line = io.StringIO()
+    writer = csv.DictWriter(line, fieldnames=fields)
+    buffer.write(codecs.BOM_UTF8)
+    writer.writeheader()
+    count = 0
+    async for record in records:
+        writer.writerow(record)
+        count += 1
+        if line.tell() > 64 * 1024:
+            buffer.write(line.getvalue().encode('utf-8'))
+            line.seek(0)
+            line.truncate()
+    buffer.write(line.getvalue().encode('utf-8'))
+    return count
+
+
+async def write_jsonl(records, record_type, buffer):
+    count = 0
+    async for record in records:
+        buffer.write(json.dumps(dict(type=record_type, **record), ensure_ascii=False).encode('utf-8'))
+        buffer.write(b'\n')
+        count += 1
+    return count
+
+
+def _spooled():
+    return tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, mode='w+b')
+
+
+async def export_event(storage, fmt='csv', event_id=DEFAULT_EVENT_ID):
+    """Готовит выгрузку: [(имя файла, буфер с позицией в начале)], число записей о долях.
+
+    Буферы закрывает вызывающий код.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f'Неизвестный формат выгрузки: {fmt}')
+    files = []
+    try:
+        if fmt == 'csv':
+            expenses_buf = _spooled()
+            files.append(('expenses.csv', expenses_buf))
+            count = await write_csv(iter_share_records(storage.expenses, event_id), SHARE_FIELDS, expenses_buf)
+            transfers_buf = _spooled()
+            files.append(('transfers.csv', transfers_buf))
+            await write_csv(iter_transfer_records(storage.ledger, storage.users), TRANSFER_FIELDS, transfers_buf)
+        else:
+            buf = _spooled()
+            files.append(('export.jsonl', buf))
+            count = await write_jsonl(iter_share_records(storage.expenses, event_id), 'share', buf)
+            await write_jsonl(iter_transfer_records(storage.ledger, storage.users), 'transfer', buf)
+    except Exception:
+        for _, buf in files:
+            buf.close()
+        raise
+    for _, buf in files:
+        buf.seek(0)
+    return files, count
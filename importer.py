@@ -0,0 +1,288 @@
+import csv
+import io
+import re
+from datetime import datetime
+
+import debts_optimizer
+import shares
+import split
+from storage import DEFAULT_EVENT_ID
+
+# Импорт истории расходов (/import) из CSV-файла. Поддерживаются два формата, определяются по заголовку:
+#   native    — expenses.csv из /export: строка на долю, строки одного платежа идут подряд с одним expense_id;
+#               участники заданы Telegram id (payer_id, participant_id), статус оплаты сохраняется.
+#   splitwise — экспорт Splitwise: Date, Description, Category, Cost, Currency и по колонке на участника
+#               с его чистым итогом по расходу (+ ему должны, - он должен). Участники сопоставляются
+#               с пользователями бота по подписи к файлу ("Anna=@anna, Bob=@boris") или по совпадению имени.
+#               Расход Splitwise превращается в платежи кредиторов с долями должников (жадное сопоставление,
+#               debts_optimizer.settle_balances), поэтому сумма платежа — это сумма долгов, а не полная стоимость;
+#               балансы при этом совпадают со Splitwise.
+# Файл читается потоково, строки проверяются по одной; корректные платежи пишутся пачками по CHUNK_SIZE
+# через ExpenseRepository.create_many (одна транзакция и executemany на пачку). Отклонённые строки
+# возвращаются с номером и причиной. Повторный импорт того же файла создаст платежи заново.
+
+CHUNK_SIZE = 1000
+MAX_REJECTS_REPORTED = 20
+
+NATIVE_REQUIRED = {'expense_id', 'date', 'name', 'currency', 'amount', 'payer_id', 'payer'}
+SPLITWISE_FIXED = ['Date', 'Description', 'Category', 'Cost', 'Currency']
+SPLITWISE_TOTAL_ROW = 'total balance'
+
+_MAPPING_RE = re.compile(r'([^=,;\n]+?)\s*=\s*@?(\w+)')
+
+
+class ImportFormatError(ValueError):
+    pass
+
+
+class ImportResult:
+    def __init__(self):
+        self.payments = 0
+        self.shares = 0
+        self.rejected = []  # [(номер строки, причина)]
+
+    def reject(self, lines, reason):
+        for line in (lines if isinstance(lines, (list, tuple)) else [lines]):
+            self.rejected.append((line, reason))
+
+    def summary(self):
+        text = f'Импортировано платежей: {self.payments}, долей: {self.shares}'
+        if self.rejected:
+            text += f'\nОтклонено строк: {len(self.rejected)}'
+            for line, reason in self.rejected[:MAX_REJECTS_REPORTED]:
+                text += f'\n  строка {line}: {reason}'
+            if len(self.rejected) > MAX_REJECTS_REPORTED:
+                text += f'\n  ... и ещё {len(self.rejected) - MAX_REJECTS_REPORTED}'
+        return text
+
+
+def parse_mapping(text):
+    """'Anna=@anna, Bob = boris' -> {'anna': 'anna', 'bob': 'boris'} (имя в Splitwise -> username)."""
+    return {name.strip().lower(): username.lower() for name, username in _MAPPING_RE.findall(text or '')}
+
+
+def detect_format(header):
+    names = {h.strip() for h in header}
+    if NATIVE_REQUIRED <= names:
+        return 'native'
+    if header[:len(SPLITWISE_FIXED)] == SPLITWISE_FIXED and len(header) > len(SPLITWISE_FIXED):
+        return 'splitwise'
+    raise ImportFormatError(
+        'Не удалось определить формат: нужен expenses.csv из /export или экспорт Splitwise '
+        '(Date, Description, Category, Cost, Currency, участники...)'
+    )
+
+
+def _amount(value, what):
+    try:
+        amount = shares.parse_amount(value)
+    except ValueError:
+        raise ValueError(f'{what}: не число "{value}"')
+    return amount
+
+
+def _currency(value):
+    cur = (value or '').strip().upper() or 'RUB'
+    if not re.fullmatch(r'[A-Z]{3}', cur):
+        raise ValueError(f'некорректная валюта "{value}"')
+    return cur
+
+
+def _splitwise_date(value):
+    """Splitwise пишет дату как 2024-01-15; в боте paid_date — '15.01.2024 00:00'."""
+    try:
+        return datetime.strptime(value.strip()[:10], '%Y-%m-%d').strftime('%d.%m.%Y %H:%M')
+    except ValueError:
+        raise ValueError(f'некорректная дата "{value}"')
+
+
+# =========================
+# NATIVE
+# =========================
+
+def _native_payment(rows, categories):
+    """rows — [(номер строки, dict)] одного expense_id; возвращает payment для create_many или ValueError."""
+    _, first = rows[0]
+    amount = _amount(first['amount'], 'сумма')
+    if amount <= 0:
+        raise ValueError('сумма должна быть больше 0')
+    try:
+        payer_id = int(first['payer_id'])
+    except ValueError:
+        raise ValueError(f'некорректный payer_id "{first["payer_id"]}"')
+    if not first['date'].strip():
+        raise ValueError('не указана дата')
+    participant_shares = []
+    for _, row in rows:
+        if not (row.get('participant_id') or '').strip():
+            continue
+        try:
+            participant_id = int(row['participant_id'])
+        except ValueError:
+            raise ValueError(f'некорректный participant_id "{row["participant_id"]}"')
+        share = _amount(row.get('share') or '', 'доля')
+        if share <= 0:
+            raise ValueError('доля должна быть больше 0')
+        is_paid = (row.get('is_paid') or '').strip().lower() in ('1', 'true', 'да', 'yes')
+        participant_shares.append((participant_id, row.get('participant') or str(participant_id), share, is_paid))
+    shares.check_share_limit(amount, 0, [s[2] for s in participant_shares])
+    return {
+        'description': first['name'] or 'Без названия',
+        'user_id': payer_id,
+        'created_by': first['payer'] or str(payer_id),
+        'timestamp': first['date'].strip(),
+        'amount': amount,
+        'currency': _currency(first['currency']),
+        'category_id': categories.get((first.get('category') or '').strip().lower()),
+        'shares': participant_shares,
+    }
+
+
+def iter_native(reader, header, categories, result):
+    """Генератор (номера строк, payment) по строкам expenses.csv; ошибки складываются в result."""
+    group = []
+    group_id = None
+    for line_no, values in enumerate(reader, start=2):
+        if not any(v.strip() for v in values):
+            continue
+        row = dict(zip(header, values))
+        expense_id = row.get('expense_id')
+        if group and expense_id != group_id:
+            yield from _native_group(group, categories, result)
+            group = []
+        group_id = expense_id
+        group.append((line_no, row))
+    if group:
+        yield from _native_group(group, categories, result)
+
+
+def _native_group(group, categories, result):
+    lines = [line_no for line_no, _ in group]
+    try:
+        yield lines, _native_payment(group, categories)
+    except (ValueError, shares.ShareLimitError) as e:
+        result.reject(lines, str(e))
+
+
+# =========================
+# SPLITWISE
+# =========================
+
+def _splitwise_payments(row, members, category_id):
+    """Расход Splitwise -> платежи бота: по одному на кредитора, доли — должники."""
+    description = row[1].strip() or 'Без названия'
+    timestamp = _splitwise_date(row[0])
+    currency = _currency(row[4])
+    balance = {}
+    for (user_id, _), value in zip(members, row[len(SPLITWISE_FIXED):]):
+        if value.strip():
+            cents = split.to_cents(_amount(value, 'итог участника'))
+            if cents:
+                balance[user_id] = balance.get(user_id, 0) + cents
+    if abs(sum(balance.values())) > len(members):
+        raise ValueError('итоги участников не сходятся в ноль')
+    names = dict(members)
+    by_creditor = {}
+    for debtor, creditor, amount, _ in debts_optimizer.settle_balances(balance, currency):
+        by_creditor.setdefault(creditor, []).append((debtor, names[debtor], amount))
+    return [{
+        'description': description,
+        'user_id': creditor,
+        'created_by': names[creditor],
+        'timestamp': timestamp,
+        'amount': round(sum(a for _, _, a in debtor_shares), 2),
+        'currency': currency,
+        'category_id': category_id,
+        'shares': debtor_shares,
+    } for creditor, debtor_shares in by_creditor.items()]
+
+
+def resolve_splitwise_members(header, mapping, usernames, users):
+    """Колонки участников -> [(user_id, name)]; ValueError со списком несопоставленных имён.
+
+    mapping — {имя: username} из подписи, usernames — {username: (id, name)} из хранилища,
+    users — [(id, name, ...)] всех пользователей для сопоставления по имени.
+    """
+    by_name = {}
+    for user_id, name, *_ in users:
+        by_name.setdefault(name.strip().lower(), []).append(user_id)
+    members = []
+    unknown = []
+    for column in header[len(SPLITWISE_FIXED):]:
+        key = column.strip().lower()
+        if key in mapping and mapping[key] in usernames:
+            members.append((usernames[mapping[key]][0], column.strip()))
+        elif len(by_name.get(key, [])) == 1:
+            members.append((by_name[key][0], column.strip()))
+        else:
+            unknown.append(column.strip())
+    if unknown:
+        raise ImportFormatError(
+            'Не удалось сопоставить участников Splitwise: ' + ', '.join(unknown) +
+            '. Укажите их в подписи к файлу: /import Имя=@username, ...'
+        )
+    return members
+
+
+def iter_splitwise(reader, members, categories, result):
+    for line_no, row in enumerate(reader, start=2):
+        if not any(v.strip() for v in row):
+            continue
+        if row[1].strip().lower() == SPLITWISE_TOTAL_ROW:
+            continue
+        try:
+            category_id = categories.get(row[2].strip().lower())
+            for payment in _splitwise_payments(row, members, category_id):
+                yield [line_no], payment
+        except (ValueError, IndexError) as e:
+            result.reject(line_no, str(e) or 'неполная строка')
+
+
+# =========================
+# IMPORT
+# =========================
+
+async def import_csv(storage, data, mapping_text='', event_id=DEFAULT_EVENT_ID, chunk_size=CHUNK_SIZE):
+    """Импортирует CSV из бинарного потока data в хранилище; возвращает ImportResult.
+
+    ImportFormatError — если формат не распознан или участники Splitwise не сопоставлены.
+    """
+    reader = csv.reader(io.TextIOWrapper(data, encoding='utf-8-sig', newline=''))
+    try:
+        header = [h.strip() for h in next(reader)]
+    except StopIteration:
+        raise ImportFormatError('Пустой файл')
+    fmt = detect_format(header)
+    categories = {name.lower(): cid for cid, name in await storage.expenses.get_categories()}
+    result = ImportResult()
+
+    if fmt == 'native':
+        payments = iter_native(reader, header, categories, result)
+    else:
+        mapping = parse_mapping(mapping_text)
+        usernames = await storage.users.find_by_usernames(mapping.values()) if mapping else {}
+        members = resolve_splitwise_members(header, mapping, usernames, await storage.users.get_all())
+        payments = iter_splitwise(reader, members, categories, result)
+
+    chunk = []
+    for lines, payment in payments:
+        payment['event_id'] = event_id
+        chunk.append((lines, payment))
+        if len(chunk) >= chunk_size:
+            await _flush(storage, chunk, result)
+            chunk = []
+    if chunk:
+        await _flush(storage, chunk, result)
+    return result
+
+
+async def _flush(storage, chunk, result):
+    try:
+        await storage.expenses.create_many([payment for _, payment in chunk])
+    except Exception as e:
+        # пачка откатывается целиком — все её строки считаются отклонёнными
+        for lines, _ in chunk:
+            result.reject(lines, f'ошибка записи: {e}')
+        return
+    result.payments += len(chunk)
+    result.shares += sum(len(payment['shares']) for _, payment in chunk)
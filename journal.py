@@ -0,0 +1,82 @@
+import json
+import logging
+
+# Журнал расчётов (settlement_journal) и восстановление после сбоя.
+# /optimize — несколько шагов: план -> сообщение с планом в чате -> пометка задействованных долей оплаченными.
+# Если бот падал между шагами, нельзя было понять, какой план отправлен в чат, а какой применён к долгам.
+# Теперь каждый запуск (бот или python -m debts_optimizer) дописывает в журнал записи; записи не меняются и не удаляются:
+#   planned   — режим, мероприятие, чат и весь план с аллокациями (JSON);
+#   posted    — план отправлен в чат (message_id);
+#   applied   — доли помечены оплаченными; пишется в той же транзакции, что и apply_allocations,
+#               поэтому после сбоя applied есть тогда и только тогда, когда доли действительно помечены;
+#   failed    — ошибка отправки или применения (текст в payload);
+#   abandoned — запуск брошен при восстановлении.
+# applied, failed и abandoned — конечные состояния. При старте бота recover() завершает прерванные запуски:
+#   planned без posted — план никто не видел, он бросается (abandoned);
+#   posted без applied — план уже висит в чате, и его аллокации применяются сейчас; plan_allocation_updates
+#     проверяет, что задействованные доли не изменились, иначе запуск помечается failed.
+# Чтобы восстановление не читало весь журнал, хранится позиция settlement_checkpoint: все запуски до неё завершены.
+# recover() читает только хвост журнала после неё и двигает её вперёд (как и обслуживание базы, maintenance.compact).
+# Снимки базы для восстановления после потери файла — maintenance.snapshot.
+
+logger = logging.getLogger(__name__)
+
+PLANNED = 'planned'
+POSTED = 'posted'
+APPLIED = 'applied'
+FAILED = 'failed'
+ABANDONED = 'abandoned'
+FINAL_STATES = (APPLIED, FAILED, ABANDONED)
+
+STATE_NAMES = {
+    PLANNED: 'рассчитан',
+    POSTED: 'отправлен, не применён',
+    APPLIED: 'применён',
+    FAILED: 'ошибка',
+    ABANDONED: 'брошен',
+}
+
+
+def dump_plan(transfers):
+    """План с аллокациями -> JSON для записи planned."""
+    return json.dumps(transfers, ensure_ascii=False)
+
+
+def load_plan(payload):
+    """JSON записи planned -> план для apply_allocations (аллокации — списки вместо кортежей, это не мешает)."""
+    return json.loads(payload)
+
+
+async def recover(ledger):
+    """Завершает запуски, прерванные сбоем; возвращает [(run_id, конечное состояние)]."""
+    results = []
+    for run_id, state, payload in await ledger.get_open_runs():
+        if state == PLANNED:
+            await ledger.journal_append(run_id, ABANDONED)
+            results.append((run_id, ABANDONED))
+            continue
+        try:
+            await ledger.apply_allocations(load_plan(payload), run_id)
+        except Exception as e:
+            logger.error('Расчёт %s: не удалось применить план после сбоя: %s', run_id, e)
+            await ledger.journal_append(run_id, FAILED, detail=str(e))
+            results.append((run_id, FAILED))
+            continue
+        results.append((run_id, APPLIED))
+    checkpoint = await ledger.advance_journal_checkpoint()
+    if results:
+        logger.info('Журнал расчётов: восстановлено %s, позиция %s', results, checkpoint)
+    return results
+
+
+def format_runs(rows):
+    """rows — LedgerRepository.get_recent_runs: (run_id, created_at, source, mode, event_id, transfers, state, detail)."""
+    if not rows:
+        return 'Журнал расчётов пуст'
+    lines = ['Последние расчёты:']
+    for run_id, created_at, source, mode, event_id, transfers, state, detail in rows:
+        event = f', мероприятие {event_id}' if event_id is not None else ''
+        lines.append(f'#{run_id} {created_at} {source} {mode}{event}: переводов {transfers} — {STATE_NAMES.get(state, state)}')
+        if detail:
+            lines.append(f'   {detail[:200]}')
+    return '\n'.join(lines)
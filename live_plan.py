@@ -0,0 +1,163 @@
+import asyncio
+import logging
+
+import debts_optimizer
+import messaging
+import metrics
+
+# Живой план переводов (/live on в группе).
+# Без него план появляется только по /optimize, и каждый запуск присылает и закрепляет новое сообщение.
+# В живом режиме бот один раз отправляет и закрепляет сообщение с планом, а дальше правит его сам:
+#   1) после записи долей (ответ на платёж, позиции чека, /import) и после /optimize вызывается touch(валюта);
+#   2) первый touch запускает отложенный пересчёт через LIVE_PLAN_DELAY секунд, следующие touch в этом окне
+#      только добавляют валюту в набор "грязных" — занятый чат даёт не больше одного пересчёта за окно;
+#   3) пересчитываются только затронутые валюты: суммы долгов по парам одной валюты
+#      (LedgerRepository.get_unpaid_totals(currency)) -> план, как в /export (compute_net_transfers
+#      или compute_direct_transfers для SETTLEMENT_MODE = 'direct'); планы остальных валют берутся из кэша;
+#   4) новый план сравнивается с прежним, и закреплённые сообщения правятся, только если он изменился.
+# План только показывается: доли оплаченными не помечаются, для этого по-прежнему нужен /optimize.
+# Список чатов с живым планом хранится в памяти: после перезапуска бота /live on нужно выполнить заново.
+# Отложенный пересчёт — обычная asyncio-задача, а не JobQueue: она не требует python-telegram-bot[job-queue].
+# Настройки в config.py:
+#   LIVE_PLAN_DELAY = 10          # окно объединения изменений, секунд
+
+logger = logging.getLogger(__name__)
+
+LIVE_PLAN_DELAY = 10.0
+
+PLANNERS = {
+    'net': debts_optimizer.compute_net_transfers,
+    'direct': debts_optimizer.compute_direct_transfers,
+}
+
+
+def _currency(currency):
+    return (currency or 'RUB').strip().upper() or 'RUB'
+
+
+class LivePlan:
+    """Закреплённые сообщения с планом по чатам и отложенный пересчёт.
+
+    render — async-функция: список переводов {from, to, amount, currency} -> HTML-текст сообщения.
+    """
+
+    def __init__(self, ledger, render, delay=LIVE_PLAN_DELAY, mode='net'):
+        if mode not in PLANNERS:
+            raise ValueError(f'Неизвестный режим расчёта: {mode}')
+        self.ledger = ledger
+        self.render = render
+        self.delay = delay
+        self.plan = PLANNERS[mode]
+        self.bot = None
+        self.chats = {}      # chat_id -> message_id закреплённого плана
+        self.texts = {}      # chat_id -> последний отправленный текст
+        self.plans = None    # валюта -> [переводы]; None — ещё не считали
+        self._dirty = set()  # валюты к пересчёту; None — все
+        self._task = None
+
+    def enabled(self, chat_id):
+        return chat_id in self.chats
+
+    async def enable(self, bot, chat_id):
+        """Отправляет план в чат и закрепляет его; возвращает отправленное сообщение."""
+        self.bot = bot
+        if self.plans is None:
+            await self._recompute({None})
+        text = await self._text()
+        sent = await bot.send_message(chat_id=chat_id, text=text, parse_mode='HTML', disable_web_page_preview=True)
+        try:
+            await bot.pin_chat_message(chat_id=chat_id, message_id=sent.message_id)
+        except Exception as e:
+            logger.warning('Не удалось закрепить живой план в чате %s: %s', chat_id, e)
+        self.chats[chat_id] = sent.message_id
+        self.texts[chat_id] = text
+        return sent
+
+    def disable(self, chat_id):
+        """Выключает живой план в чате; возвращает message_id закреплённого плана или None."""
+        self.texts.pop(chat_id, None)
+        message_id = self.chats.pop(chat_id, None)
+        if not self.chats:
+            self.plans = None
+        return message_id
+
+    def touch(self, currency=None):
+        """Долги в валюте изменились (currency=None — в любой); пересчёт будет не раньше чем через delay."""
+        if not self.chats:
+            return
+        self._dirty.add(_currency(currency) if currency is not None else None)
+        if self._task is None:
+            self._task = asyncio.create_task(self._debounced())
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _debounced(self):
+        try:
+            # изменения, пришедшие во время пересчёта, попадут в следующее окно
+            while self._dirty:
+                await asyncio.sleep(self.delay)
+                dirty, self._dirty = self._dirty, set()
+                try:
+                    await self.refresh(dirty)
+                except Exception as e:
+                    logger.exception('Ошибка обновления живого плана: %s', e)
+        finally:
+            self._task = None
+
+    async def refresh(self, currencies):
+        """Пересчитывает план по валютам (None в наборе — все) и правит сообщения, если он изменился.
+
+        Возвращает число отредактированных сообщений.
+        """
+        if not self.chats:
+            return 0
+        with metrics.timer('optimizer_stage_seconds', stage='live_plan_refresh'):
+            if not await self._recompute(currencies):
+                return 0
+            text = await self._text()
+        edited = 0
+        for chat_id, message_id in list(self.chats.items()):
+            if self.texts.get(chat_id) == text:
+                continue
+            try:
+                await self.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text,
+                                                 parse_mode='HTML', disable_web_page_preview=True)
+            except Exception as e:
+                # сообщение удалили или бота убрали из чата — живой план в этом чате выключается
+                logger.warning('Не удалось обновить живой план в чате %s, режим выключен: %s', chat_id, e)
+                self.disable(chat_id)
+                continue
+            self.texts[chat_id] = text
+            edited += 1
+        return edited
+
+    async def _recompute(self, currencies):
+        """Обновляет кэш планов; возвращает True, если план изменился."""
+        if self.plans is None or None in currencies:
+            plans = {}
+            for transfer in await asyncio.to_thread(self.plan, await self.ledger.get_unpaid_totals()):
+                plans.setdefault(transfer[3], []).append(transfer)
+            changed = plans != self.plans
+            self.plans = plans
+            return changed
+        changed = False
+        for cur in sorted(currencies):
+            transfers = await asyncio.to_thread(self.plan, await self.ledger.get_unpaid_totals(cur))
+            if transfers != self.plans.get(cur, []):
+                changed = True
+                if transfers:
+                    self.plans[cur] = transfers
+                else:
+                    self.plans.pop(cur, None)
+        return changed
+
+    async def _text(self):
+        transfers = [{'from': frm, 'to': to, 'amount': amount, 'currency': cur}
+                     for cur in sorted(self.plans) for frm, to, amount, _ in self.plans[cur]]
+        text = await self.render(transfers)
+        # в закреплённом сообщении помещается только первая часть длинного плана
+        parts = messaging.split_message(text, messaging.MAX_MESSAGE_LENGTH - 2)
+        return parts[0] + ('\n…' if len(parts) > 1 else '')
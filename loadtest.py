@@ -0,0 +1,302 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+from telegram import Update
+from telegram.ext import Application
+from telegram.request import BaseRequest
+
+# Офлайн-нагрузочный стенд для всего стека обработчиков bot.py — без подключения к Telegram.
+# Application собирается через bot.build_application, но вместо HTTP-клиента подставляется FakeRequest:
+# он отвечает на вызовы Bot API (sendMessage, editMessageText, pinChatMessage, ...) правдоподобными
+# объектами и записывает их. На вход подаются синтетические сценарии (создание платежа, ответы с долями,
+# запросы баланса/долгов, /optimize) или записанный поток апдейтов (JSON lines), база — временный expenses.db.
+# Результат — апдейтов в секунду и перцентили задержки по каждому типу обработчика.
+#
+# Запуск:
+#   python loadtest.py --chats 20 --users-per-chat 5 --payments 10 --concurrency 8
+#   python loadtest.py --updates recorded.jsonl --concurrency 4
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'LoadTestBot', 'username': 'loadtest_bot'}
+
+try:
+    import config  # noqa: F401
+except ImportError:
+    # стенд работает офлайн, настоящий токен ему не нужен
+    import types
+    config = types.ModuleType('config')
+    config.BOT_TOKEN = '123456:LOADTEST'
+    sys.modules['config'] = config
+
+import bot
+import storage
+
+
+class FakeRequest(BaseRequest):
+    """Отвечает на запросы Bot API локально и записывает исходящие вызовы."""
+
+    def __init__(self):
+        self.calls = []
+        self.message_ids = itertools.count(1_000_000)
+        # последнее сообщение бота в каждом чате с текстом, начинающимся с ключа, — нужно сценариям для ответов
+        self.last_message = {}
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls.append((api_method, params))
+        result = self._result(api_method, params)
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+    def _result(self, api_method, params):
+        if api_method == 'getMe':
+            return dict(BOT_USER, can_join_groups=True, can_read_all_group_messages=True, supports_inline_queries=False)
+        if api_method in ('sendMessage', 'editMessageText'):
+            chat_id = params.get('chat_id', 0)
+            message_id = params.get('message_id') or next(self.message_ids)
+            text = params.get('text', '')
+            self.last_message[(chat_id, text.split('\n', 1)[0])] = message_id
+            return {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'group' if chat_id < 0 else 'private', 'title': 'loadtest'},
+                'from': BOT_USER,
+                'text': text,
+            }
+        if api_method == 'sendDocument':
+            return {
+                'message_id': next(self.message_ids),
+                'date': int(time.time()),
+                'chat': {'id': params.get('chat_id', 0), 'type': 'group', 'title': 'loadtest'},
+                'from': BOT_USER,
+                'document': {'file_id': 'doc', 'file_unique_id': 'doc'},
+            }
+        return True
+
+    def counts(self):
+        result = defaultdict(int)
+        for api_method, _ in self.calls:
+            result[api_method] += 1
+        return dict(result)
+
+
+class UpdateFactory:
+    """Собирает JSON апдейтов так, как их присылает Telegram."""
+
+    def __init__(self):
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+
+    @staticmethod
+    def user(user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}', 'username': f'user{user_id}'}
+
+    @staticmethod
+    def chat(chat_id):
+        return {'id': chat_id, 'type': 'group', 'title': f'Chat {chat_id}'}
+
+    def message(self, chat_id, user_id, text, reply_to=None):
+        message = {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': self.chat(chat_id),
+            'from': self.user(user_id),
+            'text': text,
+        }
+        if text.startswith('/'):
+            command = text.split()[0]
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        if reply_to is not None:
+            message['reply_to_message'] = {
+                'message_id': reply_to,
+                'date': int(time.time()),
+                'chat': self.chat(chat_id),
+                'from': BOT_USER,
+                'text': 'Платеж создан!',
+            }
+        return {'update_id': next(self.update_ids), 'message': message}
+
+    def callback(self, chat_id, user_id, data, message_id):
+        return {
+            'update_id': next(self.update_ids),
+            'callback_query': {
+                'id': str(next(self.update_ids)),
+                'from': self.user(user_id),
+                'chat_instance': str(chat_id),
+                'data': data,
+                'message': {
+                    'message_id': message_id,
+                    'date': int(time.time()),
+                    'chat': self.chat(chat_id),
+                    'from': BOT_USER,
+                    'text': '...',
+                },
+            },
+        }
+
+
+class LoadTest:
+    def __init__(self, application, request):
+        self.application = application
+        self.request = request
+        self.factory = UpdateFactory()
+        self.latencies = defaultdict(list)
+
+    async def feed(self, label, update_json):
+        update = Update.de_json(update_json, self.application.bot)
+        started = time.perf_counter()
+        # через update_processor, как в run_polling: задержка включает ожидание в очереди планировщика
+        await self.application.update_processor.process_update(update, self.application.process_update(update))
+        self.latencies[label].append(time.perf_counter() - started)
+
+    async def chat_scenario(self, chat_id, user_ids, payments, optimize_every):
+        f = self.factory
+        for uid in user_ids:
+            await self.feed('command:start', f.message(chat_id, uid, '/start'))
+        for n in range(payments):
+            payer = user_ids[n % len(user_ids)]
+            await self.feed('button:create_payment', f.message(chat_id, payer, 'Создать платеж'))
+            await self.feed('text:title', f.message(chat_id, payer, f'Ужин {n}'))
+            await self.feed('text:amount', f.message(chat_id, payer, str(100 * len(user_ids) + n)))
+            await self.feed('callback:currency', f.callback(chat_id, payer, 'currency_RUB', 0))
+            await self.feed('callback:confirm', f.callback(chat_id, payer, 'confirm_payment', 0))
+            await self.feed('callback:category', f.callback(chat_id, payer, 'category_1', 0))
+            created_id = self.request.last_message.get((chat_id, 'Платеж создан!'))
+            others = [u for u in user_ids if u != payer]
+            if others:
+                # первый участник записывает доли всех сразу, остальные — по одной
+                bulk = ', '.join(f'@user{u} 50' for u in others[:3])
+                await self.feed('reply:bulk_shares', f.message(chat_id, others[0], bulk, reply_to=created_id))
+            for uid in others[3:]:
+                await self.feed('reply:share', f.message(chat_id, uid, '50', reply_to=created_id))
+            viewer = user_ids[(n + 1) % len(user_ids)]
+            await self.feed('button:balance', f.message(chat_id, viewer, 'Баланс'))
+            await self.feed('button:my_debt', f.message(chat_id, viewer, 'Мой долг'))
+            await self.feed('button:total_debt', f.message(chat_id, viewer, 'Общий долг'))
+            await self.feed('button:history', f.message(chat_id, viewer, 'История платежей'))
+            await self.feed('button:stats', f.message(chat_id, viewer, 'Статистика'))
+            if optimize_every and (n + 1) % optimize_every == 0:
+                await self.feed('command:optimize', f.message(chat_id, payer, '/optimize'))
+
+    async def run_synthetic(self, chats, users_per_chat, payments, concurrency, optimize_every):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run_chat(i):
+            chat_id = -1000 - i
+            user_ids = [100_000 + i * users_per_chat + k for k in range(users_per_chat)]
+            async with semaphore:
+                await self.chat_scenario(chat_id, user_ids, payments, optimize_every)
+
+        await asyncio.gather(*(run_chat(i) for i in range(chats)))
+
+    async def run_recorded(self, path, concurrency):
+        """Записанные апдейты (JSON lines); апдейты одного чата идут по порядку, разные чаты — параллельно."""
+        by_chat = defaultdict(list)
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    data = json.loads(line)
+                    by_chat[_chat_of(data)].append(data)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run_chat(updates):
+            async with semaphore:
+                for data in updates:
+                    await self.feed(_label_of(data), data)
+
+        await asyncio.gather(*(run_chat(updates) for updates in by_chat.values()))
+
+    def report(self, elapsed):
+        total = sum(len(v) for v in self.latencies.values())
+        print(f'Апдейтов: {total} за {elapsed:.2f} с — {total / elapsed:.1f} апдейтов/с')
+        print(f'{"обработчик":<24}{"n":>7}{"p50 мс":>10}{"p95 мс":>10}{"p99 мс":>10}{"max мс":>10}')
+        for label in sorted(self.latencies):
+            values = sorted(self.latencies[label])
+            print(f'{label:<24}{len(values):>7}'
+                  f'{_percentile(values, 50) * 1000:>10.2f}{_percentile(values, 95) * 1000:>10.2f}'
+                  f'{_percentile(values, 99) * 1000:>10.2f}{values[-1] * 1000:>10.2f}')
+        print('Исходящие вызовы Bot API:', self.request.counts())
+
+
+def _percentile(values, p):
+    k = min(len(values) - 1, max(0, round(p / 100 * (len(values) - 1))))
+    return values[k]
+
+
+def _chat_of(data):
+    if 'callback_query' in data:
+        return data['callback_query'].get('message', {}).get('chat', {}).get('id')
+    return data.get('message', {}).get('chat', {}).get('id')
+
+
+def _label_of(data):
+    if 'callback_query' in data:
+        return 'callback:' + data['callback_query'].get('data', '').split('_', 1)[0]
+    message = data.get('message', {})
+    text = message.get('text')
+    if text is None:
+        return 'photo' if message.get('photo') else 'other'
+    if text.startswith('/'):
+        return 'command:' + text.split()[0][1:]
+    if message.get('reply_to_message'):
+        return 'reply'
+    return 'text'
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix='loadtest_')
+    db_path = os.path.join(workdir, 'expenses.db')
+    bot.db = storage.SqliteStorage(db_path)
+    await bot.db.init_schema()
+
+    request = FakeRequest()
+    builder = Application.builder().token(bot.BOT_TOKEN).request(request).get_updates_request(FakeRequest())
+    # лимиты Telegram на частоту сообщений здесь только мешают мерить сами обработчики; --rate-limit включает их
+    application = bot.build_application(builder, rate_limit=args.rate_limit)
+    await application.initialize()
+
+    test = LoadTest(application, request)
+    started = time.perf_counter()
+    if args.updates:
+        await test.run_recorded(args.updates, args.concurrency)
+    else:
+        await test.run_synthetic(args.chats, args.users_per_chat, args.payments, args.concurrency, args.optimize_every)
+    elapsed = time.perf_counter() - started
+
+    await application.shutdown()
+    test.report(elapsed)
+    print(f'База: {db_path}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Офлайн-нагрузочный стенд обработчиков bot.py')
+    parser.add_argument('--chats', type=int, default=10, help='число групповых чатов в синтетическом сценарии')
+    parser.add_argument('--users-per-chat', type=int, default=4)
+    parser.add_argument('--payments', type=int, default=5, help='платежей на чат')
+    parser.add_argument('--optimize-every', type=int, default=5, help='запускать /optimize каждые N платежей (0 — никогда)')
+    parser.add_argument('--concurrency', type=int, default=4, help='сколько чатов обрабатывается одновременно')
+    parser.add_argument('--rate-limit', action='store_true', help='включить ограничитель частоты исходящих сообщений')
+    parser.add_argument('--updates', help='файл с записанными апдейтами (JSON lines) вместо синтетики')
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import os
+import time
+
+import metrics
+
+# Обслуживание базы.
+# Каждый /optimize частично погашает доли: apply_allocations уменьшает неоплаченную строку expense_participant
+# и добавляет рядом оплаченную, поэтому таблица растёт с каждым запуском, а запросы долгов и оптимизатор
+# продолжают её сканировать. compact() по расписанию:
+#   1) сливает оплаченные фрагменты в одну строку на (платёж, участник) — LedgerRepository.compact_paid_shares;
+#   2) переносит полностью погашенные платежи закрытых мероприятий (ExpenseRepository.close_event, /close_event)
+#      в таблицы *_archive — LedgerRepository.archive_settled; /export читает и архив;
+#   3) обновляет статистику планировщика (ANALYZE) и, если освободилось много места, делает VACUUM — Storage.optimize;
+#   4) сдвигает позицию восстановления журнала расчётов (journal.py), чтобы после сбоя читался только его хвост.
+# snapshot() по своему расписанию копирует SQLite-базу в SNAPSHOT_DIR через online backup API (SqliteStorage.snapshot):
+# копия согласованная, запись в базу на это время не останавливается (режим WAL), копирование идёт в отдельном потоке.
+# Хранятся последние SNAPSHOT_KEEP снимков. Восстановление после потери или порчи expenses.db — остановить бота,
+# удалить expenses.db-wal и expenses.db-shm (иначе SQLite применит к снимку журнал старой базы), скопировать последний
+# снимок на место базы и запустить бота: незавершённые в снимке расчёты завершит journal.recover.
+# Изменения после снимка при этом теряются.
+# Для PostgreSQL снимки делаются средствами сервера (pg_dump, pg_basebackup).
+# Настройки в config.py:
+#   COMPACT_INTERVAL_HOURS = 24   # None — только вручную, командой /compact
+#   VACUUM_FREE_RATIO = 0.2       # SQLite: VACUUM, если свободные страницы больше этой доли файла
+#   SNAPSHOT_INTERVAL_HOURS = 6   # None — только вручную, командой /snapshot
+#   SNAPSHOT_DIR = 'snapshots'
+#   SNAPSHOT_KEEP = 7
+
+logger = logging.getLogger(__name__)
+
+VACUUM_FREE_RATIO = 0.2
+SNAPSHOT_DIR = 'snapshots'
+SNAPSHOT_KEEP = 7
+SNAPSHOT_PREFIX = 'snapshot-'
+
+
+async def compact(storage, vacuum_free_ratio=VACUUM_FREE_RATIO):
+    """Один проход обслуживания; возвращает словарь со статистикой."""
+    started = time.perf_counter()
+    merged = await storage.ledger.compact_paid_shares()
+    archived_expenses, archived_shares = await storage.ledger.archive_settled()
+    vacuumed = await storage.optimize(vacuum_free_ratio)
+    checkpoint = await storage.ledger.advance_journal_checkpoint()
+    stats = {
+        'merged_shares': merged,
+        'archived_expenses': archived_expenses,
+        'archived_shares': archived_shares,
+        'vacuumed': vacuumed,
+        'journal_checkpoint': checkpoint,
+        'seconds': time.perf_counter() - started,
+    }
+    metrics.observe('db_compaction_seconds', stats['seconds'])
+    logger.info('Обслуживание базы: %s', stats)
+    return stats
+
+
+def format_report(stats):
+    return (
+        f"Слито оплаченных фрагментов долей: {stats['merged_shares']}\n"
+        f"В архив перенесено платежей: {stats['archived_expenses']}, долей: {stats['archived_shares']}\n"
+        f"VACUUM: {'да' if stats['vacuumed'] else 'нет'}\n"
+        f"Позиция восстановления журнала расчётов: {stats['journal_checkpoint']}\n"
+        f"Время: {stats['seconds']:.2f} с"
+    )
+
+
+async def compaction_loop(storage, interval_seconds, vacuum_free_ratio=VACUUM_FREE_RATIO):
+    """Фоновая задача: compact() раз в interval_seconds; ошибки пишутся в лог и не останавливают цикл."""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            await compact(storage, vacuum_free_ratio)
+        except Exception as e:
+            logger.exception('Ошибка обслуживания базы: %s', e)
+
+
+async def snapshot(storage, directory=SNAPSHOT_DIR, keep=SNAPSHOT_KEEP):
+    """Снимок базы в directory и удаление снимков сверх keep; возвращает словарь со статистикой."""
+    started = time.perf_counter()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, time.strftime(f'{SNAPSHOT_PREFIX}%Y%m%d-%H%M%S.db'))
+    size = await storage.snapshot(path)
+    # имена с датой и временем сортируются по времени
+    snapshots = sorted(name for name in os.listdir(directory) if name.startswith(SNAPSHOT_PREFIX) and name.endswith('.db'))
+    removed = snapshots[:-keep] if keep else []
+    for name in removed:
+        os.remove(os.path.join(directory, name))
+    stats = {'path': path, 'bytes': size, 'removed': len(removed), 'seconds': time.perf_counter() - started}
+    metrics.observe('db_snapshot_seconds', stats['seconds'])
+    logger.info('Снимок базы: %s', stats)
+    return stats
+
+
+def format_snapshot_report(stats):
+    return (
+        f"Снимок: {stats['path']} ({stats['bytes'] / 1024 / 1024:.1f} МБ)\n"
+        f"Удалено старых снимков: {stats['removed']}\n"
+        f"Время: {stats['seconds']:.2f} с"
+    )
+
+
+async def snapshot_loop(storage, interval_seconds, directory=SNAPSHOT_DIR, keep=SNAPSHOT_KEEP):
+    """Фоновая задача: snapshot() раз в interval_seconds; ошибки пишутся в лог и не останавливают цикл."""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            await snapshot(storage, directory, keep)
+        except Exception as e:
+            logger.exception('Ошибка снимка базы: %s', e)
@@ -0,0 +1,191 @@
+import asyncio
+import logging
+import time
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+# Исходящие сообщения.
+# 1) TokenBucketRateLimiter — BaseRateLimiter для ApplicationBuilder.rate_limiter: каждый запрос к Bot API
+#    с chat_id ждёт токен в общем ведре (лимит Telegram ~30 сообщений/с на бота) и в ведре своего чата
+#    (группы ~20 сообщений/мин, личные чаты ~1 сообщение/с). Если Telegram всё же ответил 429 (RetryAfter),
+#    запрос повторяется после указанной паузы, пока остальные запросы тоже ждут.
+# 2) split_message/reply_long/send_long — длинные отчёты (общий долг, история платежей в больших группах)
+#    делятся на сообщения не длиннее 4096 символов по границам строк.
+# 3) StatusMessage — статусы одной операции ("Формирую план переводов...", затем результат)
+#    объединяются в одно сообщение, которое редактируется, вместо нескольких отдельных.
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LENGTH = 4096
+
+GLOBAL_RATE = 30.0
+GROUP_RATE = 20 / 60.0
+GROUP_BURST = 20
+PRIVATE_RATE = 1.0
+PRIVATE_BURST = 5
+MAX_RETRIES = 3
+
+
+class TokenBucket:
+    """rate токенов в секунду, не больше capacity накоплено."""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class TokenBucketRateLimiter(BaseRateLimiter):
+    def __init__(self, global_rate=GLOBAL_RATE, group_rate=GROUP_RATE, group_burst=GROUP_BURST,
+                 private_rate=PRIVATE_RATE, private_burst=PRIVATE_BURST, max_retries=MAX_RETRIES):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.private_rate = private_rate
+        self.private_burst = private_burst
+        self.max_retries = max_retries
+        self.chat_buckets = {}
+        # сброшен, пока идёт пауза после 429: остальные запросы ждут её окончания
+        self._retry_after = asyncio.Event()
+        self._retry_after.set()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 1000:
+                # полные ведра ничем не отличаются от новых — выбрасываем, чтобы словарь не рос
+                self.chat_buckets = {k: b for k, b in self.chat_buckets.items() if not b.is_full()}
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            if is_group:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.private_rate, self.private_burst)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        if isinstance(chat_id, str) and chat_id.lstrip('-').isdigit():
+            chat_id = int(chat_id)
+        max_retries = rate_limit_args if rate_limit_args is not None else self.max_retries
+        for attempt in range(max_retries + 1):
+            await self._retry_after.wait()
+            if chat_id is not None:
+                await self._chat_bucket(chat_id).acquire()
+                await self.global_bucket.acquire()
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == max_retries:
+                    raise
+                pause = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else float(e.retry_after)
+                logger.warning('Telegram ограничил частоту (%s), пауза %.1f с', endpoint, pause)
+                self._retry_after.clear()
+                try:
+                    await asyncio.sleep(pause + 0.1)
+                finally:
+                    self._retry_after.set()
+
+
+def split_message(text, limit=MAX_MESSAGE_LENGTH):
+    """Делит text на части не длиннее limit по границам строк.
+
+    Строка длиннее limit режется по последнему пробелу вне HTML-элементов (упоминания <a href=...>...</a>),
+    иначе — по limit.
+    """
+    parts = []
+    current = ''
+    for line in text.split('\n'):
+        while len(line) > limit:
+            cut = _cut_position(line, limit)
+            if current:
+                parts.append(current)
+                current = ''
+            parts.append(line[:cut].rstrip())
+            line = line[cut:].lstrip()
+        candidate = f'{current}\n{line}' if current else line
+        if len(candidate) > limit:
+            parts.append(current)
+            current = line
+        else:
+            current = candidate
+    if current.strip():
+        parts.append(current)
+    return [p for p in parts if p.strip()] or ['']
+
+
+def _cut_position(line, limit):
+    pos = limit
+    while pos > 0:
+        pos = line.rfind(' ', 0, pos)
+        if pos <= 0:
+            break
+        prefix = line[:pos]
+        closed = prefix.count('</')
+        if prefix.rfind('<') <= prefix.rfind('>') and prefix.count('<') - closed == closed:
+            return pos
+    return limit
+
+
+async def reply_long(message, text, **kwargs):
+    """reply_text для отчёта произвольной длины; клавиатура (reply_markup) — только у последней части."""
+    reply_markup = kwargs.pop('reply_markup', None)
+    parts = split_message(text)
+    sent = []
+    for i, part in enumerate(parts):
+        markup = reply_markup if i == len(parts) - 1 else None
+        sent.append(await message.reply_text(part, reply_markup=markup, **kwargs))
+    return sent
+
+
+async def send_long(bot, chat_id, text, **kwargs):
+    """bot.send_message для текста произвольной длины; возвращает список отправленных сообщений."""
+    return [await bot.send_message(chat_id=chat_id, text=part, **kwargs) for part in split_message(text)]
+
+
+class StatusMessage:
+    """Одно сообщение со статусом операции: первый set отправляет ответ, следующие редактируют его."""
+
+    def __init__(self, message):
+        self.message = message
+        self.sent = None
+        self.text = None
+
+    async def set(self, text, **kwargs):
+        if self.sent is None:
+            self.sent = await self.message.reply_text(text, **kwargs)
+        elif text != self.text:
+            try:
+                await self.sent.edit_text(text, **kwargs)
+            except Exception as e:
+                logger.warning('Не удалось обновить статус, отправляю новым сообщением: %s', e)
+                self.sent = await self.message.reply_text(text, **kwargs)
+        self.text = text
+        return self.sent
@@ -0,0 +1,248 @@
+import asyncio
+import functools
+import threading
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Метрики бота в формате Prometheus (text exposition 0.0.4), без сторонних библиотек.
+# По умолчанию выключены: observe/inc/timer/timed сводятся к проверке одного флага, обёртки
+# обработчиков и репозиториев не ставятся вовсе. Включаются в config.py:
+#   METRICS_PORT = 9108              # порт HTTP-эндпоинта /metrics (None — метрики выключены)
+#   METRICS_HOST = '127.0.0.1'
+# Что собирается:
+#   bot_handler_seconds{handler, callback}  — обработчики bot.py; callback — тип callback_data (currency, category, ...)
+#   db_query_seconds{query}                 — методы репозиториев storage.py (ledger.get_balance, ...)
+#   db_statements_total{op}                 — SQL-операторы SQLite по типу (SELECT, INSERT, ...), через trace callback
+#   db_compaction_seconds                   — проход обслуживания базы (maintenance.compact)
+#   db_snapshot_seconds                     — снимок базы (maintenance.snapshot)
+#   ocr_stage_seconds{stage}                — скачивание, предобработка, QR, каждый проход Tesseract, разбор
+#   ocr_receipts_total{path}, ocr_ladder_total{step, side} — см. ocr.PATH_STATS и ocr.LADDER_STATS
+#   optimizer_stage_seconds{stage}          — этапы debts_optimizer
+#   *_queue_depth                           — очереди (апдейты PTB, чеки в пуле OCR, альбомы), считаются при запросе
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+HELP = {
+    'bot_handler_seconds': ('histogram', 'Время обработки апдейта обработчиком bot.py'),
+    'bot_handler_errors_total': ('counter', 'Исключения в обработчиках bot.py'),
+    'db_query_seconds': ('histogram', 'Время метода репозитория хранилища'),
+    'db_statements_total': ('counter', 'Выполненные SQL-операторы SQLite по типу'),
+    'db_compaction_seconds': ('histogram', 'Время прохода обслуживания базы (слияние долей, архив, ANALYZE/VACUUM)'),
+    'db_snapshot_seconds': ('histogram', 'Время снимка базы через online backup API'),
+    'ocr_stage_seconds': ('histogram', 'Время этапа распознавания чека'),
+    'ocr_receipts_total': ('counter', 'Распознанные чеки по пути (qr, ocr, failed)'),
+    'ocr_ladder_total': ('counter', 'На какой ступени лестницы размеров фото остановилось распознавание'),
+    'optimizer_stage_seconds': ('histogram', 'Время этапа оптимизатора долгов'),
+}
+
+_enabled = False
+_lock = threading.Lock()
+# name -> {labels: [bucket_counts, sum, count]}
+_histograms = {}
+# name -> {labels: value}
+_counters = {}
+# name -> (help, fn), fn() возвращает число или {labels: число}; вызывается только при запросе /metrics
+_gauges = {}
+_server = None
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def enabled():
+    return _enabled
+
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def observe(name, seconds, **labels):
+    if not _enabled:
+        return
+    key = _key(labels)
+    with _lock:
+        series = _histograms.setdefault(name, {})
+        state = series.get(key)
+        if state is None:
+            state = series[key] = [[0] * len(DEFAULT_BUCKETS), 0.0, 0]
+        i = bisect_left(DEFAULT_BUCKETS, seconds)
+        if i < len(DEFAULT_BUCKETS):
+            state[0][i] += 1
+        state[1] += seconds
+        state[2] += 1
+
+
+def inc(name, value=1, **labels):
+    if not _enabled:
+        return
+    key = _key(labels)
+    with _lock:
+        series = _counters.setdefault(name, {})
+        series[key] = series.get(key, 0) + value
+
+
+def register_gauge(name, help_text, fn):
+    _gauges[name] = (help_text, fn)
+
+
+class _Timer:
+    __slots__ = ('name', 'labels', 'started')
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+_NOOP = nullcontext()
+
+
+def timer(name, **labels):
+    """with metrics.timer('ocr_stage_seconds', stage='preprocess'): ..."""
+    if not _enabled:
+        return _NOOP
+    return _Timer(name, labels)
+
+
+def timed(name, **labels):
+    """Декоратор: время вызова функции (обычной или async) в гистограмму name."""
+    def decorator(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                if not _enabled:
+                    return await fn(*args, **kwargs)
+                started = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    observe(name, time.perf_counter() - started, **labels)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - started, **labels)
+        return wrapper
+    return decorator
+
+
+def instrument(obj, name, prefix):
+    """Оборачивает публичные async-методы объекта (репозитория) таймером name{query="prefix.method"}."""
+    for attr in dir(type(obj)):
+        if attr.startswith('_'):
+            continue
+        method = getattr(obj, attr)
+        if asyncio.iscoroutinefunction(method):
+            setattr(obj, attr, timed(name, query=f'{prefix}.{attr}')(method))
+    return obj
+
+
+# =========================
+# EXPOSITION
+# =========================
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels_text(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+def _header(lines, name, kind, help_text):
+    lines.append(f'# HELP {name} {help_text}')
+    lines.append(f'# TYPE {name} {kind}')
+
+
+def render():
+    """Все метрики в текстовом формате Prometheus."""
+    lines = []
+    with _lock:
+        histograms = {name: {k: (list(s[0]), s[1], s[2]) for k, s in series.items()} for name, series in _histograms.items()}
+        counters = {name: dict(series) for name, series in _counters.items()}
+
+    for name in sorted(histograms):
+        _header(lines, name, 'histogram', HELP.get(name, ('', name))[1])
+        for key, (buckets, total, count) in sorted(histograms[name].items()):
+            cumulative = 0
+            for le, n in zip(DEFAULT_BUCKETS, buckets):
+                cumulative += n
+                lines.append(f'{name}_bucket{_labels_text(key, [("le", le)])} {cumulative}')
+            lines.append(f'{name}_bucket{_labels_text(key, [("le", "+Inf")])} {count}')
+            lines.append(f'{name}_sum{_labels_text(key)} {total}')
+            lines.append(f'{name}_count{_labels_text(key)} {count}')
+
+    for name in sorted(counters):
+        _header(lines, name, 'counter', HELP.get(name, ('', name))[1])
+        for key, value in sorted(counters[name].items()):
+            lines.append(f'{name}{_labels_text(key)} {value}')
+
+    for name in sorted(_gauges):
+        help_text, fn = _gauges[name]
+        try:
+            value = fn()
+        except Exception:
+            continue
+        _header(lines, name, 'gauge', help_text)
+        if isinstance(value, dict):
+            for labels, v in sorted(value.items()):
+                lines.append(f'{name}{_labels_text(_key(dict(labels)))} {v}')
+        else:
+            lines.append(f'{name} {value}')
+
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(port, host='127.0.0.1'):
+    """Поднимает /metrics в фоновом потоке (сбор метрик включается вызовом enable)."""
+    global _server
+    if _server is not None:
+        return _server
+    _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=_server.serve_forever, name='metrics', daemon=True).start()
+    return _server
+
+
+def stop_server():
+    global _server
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
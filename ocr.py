@@ -1,13 +1,62 @@
 import os
 import re
-import cv2
-import pytesseract
-from PIL import Image
-import requests
+import math
+import time
+import asyncio
+import importlib
+import logging
+import tempfile
+from datetime import datetime
+from urllib.parse import parse_qs
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# OCR_DEBUG_DIR=img/debug в окружении — каждый воркер сохраняет бинаризованное изображение чека в свой файл
+# в этой папке (для подбора предобработки); по умолчанию ничего не пишется
+OCR_DEBUG_DIR = os.environ.get('OCR_DEBUG_DIR')
+
+# Тяжёлый стек распознавания (OpenCV с NumPy, pytesseract с PIL, requests) импортируется не при загрузке модуля,
+# а при первом обращении к нему. Основной процесс бота берёт из ocr только photo_ladder, record_ladder,
+# OCR_IN_FLIGHT и get_receipt_by_url_async, а сами разбор и скачивание идут в воркерах пула, поэтому
+# бот без фото чеков не платит за стек ни временем старта, ни памятью. Воркеры загружают его один раз
+# в init_worker. Замер: python bench_startup.py.
+OCR_STACK = ('cv2', 'pytesseract', 'requests')
+
+
+class _LazyModule:
+    """Модуль, который импортируется при первом обращении к его атрибуту."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+
+cv2 = _LazyModule('cv2')
+pytesseract = _LazyModule('pytesseract')
+requests = _LazyModule('requests')
+
+
+def load_ocr_stack():
+    """Импортирует весь стек распознавания сразу (в воркере — до первого чека, а не на нём)."""
+    for module in (cv2, pytesseract, requests):
+        module.load()
 
 
 def preprocess_image(image_path):
-    image = cv2.imread(image_path)
+    return preprocess_array(cv2.imread(image_path))
+
+
+def preprocess_array(image):
     gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
     gray = cv2.convertScaleAbs(gray, alpha=1.5, beta=0)
     gray = cv2.medianBlur(gray, 3)
@@ -48,40 +97,289 @@ def extract_total_amount(text):
     return None
 
 
-def process_receipt(image_path):
-    try:
-        processed_image = preprocess_image(image_path)
+OCR_PSM_MODES = [6, 4, 3]
+OCR_LANG = 'rus+eng'
+
+
+# =========================
+# OCR ENGINES
+# =========================
+# pytesseract на каждый вызов запускает процесс tesseract и заново грузит rus+eng traineddata,
+# а на чек приходится три прохода. TesserocrEngine держит инициализированный экземпляр Tesseract API
+# (C API через tesserocr) живым в процессе и только переключает режим сегментации между проходами.
+# В боте распознавание идёт в пуле процессов (create_worker_pool): у каждого воркера свой движок,
+# созданный один раз в init_worker. Если tesserocr не установлен, используется pytesseract.
+
+class OcrEngine:
+    name = None
+
+    def image_to_data(self, image, psm):
+        """Слова с рамками и уверенностью в формате pytesseract.image_to_data(output_type=DICT)."""
+        raise NotImplementedError
+
+
+class PytesseractEngine(OcrEngine):
+    name = 'pytesseract'
+
+    def image_to_data(self, image, psm):
+        return pytesseract.image_to_data(image, config=f'--psm {psm}', lang=OCR_LANG,
+                                         output_type=pytesseract.Output.DICT)
+
+
+class TesserocrEngine(OcrEngine):
+    name = 'tesserocr'
+
+    def __init__(self):
+        import tesserocr
+        self._tesserocr = tesserocr
+        self._api = tesserocr.PyTessBaseAPI(lang=OCR_LANG)
+
+    def image_to_data(self, image, psm):
+        tesserocr = self._tesserocr
+        RIL = tesserocr.RIL
+        height, width = image.shape[:2]
+        channels = 1 if image.ndim == 2 else image.shape[2]
+        self._api.SetPageSegMode(psm)
+        self._api.SetImageBytes(image.tobytes(), width, height, channels, width * channels)
+        self._api.Recognize()
+
+        data = {k: [] for k in ('level', 'block_num', 'par_num', 'line_num', 'word_num',
+                                'left', 'top', 'width', 'height', 'conf', 'text')}
+        block = par = line = word = 0
+        iterator = self._api.GetIterator()
+        if iterator is None:
+            return data
+        for w in tesserocr.iterate_level(iterator, RIL.WORD):
+            if w.IsAtBeginningOf(RIL.BLOCK):
+                block, par, line, word = block + 1, 0, 0, 0
+            if w.IsAtBeginningOf(RIL.PARA):
+                par, line, word = par + 1, 0, 0
+            if w.IsAtBeginningOf(RIL.TEXTLINE):
+                line, word = line + 1, 0
+            word += 1
+            box = w.BoundingBox(RIL.WORD)
+            if box is None:
+                continue
+            x1, y1, x2, y2 = box
+            data['level'].append(5)
+            data['block_num'].append(block)
+            data['par_num'].append(par)
+            data['line_num'].append(line)
+            data['word_num'].append(word)
+            data['left'].append(x1)
+            data['top'].append(y1)
+            data['width'].append(x2 - x1)
+            data['height'].append(y2 - y1)
+            data['conf'].append(w.Confidence(RIL.WORD))
+            data['text'].append(w.GetUTF8Text(RIL.WORD) or '')
+        return data
+
+    def close(self):
+        self._api.End()
+
+
+ENGINES = {
+    PytesseractEngine.name: PytesseractEngine,
+    TesserocrEngine.name: TesserocrEngine,
+}
+
+_engine = None
+
+
+def create_engine(name='auto'):
+    """Движок по имени ('tesserocr', 'pytesseract'); 'auto' — tesserocr, если он установлен."""
+    if name == 'auto':
+        try:
+            return TesserocrEngine()
+        except ImportError:
+            return PytesseractEngine()
+    if name not in ENGINES:
+        raise ValueError(f'Неизвестный OCR-движок: {name}')
+    return ENGINES[name]()
+
 
-        cv2.imwrite('img/processed_receipt.jpg', processed_image)
+def get_engine():
+    global _engine
+    if _engine is None:
+        _engine = create_engine(os.environ.get('OCR_ENGINE', 'auto'))
+    return _engine
 
-        configs = [
-            '--psm 6',
-            '--psm 4',
-            '--psm 3',
-        ]
 
-        all_text = ""
+def init_worker(engine_name='auto'):
+    """Инициализатор процесса пула: стек распознавания и движок загружаются один раз и живут, пока жив воркер."""
+    global _engine
+    load_ocr_stack()
+    _engine = create_engine(engine_name)
 
-        for config in configs:
-            text = pytesseract.image_to_string(processed_image, config=config, lang='rus+eng')
-            all_text += text + "\n"
 
-        pil_image = Image.fromarray(processed_image)
-        text_pil = pytesseract.image_to_string(pil_image, lang='rus+eng')
-        all_text += text_pil
+def create_worker_pool(workers=2, engine_name='auto'):
+    """Пул процессов для распознавания; процессы запускаются при первой задаче, а не при создании пула."""
+    from concurrent.futures import ProcessPoolExecutor
+    return ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(engine_name,))
 
-        total_amount = extract_total_amount(all_text)
 
-        if total_amount:
-            return total_amount
-        else:
-            return None
+def _stage(timings, stage, started):
+    """Дописывает (этап, секунды) в timings и возвращает новую отметку времени."""
+    now = time.perf_counter()
+    if timings is not None:
+        timings.append((stage, now - started))
+    return now
+
+
+def run_ocr_passes(processed_image, timings=None):
+    """Результаты image_to_data (слова с рамками и уверенностью) для каждого режима из OCR_PSM_MODES."""
+    engine = get_engine()
+    passes = []
+    for psm in OCR_PSM_MODES:
+        started = time.perf_counter()
+        passes.append(engine.image_to_data(processed_image, psm))
+        _stage(timings, f'tesseract_psm{psm}', started)
+    return passes
+
+
+def analyze_receipt(image_path, timings=None):
+    """Итог чека с уверенностью и позиции: {'total', 'confidence', 'items', 'consistent', 'source'} или None при ошибке.
+
+    Сначала ищется фискальный QR-код (source='qr', дополнительно 'timestamp' и 'fiscal'), и только без него — OCR.
+    В timings (список) дописываются длительности этапов: preprocess, qr, tesseract_psmN, extract.
+    """
+    try:
+        started = time.perf_counter()
+        image = cv2.imread(image_path)
+        processed_image = preprocess_array(image)
+        started = _stage(timings, 'preprocess', started)
+
+        fiscal = decode_fiscal_qr(image, processed_image)
+        started = _stage(timings, 'qr', started)
+        if fiscal:
+            return {
+                'total': fiscal['total'],
+                'confidence': 1.0,
+                'items': [],
+                'consistent': False,
+                'source': 'qr',
+                'timestamp': fiscal['timestamp'],
+                'fiscal': fiscal,
+            }
+
+        if OCR_DEBUG_DIR:
+            save_debug_image(processed_image)
+
+        passes = run_ocr_passes(processed_image, timings)
+        started = time.perf_counter()
+        receipt = analyze_passes(passes)
+        _stage(timings, 'extract', started)
+        receipt['source'] = 'ocr'
+        return receipt
 
     except Exception as e:
-        print(f"Ошибка при обработке изображения: {e}")
+        logger.exception('Ошибка при обработке изображения %s: %s', image_path, e)
         return None
 
 
+def save_debug_image(image):
+    """Пишет изображение в уникальный файл в OCR_DEBUG_DIR: параллельные воркеры не перезаписывают друг друга."""
+    os.makedirs(OCR_DEBUG_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix='.jpg', prefix='processed_', dir=OCR_DEBUG_DIR)
+    os.close(fd)
+    cv2.imwrite(path, image)
+    return path
+
+
+def process_receipt(image_path):
+    receipt = analyze_receipt(image_path)
+    if receipt and receipt['total']:
+        return receipt['total']
+    return None
+
+
+# =========================
+# FISCAL QR
+# =========================
+# На каждом российском кассовом чеке есть QR-код вида
+#   t=20240115T1530&s=1234.56&fn=9999078900012345&i=12345&fp=1234567890&n=1
+# где s — итоговая сумма, t — дата и время, fn/i/fp — номер ФН, номер документа и фискальный признак.
+# Декодирование занимает десятки миллисекунд против нескольких секунд на проходы Tesseract,
+# а сумма в нём точная, поэтому QR проверяется первым.
+
+# сколько раз сработал каждый путь и сколько времени он занял (от скачивания до результата);
+# считается в основном процессе в get_receipt_by_url_async, т.к. сам разбор идёт в воркерах
+PATH_STATS = {
+    'qr': {'count': 0, 'seconds': 0.0},
+    'ocr': {'count': 0, 'seconds': 0.0},
+    'failed': {'count': 0, 'seconds': 0.0},
+}
+
+_qr_detector = None
+
+
+def record_receipt(receipt, seconds):
+    if receipt is None or receipt['total'] is None:
+        path = 'failed'
+    else:
+        path = receipt.get('source', 'ocr')
+    PATH_STATS[path]['count'] += 1
+    PATH_STATS[path]['seconds'] += seconds
+    metrics.inc('ocr_receipts_total', path=path)
+    metrics.observe('ocr_stage_seconds', seconds, stage=f'total_{path}')
+    for stage, stage_seconds in (receipt or {}).get('timings', ()):
+        metrics.observe('ocr_stage_seconds', stage_seconds, stage=stage)
+
+
+def get_path_stats():
+    """Копия PATH_STATS с долей каждого пути."""
+    total = sum(s['count'] for s in PATH_STATS.values()) or 1
+    return {path: dict(s, share=s['count'] / total) for path, s in PATH_STATS.items()}
+
+
+def parse_fiscal_payload(payload):
+    """{'total', 'timestamp', 'fn', 'i', 'fp', 'n'} из строки фискального QR-кода или None, если это не он."""
+    if not payload:
+        return None
+    params = {k: v[0] for k, v in parse_qs(payload.strip()).items()}
+    if not {'t', 's', 'fn'} <= params.keys():
+        return None
+    try:
+        total = float(params['s'].replace(',', '.'))
+    except ValueError:
+        return None
+    # nan и inf float() принимает; у чека из QR уверенность 1.0, и подтверждение суммы не спрашивается
+    if not math.isfinite(total) or total <= 0:
+        return None
+    # strptime нестрог к числу цифр ('1530' как %H%M%S дало бы 15:03), поэтому формат выбираем по длине
+    fmt = '%Y%m%dT%H%M%S' if len(params['t']) == 15 else '%Y%m%dT%H%M'
+    try:
+        timestamp = datetime.strptime(params['t'], fmt)
+    except ValueError:
+        return None
+    return {
+        'total': round(total, 2),
+        'timestamp': timestamp,
+        'fn': params.get('fn'),
+        'i': params.get('i'),
+        'fp': params.get('fp'),
+        'n': params.get('n'),
+    }
+
+
+def decode_fiscal_qr(*images):
+    """Пробует декодировать фискальный QR на каждом из изображений (цветное, бинаризованное), результат parse_fiscal_payload."""
+    global _qr_detector
+    if _qr_detector is None:
+        _qr_detector = cv2.QRCodeDetector()
+    for image in images:
+        if image is None:
+            continue
+        try:
+            payload, _, _ = _qr_detector.detectAndDecode(image)
+        except cv2.error:
+            continue
+        fiscal = parse_fiscal_payload(payload)
+        if fiscal:
+            return fiscal
+    return None
+
+
 def extract_amounts_with_context(text):
     lines = text.split('\n')
     amount_candidates = []
@@ -116,16 +414,322 @@ def extract_amounts_with_context(text):
     return None
 
 
-def get_total_by_url(url):
+def download_image(url, image_path=None):
+    """Скачивает фото; без image_path — в уникальный файл в img/, чтобы параллельные воркеры не перезаписывали друг друга."""
     try:
         response = requests.get(url, stream=True)
-        os.makedirs('img', exist_ok=True)
-        image_path = 'img/image.jpg'
+        if image_path is None:
+            os.makedirs('img', exist_ok=True)
+            fd, image_path = tempfile.mkstemp(suffix='.jpg', prefix='receipt_', dir='img')
+            os.close(fd)
+        os.makedirs(os.path.dirname(image_path) or '.', exist_ok=True)
         with open(image_path, 'wb') as file:
             for chunk in response.iter_content(chunk_size=8192):
                 file.write(chunk)
-        total = process_receipt(image_path)
-        return total
+        return image_path
     except requests.exceptions.RequestException as e:
-        print(f"Error downloading image: {e}")
+        logger.error('Не удалось скачать фото чека: %s', e)
+        return None
+
+
+def get_total_by_url(url):
+    receipt = get_receipt_by_url(url)
+    return receipt['total'] if receipt else None
+
+
+def get_receipt_by_url(url):
+    """{'total', 'confidence', 'items', 'consistent'} по фото чека; позиции — только если сходятся с итогом."""
+    timings = []
+    started = time.perf_counter()
+    image_path = download_image(url)
+    _stage(timings, 'download', started)
+    if image_path is None:
         return None
+    try:
+        receipt = analyze_receipt(image_path, timings)
+    finally:
+        os.remove(image_path)
+    if receipt is not None:
+        # этапы меряются в воркере, а в метрики попадают в основном процессе (record_receipt)
+        receipt['timings'] = timings
+    return receipt
+
+
+# =========================
+# PHOTO RESOLUTION LADDER
+# =========================
+# Telegram хранит фото в нескольких размерах (PhotoSize по возрастанию). Распознавание начинается
+# с наименьшего размера, у которого длинная сторона не меньше min_side, и переходит к большему,
+# только если сумма распознана неуверенно. LADDER_STATS показывает, на каком размере
+# распознавание в итоге остановилось, — по нему подбирается min_side.
+
+LADDER_STATS = {}
+
+
+def photo_ladder(photo_sizes, min_side=800):
+    """Размеры фото для перебора: от наименьшего подходящего (длинная сторона >= min_side) до самого большого."""
+    sizes = sorted(photo_sizes, key=lambda p: p.width * p.height)
+    if not sizes:
+        return []
+    start = next((i for i, p in enumerate(sizes) if max(p.width, p.height) >= min_side), len(sizes) - 1)
+    return sizes[start:]
+
+
+def record_ladder(step, photo):
+    """Запоминает, какая ступень (0 — первая попытка) и какой размер понадобились для распознавания."""
+    key = (step, max(photo.width, photo.height))
+    LADDER_STATS[key] = LADDER_STATS.get(key, 0) + 1
+    metrics.inc('ocr_ladder_total', step=step, side=key[1])
+
+
+# сколько чеков сейчас отправлено в пул и ещё не распознано
+OCR_IN_FLIGHT = 0
+
+
+async def get_receipt_by_url_async(url, executor=None):
+    """get_receipt_by_url в пуле воркеров (create_worker_pool), не блокируя цикл событий бота."""
+    global OCR_IN_FLIGHT
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    OCR_IN_FLIGHT += 1
+    try:
+        receipt = await loop.run_in_executor(executor, get_receipt_by_url, url)
+    finally:
+        OCR_IN_FLIGHT -= 1
+    record_receipt(receipt, time.perf_counter() - started)
+    return receipt
+
+
+# =========================
+# ITEMISED RECEIPTS
+# =========================
+# Разбор чека по позициям идёт потоково по результату pytesseract.image_to_data:
+# слова (с рамками и уверенностью) склеиваются в строки по (block_num, par_num, line_num),
+# и каждая строка сразу классифицируется — итог, позиция с количеством, позиция с ценой или часть названия.
+# Весь текст заново не сканируется.
+
+AMOUNT_RE = re.compile(r'(\d+[.,]\d{2})')
+QTY_PRICE_RE = re.compile(r'(\d+(?:[.,]\d{1,3})?)\s*[xх×*]\s*(\d+[.,]\d{2})', re.IGNORECASE)
+TOTAL_KEYWORDS = ('итого', 'итог', 'всего', 'к оплате', 'total')
+SKIP_KEYWORDS = ('ндс', 'инн', 'кассир', 'смена', 'фн', 'фд', 'фп', 'кассовый', 'сдача', 'наличн', 'безналич', 'карт', 'скидк', 'чек')
+
+
+def _parse_money(s):
+    return float(s.replace(' ', '').replace(',', '.'))
+
+
+def iter_data_lines(data):
+    """Генератор строк из словаря image_to_data(output_type=DICT): список слов {text, conf, left, top, width, height}."""
+    current_key = None
+    words = []
+    for i, text in enumerate(data['text']):
+        text = (text or '').strip()
+        if not text:
+            continue
+        key = (data['block_num'][i], data['par_num'][i], data['line_num'][i])
+        if key != current_key and words:
+            yield words
+            words = []
+        current_key = key
+        words.append({
+            'text': text,
+            'conf': float(data['conf'][i]),
+            'left': data['left'][i],
+            'top': data['top'][i],
+            'width': data['width'][i],
+            'height': data['height'][i],
+        })
+    if words:
+        yield words
+
+
+def parse_receipt_lines(lines):
+    """Разбирает строки чека: {'items': [{name, quantity, price, amount}], 'total': float|None, 'consistent': bool}.
+
+    price — цена за единицу, amount — сумма по позиции. consistent — сумма позиций совпадает с итогом.
+    """
+    items = []
+    total = None
+    pending_name = []
+    expect_total = False
+
+    for words in lines:
+        text = ' '.join(w['text'] for w in words)
+        lower = text.lower()
+        amounts = AMOUNT_RE.findall(text)
+
+        if expect_total or any(k in lower for k in TOTAL_KEYWORDS):
+            if amounts:
+                total = _parse_money(amounts[-1])
+                # после итога идут оплата, НДС и фискальные данные — позиции там не встречаются
+                break
+            # сумма итога может стоять на следующей строке
+            expect_total = True
+            continue
+
+        if any(k in lower for k in SKIP_KEYWORDS):
+            pending_name = []
+            continue
+
+        qty_match = QTY_PRICE_RE.search(text)
+        if qty_match:
+            quantity = _parse_money(qty_match.group(1))
+            price = _parse_money(qty_match.group(2))
+            rest = AMOUNT_RE.findall(text[qty_match.end():])
+            amount = _parse_money(rest[-1]) if rest else round(quantity * price, 2)
+            name = text[:qty_match.start()].strip(' .=-')
+            name = name or ' '.join(pending_name)
+            items.append({'name': name or 'Позиция', 'quantity': quantity, 'price': price, 'amount': amount})
+            pending_name = []
+            continue
+
+        if amounts:
+            name = AMOUNT_RE.sub('', text).strip(' .=-*')
+            # строки без букв (номера, даты) — не позиции
+            if not re.search(r'[A-Za-zА-Яа-яЁё]', name) and not pending_name:
+                continue
+            amount = _parse_money(amounts[-1])
+            full_name = ' '.join(pending_name + ([name] if name else []))
+            items.append({'name': full_name or 'Позиция', 'quantity': 1.0, 'price': amount, 'amount': amount})
+            pending_name = []
+            continue
+
+        if re.search(r'[A-Za-zА-Яа-яЁё]', text):
+            # название позиции может занимать строку-две перед строкой с ценой
+            pending_name = (pending_name + [text.strip()])[-2:]
+
+    items_total = round(sum(i['amount'] for i in items), 2)
+    consistent = total is not None and bool(items) and abs(items_total - total) <= 0.01
+    return {'items': items, 'total': total, 'consistent': consistent}
+
+
+def process_receipt_items(image_path):
+    """Позиции и итог чека по фото (см. parse_receipt_lines) или None при ошибке."""
+    receipt = analyze_receipt(image_path)
+    if receipt is None:
+        return None
+    return {'items': receipt['items'], 'total': receipt['total'], 'consistent': receipt['consistent']}
+
+
+# =========================
+# TOTAL AMOUNT SCORING
+# =========================
+# Вместо "самое большое число во всём тексте" каждое число-кандидат оценивается по словам image_to_data:
+#   - уверенность Tesseract в слове;
+#   - близость к ключевому слову итога (та же строка или строка ниже, по рамкам слов);
+#   - выравнивание по правому краю (итог обычно в правой колонке);
+#   - согласованность — в скольких проходах (psm) встретилась та же сумма.
+# Длинные цифровые строки (ИНН, штрихкоды, номера ФН) отбрасываются, строки с НДС/сдачей штрафуются.
+# Уверенность результата учитывает отрыв от второго кандидата и совпадение с суммой позиций.
+
+SCORE_WEIGHTS = {'keyword': 0.45, 'conf': 0.25, 'right': 0.15, 'consistency': 0.15}
+MAX_INTEGER_DIGITS = 7
+PENALTY_KEYWORDS = ('ндс', 'инн', 'сдача', 'скидк', 'получено', 'бонус', 'баллы')
+KEYWORD_STEMS = ('итог', 'всего', 'оплат', 'total', 'сумма')
+
+
+def _keyword_boxes(lines):
+    boxes = []
+    for words in lines:
+        for w in words:
+            lower = w['text'].lower()
+            if any(stem in lower for stem in KEYWORD_STEMS):
+                boxes.append(w)
+    return boxes
+
+
+def _keyword_proximity(word, boxes):
+    """1.0 — на одной строке правее ключевого слова, плавно убывает с расстоянием по вертикали."""
+    best = 0.0
+    center = word['top'] + word['height'] / 2
+    for kw in boxes:
+        if word['left'] < kw['left']:
+            continue
+        height = max(kw['height'], word['height'], 1)
+        dy = center - (kw['top'] + kw['height'] / 2)
+        if dy < -height / 2:
+            # выше ключевого слова итог не бывает
+            continue
+        best = max(best, 1.0 / (1.0 + max(dy, 0) / (1.5 * height)) ** 2)
+    return best
+
+
+def score_amount_candidates(passes):
+    """Список кандидатов {'amount', 'score', 'passes'} по убыванию score."""
+    by_amount = {}
+    for pass_index, data in enumerate(passes):
+        lines = list(iter_data_lines(data))
+        if not lines:
+            continue
+        page_right = max(w['left'] + w['width'] for words in lines for w in words) or 1
+        boxes = _keyword_boxes(lines)
+        for words in lines:
+            line_lower = ' '.join(w['text'] for w in words).lower()
+            penalty = 0.5 if any(k in line_lower for k in PENALTY_KEYWORDS) else 1.0
+            for w in words:
+                match = AMOUNT_RE.search(w['text'])
+                if not match:
+                    continue
+                integer_part = re.match(r'\d+', match.group(1)).group(0)
+                # число, приклеенное к длинной цифровой строке, — ИНН/штрихкод, а не сумма
+                digits_around = re.search(r'\d*' + re.escape(match.group(1)), w['text']).group(0)
+                if len(integer_part) > MAX_INTEGER_DIGITS or len(digits_around) > len(match.group(1)):
+                    continue
+                amount = _parse_money(match.group(1))
+                if amount <= 0:
+                    continue
+                score = penalty * (
+                    SCORE_WEIGHTS['keyword'] * _keyword_proximity(w, boxes) +
+                    SCORE_WEIGHTS['conf'] * max(w['conf'], 0) / 100.0 +
+                    SCORE_WEIGHTS['right'] * min((w['left'] + w['width']) / page_right, 1.0)
+                )
+                key = int(round(amount * 100))
+                cand = by_amount.setdefault(key, {'amount': amount, 'score': 0.0, 'passes': set()})
+                cand['score'] = max(cand['score'], score)
+                cand['passes'].add(pass_index)
+
+    candidates = []
+    for cand in by_amount.values():
+        consistency = len(cand['passes']) / len(passes)
+        candidates.append({
+            'amount': cand['amount'],
+            'score': cand['score'] + SCORE_WEIGHTS['consistency'] * consistency,
+            'passes': len(cand['passes']),
+        })
+    candidates.sort(key=lambda c: (-c['score'], -c['amount']))
+    return candidates
+
+
+def select_total(passes):
+    """{'amount', 'confidence'} лучшего кандидата или None; confidence в [0, 1]."""
+    candidates = score_amount_candidates(passes)
+    if not candidates:
+        return None
+    best = candidates[0]
+    margin = best['score'] - candidates[1]['score'] if len(candidates) > 1 else best['score']
+    confidence = best['score'] * (0.6 + 0.4 * min(1.0, margin / 0.15))
+    return {'amount': best['amount'], 'confidence': round(min(confidence, 1.0), 3)}
+
+
+def analyze_passes(passes):
+    """Итог и позиции по уже выполненным проходам OCR (см. analyze_receipt)."""
+    selected = select_total(passes)
+    total = selected['amount'] if selected else None
+    confidence = selected['confidence'] if selected else 0.0
+
+    items = []
+    consistent = False
+    for data in passes:
+        parsed = parse_receipt_lines(iter_data_lines(data))
+        if not parsed['consistent']:
+            continue
+        if total is None or abs(parsed['total'] - total) <= 0.01:
+            items = parsed['items']
+            consistent = True
+            if total is None:
+                total = parsed['total']
+            # позиции сошлись с итогом — сумма подтверждена независимо
+            confidence = max(confidence, 0.95)
+            break
+
+    return {'total': total, 'confidence': confidence, 'items': items, 'consistent': consistent}
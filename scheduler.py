@@ -0,0 +1,133 @@
+import asyncio
+import logging
+from collections import deque
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+import metrics
+
+# Честное планирование апдейтов между чатами.
+# По умолчанию Application обрабатывает апдейты строго по одному, и группа, которая шлёт альбомы чеков
+# или запускает /optimize, задерживает всех остальных. Просто включить concurrent_updates нельзя:
+# диалог создания платежа (user_states, pending_payment) рассчитан на то, что апдейты одного чата
+# обрабатываются по порядку.
+# FairUpdateProcessor:
+#   - у каждого чата своя очередь, апдейты одного чата обрабатываются строго по одному и по порядку;
+#   - разные чаты обрабатываются параллельно, не больше workers одновременно;
+#   - чаты с ожидающими апдейтами стоят в кольце (round-robin): чат получает слот на один апдейт
+#     и возвращается в конец кольца, поэтому шумный чат не может вытеснить тихие;
+#   - очередь чата ограничена chat_queue_limit, лишние апдейты отбрасываются с предупреждением в лог.
+# Апдейты без чата (например, inline-запросы) упорядочиваются по пользователю.
+
+logger = logging.getLogger(__name__)
+
+# семафор BaseUpdateProcessor ограничивает апдейты, которые уже приняты в очереди, а не выполняемые —
+# параллельность задаёт workers, поэтому здесь только защита от неограниченного роста
+_ACCEPTED_LIMIT = 100_000
+
+
+def update_key(update):
+    """Ключ очереди: id чата, иначе id пользователя, иначе None (без упорядочивания)."""
+    if isinstance(update, Update):
+        if update.effective_chat is not None:
+            return ('chat', update.effective_chat.id)
+        if update.effective_user is not None:
+            return ('user', update.effective_user.id)
+    return None
+
+
+class FairUpdateProcessor(BaseUpdateProcessor):
+    __slots__ = ('workers', 'chat_queue_limit', '_queues', '_ready', '_active', '_tasks', 'dropped')
+
+    def __init__(self, workers=8, chat_queue_limit=50):
+        super().__init__(max_concurrent_updates=_ACCEPTED_LIMIT)
+        if workers < 1:
+            raise ValueError('workers должно быть не меньше 1')
+        self.workers = workers
+        self.chat_queue_limit = chat_queue_limit
+        # ключ чата -> deque[(coroutine, future)]; ключ есть, пока у чата есть ожидающие или выполняемый апдейт
+        self._queues = {}
+        # кольцо чатов, у которых есть ожидающие апдейты и нет выполняемого
+        self._ready = deque()
+        self._active = 0
+        self._tasks = set()
+        self.dropped = 0
+
+    @property
+    def pending(self):
+        return sum(len(q) for q in self._queues.values())
+
+    @property
+    def chats(self):
+        return len(self._queues)
+
+    async def do_process_update(self, update, coroutine):
+        key = update_key(update)
+        if key is None:
+            # апдейт без чата и пользователя ни с чем не упорядочивается
+            key = ('update', id(coroutine))
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+            self._ready.append(key)
+        elif len(queue) >= self.chat_queue_limit:
+            coroutine.close()
+            self.dropped += 1
+            metrics.inc('scheduler_dropped_total')
+            logger.warning('Очередь %s переполнена (%s апдейтов), апдейт отброшен', key, len(queue))
+            return
+        future = asyncio.get_running_loop().create_future()
+        queue.append((coroutine, future))
+        self._pump()
+        await future
+
+    def _pump(self):
+        while self._active < self.workers and self._ready:
+            key = self._ready.popleft()
+            self._active += 1
+            task = asyncio.create_task(self._run_next(key))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run_next(self, key):
+        queue = self._queues.get(key)
+        if not queue:
+            # очереди сброшены в shutdown
+            self._active -= 1
+            return
+        coroutine, future = queue.popleft()
+        try:
+            await coroutine
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(None)
+        finally:
+            self._active -= 1
+            if queue:
+                # следующий апдейт этого чата — в конец кольца, после остальных ожидающих чатов
+                self._ready.append(key)
+            else:
+                self._queues.pop(key, None)
+            self._pump()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        for queue in self._queues.values():
+            for coroutine, future in queue:
+                coroutine.close()
+                if not future.done():
+                    future.cancel()
+            queue.clear()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._queues.clear()
+        self._ready.clear()
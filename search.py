@@ -0,0 +1,122 @@
+import re
+from datetime import date
+
+# Поиск по истории платежей (/find такси вт >500).
+# Текст запроса ищется по названию платежа, категории и имени плательщика; каждое слово — префикс ("такс"
+# найдёт "такси"), все слова должны встретиться. Остальное в запросе — фильтры:
+#   14.07 или 14.07.2024        — день; две даты или 01.07-15.07 — период включительно
+#   пн ... вс, понедельник ...  — день недели ("такси во вторник" -> /find такси вт)
+#   >500, <1000, 500-1000       — сумма платежа
+# SQLite: FTS5-таблица expense_fts (rowid = expense.id, колонки name, category, payer) с префиксными
+# индексами на 2 и 3 символа; её синхронизируют триггеры на expense (вставка, изменение, удаление — в том числе
+# перенос в архив), category и user (переименование), поэтому запросы не сканируют expense и на десятках
+# тысяч платежей отвечают за миллисекунды. Для уже существующей базы индекс заполняется при создании таблицы.
+# PostgreSQL: to_tsvector('simple', ...) по тем же полям и to_tsquery с префиксами "слово:*".
+# Результаты — от новых к старым, страницами по PAGE_SIZE; листание — inline-кнопками.
+
+PAGE_SIZE = 10
+
+WEEKDAYS = {
+    'пн': 1, 'понедельник': 1, 'вт': 2, 'вторник': 2, 'ср': 3, 'среда': 3, 'среду': 3,
+    'чт': 4, 'четверг': 4, 'пт': 5, 'пятница': 5, 'пятницу': 5,
+    'сб': 6, 'суббота': 6, 'субботу': 6, 'вс': 0, 'воскресенье': 0,
+}
+
+_DATE = r'(\d{1,2})\.(\d{1,2})(?:\.(\d{2}|\d{4}))?'
+_DATE_RE = re.compile(rf'^{_DATE}$')
+_DATE_RANGE_RE = re.compile(rf'^{_DATE}-{_DATE}$')
+_AMOUNT_RE = re.compile(r'^([<>])=?(\d+(?:[.,]\d+)?)$')
+_AMOUNT_RANGE_RE = re.compile(r'^(\d+(?:[.,]\d+)?)-(\d+(?:[.,]\d+)?)$')
+_WORD_RE = re.compile(r'\w+')
+
+
+class SearchQuery:
+    def __init__(self):
+        self.terms = []
+        self.date_from = None  # 'YYYY-MM-DD'
+        self.date_to = None
+        self.weekday = None    # 0 — воскресенье, как strftime('%w')
+        self.amount_min = None
+        self.amount_max = None
+
+    def filters(self):
+        """Параметры для ExpenseRepository.search."""
+        return {
+            'date_from': self.date_from, 'date_to': self.date_to, 'weekday': self.weekday,
+            'amount_min': self.amount_min, 'amount_max': self.amount_max,
+        }
+
+    def is_empty(self):
+        return not self.terms and not any(v is not None for v in self.filters().values())
+
+
+def _date(day, month, year, today):
+    year = int(year) if year else today.year
+    if year < 100:
+        year += 2000
+    try:
+        return date(year, int(month), int(day)).isoformat()
+    except ValueError:
+        raise ValueError(f'Некорректная дата "{day}.{month}"')
+
+
+def _number(value):
+    return float(value.replace(',', '.'))
+
+
+def parse_query(text, today=None):
+    """Текст после /find -> SearchQuery; ValueError на некорректный фильтр."""
+    today = today or date.today()
+    query = SearchQuery()
+    dates = []
+    for token in (text or '').lower().split():
+        m = _DATE_RANGE_RE.match(token)
+        if m:
+            dates += [_date(*m.groups()[:3], today), _date(*m.groups()[3:], today)]
+            continue
+        m = _DATE_RE.match(token)
+        if m:
+            dates.append(_date(*m.groups(), today))
+            continue
+        if token in WEEKDAYS:
+            query.weekday = WEEKDAYS[token]
+            continue
+        m = _AMOUNT_RE.match(token)
+        if m:
+            if m.group(1) == '>':
+                query.amount_min = _number(m.group(2))
+            else:
+                query.amount_max = _number(m.group(2))
+            continue
+        m = _AMOUNT_RANGE_RE.match(token)
+        if m:
+            query.amount_min, query.amount_max = sorted((_number(m.group(1)), _number(m.group(2))))
+            continue
+        query.terms.extend(_WORD_RE.findall(token))
+    if len(dates) > 2:
+        raise ValueError('Укажите не больше двух дат')
+    if dates:
+        query.date_from, query.date_to = min(dates), max(dates)
+    return query
+
+
+def fts_match(terms):
+    """Слова -> выражение MATCH для FTS5: '"такси"* AND "аэро"*' (кавычки — чтобы слова не читались как операторы)."""
+    return ' AND '.join('"' + term.replace('"', '""') + '"*' for term in terms)
+
+
+def pg_tsquery(terms):
+    """Слова -> to_tsquery('simple', ...): 'такси:* & аэро:*'."""
+    return ' & '.join(term.replace("'", '') + ':*' for term in terms)
+
+
+def format_results(rows, page, has_next):
+    """rows — ExpenseRepository.search: (id, paid_date, name, amount, currency, payer_name, category_name)."""
+    if not rows:
+        return 'Ничего не найдено' if page == 0 else 'Больше ничего не найдено'
+    start = page * PAGE_SIZE
+    lines = [f'Найдено: {start + 1}–{start + len(rows)}' + (' …' if has_next else '')]
+    for _, paid_date, name, amount, currency, payer_name, category_name in rows:
+        lines.append(f"\n• {paid_date or ''} | {payer_name or '?'} | {category_name or 'Без категории'}")
+        lines.append(f'   {amount:.2f} {currency} — {name}')
+    return '\n'.join(lines)
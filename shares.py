@@ -0,0 +1,158 @@
+import math
+import re
+
+import split
+
+# Разбор ответа на сообщение "Платеж создан!" с долями нескольких участников сразу.
+# Синтаксис (элементы через запятую или с новой строки):
+#   500                        — моя доля (как раньше)
+#   @anna 500, @boris 700      — явные доли указанных участников
+#   @anna 500, @boris, я       — у кого сумма не указана, делят остаток платежа поровну
+#   @boris x2, @vova, я        — остаток делится по весам: у boris вдвое большая доля (по умолчанию вес 1)
+# Вместо @username можно выбрать участника через упоминание (text_mention) — тогда цель задаётся его именем.
+# Себя можно обозначить как "я", "мне", "me" или "@me".
+# Остаток = сумма платежа - уже записанные доли - явно указанные доли.
+# Если платёж создан по чеку с позициями, можно забрать позиции целиком: "#1 #3" — доля равна их сумме.
+
+SELF = 'я'
+SELF_ALIASES = {'я', 'мне', 'меня', 'me', '@me'}
+
+_AMOUNT_RE = re.compile(r'(?<![\w@])(\d+(?:[.,]\d{1,2})?)(?![\w])')
+# вес: x2, х2 (кириллица), ×1.5, *3
+_WEIGHT_RE = re.compile(r'(?:^|\s)[xх×*]\s?(\d+(?:[.,]\d+)?)(?=\s|$)', re.IGNORECASE)
+
+
+class ShareParseError(ValueError):
+    pass
+
+
+class ShareLimitError(Exception):
+    """Доли превышают сумму платежа."""
+
+    def __init__(self, total_cents, existing_cents, requested_cents):
+        self.total_cents = total_cents
+        self.existing_cents = existing_cents
+        self.requested_cents = requested_cents
+        super().__init__(
+            f'Доли превышают сумму платежа: сумма {total_cents / 100:.2f}, '
+            f'уже записано {existing_cents / 100:.2f}, запрошено {requested_cents / 100:.2f}'
+        )
+
+    @property
+    def available_cents(self):
+        return max(self.total_cents - self.existing_cents, 0)
+
+
+class ItemClaimError(Exception):
+    """Позиция чека не найдена или уже выбрана другим участником."""
+    pass
+
+
+_to_cents = split.to_cents
+
+
+def parse_amount(s):
+    """Число из строки пользователя ('1 200,50' -> 1200.5) или ValueError.
+
+    float() принимает и 'nan', 'inf', '1e400' — такие значения дальше ломают перевод в копейки, поэтому отклоняются здесь.
+    """
+    value = float(s.replace(' ', '').replace(',', '.').strip())
+    if not math.isfinite(value):
+        raise ValueError(f'Некорректная сумма: {s}')
+    return value
+
+
+def parse_share_text(text):
+    """Возвращает список (target, amount, weight).
+
+    target: '@username', SELF или имя; amount: float или None (делит остаток); weight: вес при делении остатка.
+    """
+    items = []
+    # запятая перед цифрой — десятичный разделитель ("700,50"), а не разделитель элементов
+    for part in re.split(r'[;\n]+|,(?!\d)', text):
+        part = part.strip()
+        if not part:
+            continue
+        weight = 1
+        weights = _WEIGHT_RE.findall(part)
+        if len(weights) > 1:
+            raise ShareParseError(f'Несколько весов в "{part}"')
+        if weights:
+            weight = float(weights[0].replace(',', '.'))
+            if weight <= 0:
+                raise ShareParseError(f'Вес должен быть больше 0: "{part}"')
+            part = _WEIGHT_RE.sub(' ', part, count=1).strip()
+        amounts = _AMOUNT_RE.findall(part)
+        if len(amounts) > 1:
+            raise ShareParseError(f'Несколько сумм в "{part}"')
+        if amounts and weights:
+            raise ShareParseError(f'Укажите либо сумму, либо вес: "{part}"')
+        amount = None
+        target = part
+        if amounts:
+            amount = parse_amount(amounts[0])
+            if amount <= 0:
+                raise ShareParseError(f'Сумма должна быть больше 0: "{part}"')
+            target = _AMOUNT_RE.sub('', part, count=1).strip()
+        if not target:
+            target = SELF
+        elif target.lower() in SELF_ALIASES:
+            target = SELF
+        items.append((target, amount, weight))
+    if not items:
+        raise ShareParseError('Пустой ответ')
+    targets = [t for t, _, _ in items]
+    if len(set(targets)) != len(targets):
+        raise ShareParseError('Участник указан несколько раз')
+    return items
+
+
+def is_single_amount(text):
+    try:
+        parse_amount(text)
+        return True
+    except ValueError:
+        return False
+
+
+def check_share_limit(total, existing, new_amounts):
+    """Проверяет, что уже записанные и новые доли не превышают сумму платежа; суммы в рублях (float)."""
+    total_cents = _to_cents(total)
+    existing_cents = _to_cents(existing or 0)
+    requested_cents = sum(_to_cents(a) for a in new_amounts)
+    if existing_cents + requested_cents > total_cents:
+        raise ShareLimitError(total_cents, existing_cents, requested_cents)
+
+
+def resolve_amounts(items, total, existing):
+    """Подставляет суммы участникам без явной суммы: остаток делится по весам (split.split_amount).
+
+    items — [(key, amount or None, weight)], возвращает [(key, amount)].
+    """
+    total_cents = _to_cents(total)
+    existing_cents = _to_cents(existing or 0)
+    explicit_cents = sum(_to_cents(a) for _, a, _ in items if a is not None)
+    if existing_cents + explicit_cents > total_cents:
+        raise ShareLimitError(total_cents, existing_cents, explicit_cents)
+
+    weighted = [(k, w) for k, a, w in items if a is None]
+    result = {k: a for k, a, _ in items if a is not None}
+    if weighted:
+        rest = total_cents - existing_cents - explicit_cents
+        if rest <= 0:
+            raise ShareLimitError(total_cents, existing_cents, explicit_cents + len(weighted))
+        result.update(split.split_amount(split.from_cents(rest), [k for k, _ in weighted], dict(weighted)))
+    return [(k, result[k]) for k, _, _ in items if result.get(k, 0) > 0]
+
+
+_CLAIM_RE = re.compile(r'^\s*(#\d+[\s,;]*)+$')
+
+
+def parse_item_claims(text):
+    """Номера позиций из ответа вида "#1 #3" или None, если это не выбор позиций."""
+    if not _CLAIM_RE.match(text):
+        return None
+    positions = [int(p) for p in re.findall(r'#(\d+)', text)]
+    if len(set(positions)) != len(positions):
+        raise ShareParseError('Позиция указана несколько раз')
+    return positions
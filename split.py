@@ -0,0 +1,55 @@
+from fractions import Fraction
+
+# Автоматическое распределение суммы платежа между участниками.
+# Все расчёты — в целых копейках: каждому достаётся floor(total * w / W), а оставшиеся копейки
+# раздаются по одной участникам с наибольшей дробной частью (при равенстве — в порядке списка).
+# Поэтому сумма долей всегда в точности равна сумме платежа, а результат детерминирован.
+# Веса считаются через Fraction от десятичной записи веса (Fraction(str(w))): Fraction(0.1) — это точное двоичное
+# значение float 0.1, а Fraction('0.1') — ровно 1/10, поэтому веса 0.1 и 0.3 делят сумму ровно 1:3.
+# Доли из ответа на платёж (shares.resolve_amounts) считаются здесь, через split_amount.
+
+
+def to_cents(x):
+    return int(round(float(x) * 100))
+
+
+def from_cents(c):
+    return round(c / 100.0, 2)
+
+
+def split_cents(total_cents, weights):
+    """Делит total_cents по весам.
+
+    weights — [(key, weight), ...], ключи уникальны. Возвращает [(key, cents), ...] в том же порядке.
+    """
+    if total_cents < 0:
+        raise ValueError('Сумма не может быть отрицательной')
+    if not weights:
+        if total_cents:
+            raise ValueError('Нет участников для распределения суммы')
+        return []
+    ws = [Fraction(str(w)) for _, w in weights]
+    if any(w < 0 for w in ws):
+        raise ValueError('Вес участника не может быть отрицательным')
+    total_weight = sum(ws)
+    if total_weight == 0:
+        raise ValueError('Сумма весов участников должна быть больше 0')
+
+    exact = [total_cents * w / total_weight for w in ws]
+    cents = [int(e) for e in exact]
+    rest = total_cents - sum(cents)
+    # кому достанутся лишние копейки: по убыванию дробной части, при равенстве — по порядку
+    order = sorted(range(len(weights)), key=lambda i: (-(exact[i] - cents[i]), i))
+    for i in order[:rest]:
+        cents[i] += 1
+    return [(key, c) for (key, _), c in zip(weights, cents)]
+
+
+def split_amount(total, participants, weights=None):
+    """Делит сумму total (в рублях) между participants по весам weights — {key: weight}, по умолчанию 1 у всех.
+
+    Возвращает [(key, amount)] в порядке participants; нулевые доли не возвращаются.
+    """
+    weights = weights or {}
+    base = split_cents(to_cents(total), [(k, weights.get(k, 1)) for k in participants])
+    return [(k, from_cents(c)) for k, c in base if c > 0]
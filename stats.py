@@ -0,0 +1,165 @@
+import re
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+
+# Статистика трат (/stats).
+# Запросы к сырым платежам и долям растут вместе с историей поездки, поэтому траты хранятся ещё и в дневных
+# сводках spending_daily: строка на (мероприятие, день, участник, категория, валюта) с суммами
+#   spent — сколько участник потратил на себя: его доли плюс остаток платежа, не разделённый на доли, у плательщика;
+#   paid  — сколько он заплатил как плательщик.
+# Сводки обновляются в той же транзакции, что и запись платежа или долей (ExpenseRepository.create, create_many,
+# add_shares, claim_items), частичные погашения (apply_allocations) и архив их не меняют. Для уже существующей
+# базы сводки строятся один раз при создании таблицы (StatsRepository.rebuild).
+# Отчёт /stats читает только сводки, поэтому его стоимость зависит от числа дней и категорий, а не платежей.
+
+UNKNOWN_DAY = ''
+NO_CATEGORY = 0
+TOP_CATEGORIES = 5
+MAX_DAYS_SHOWN = 31
+BAR_WIDTH = 12
+
+_DAYS_RE = re.compile(r'^(\d+)\s*[dд]$', re.IGNORECASE)
+_DATE_RE = re.compile(r'^(\d{1,2})\.(\d{1,2})(?:\.(\d{2}|\d{4}))?$')
+
+
+def day_key(paid_date):
+    """'15.07.2024 13:05' -> '2024-07-15'; нераспознанная дата -> UNKNOWN_DAY."""
+    try:
+        return datetime.strptime((paid_date or '').strip()[:10], '%d.%m.%Y').strftime('%Y-%m-%d')
+    except ValueError:
+        return UNKNOWN_DAY
+
+
+def _currency(currency):
+    return (currency or 'RUB').strip().upper() or 'RUB'
+
+
+def rollup_deltas(expense, participant_shares, include_payment=True):
+    """Изменения сводок от платежа и/или его новых долей.
+
+    expense — (event_id, paid_date, payer_id, category_id, currency, amount);
+    participant_shares — [(user_id, amount), ...]; include_payment=False — только доли уже записанного платежа.
+    Возвращает [(event_id, day, user_id, category_id, currency, spent, paid), ...].
+    """
+    event_id, paid_date, payer_id, category_id, currency, amount = expense
+    base = (event_id, day_key(paid_date))
+    tail = (category_id or NO_CATEGORY, _currency(currency))
+    deltas = defaultdict(lambda: [0.0, 0.0])
+    if include_payment:
+        deltas[payer_id][0] += amount
+        deltas[payer_id][1] += amount
+    for user_id, share in participant_shares:
+        # доля переходит из "остатка" плательщика к участнику
+        deltas[user_id][0] += share
+        deltas[payer_id][0] -= share
+    return [base + (user_id,) + tail + (round(spent, 2), round(paid, 2))
+            for user_id, (spent, paid) in deltas.items() if round(spent, 2) or round(paid, 2)]
+
+
+def merge_deltas(rows, into=None):
+    """Суммирует строки rollup_deltas по ключу: {(event_id, day, user_id, category_id, currency): [spent, paid]}."""
+    into = into if into is not None else defaultdict(lambda: [0.0, 0.0])
+    for *key, spent, paid in rows:
+        acc = into[tuple(key)]
+        acc[0] += spent
+        acc[1] += paid
+    return into
+
+
+# =========================
+# REPORT
+# =========================
+
+def parse_period(args, today=None):
+    """Аргументы /stats -> (для всех участников, date_from, date_to); даты — 'YYYY-MM-DD' или None.
+
+    'все' / 'all' — по всем участникам; '7d' / '7д' — последние 7 дней; '01.07' или '01.07.2024' —
+    с этой даты, вторая дата — по неё включительно. ValueError на непонятный аргумент.
+    """
+    today = today or date.today()
+    everyone = False
+    dates = []
+    for arg in args:
+        arg = arg.strip().lower()
+        if arg in ('все', 'all'):
+            everyone = True
+            continue
+        m = _DAYS_RE.match(arg)
+        if m:
+            days = int(m.group(1))
+            if days < 1:
+                raise ValueError('Число дней должно быть больше 0')
+            dates = [today - timedelta(days=days - 1), today]
+            continue
+        m = _DATE_RE.match(arg)
+        if not m:
+            raise ValueError(f'Не понимаю "{arg}"')
+        year = int(m.group(3)) if m.group(3) else today.year
+        if year < 100:
+            year += 2000
+        try:
+            dates.append(date(year, int(m.group(2)), int(m.group(1))))
+        except ValueError:
+            raise ValueError(f'Некорректная дата "{arg}"')
+    if len(dates) > 2:
+        raise ValueError('Укажите не больше двух дат')
+    date_from = dates[0].isoformat() if dates else None
+    date_to = dates[1].isoformat() if len(dates) > 1 else None
+    if date_from and date_to and date_from > date_to:
+        date_from, date_to = date_to, date_from
+    return everyone, date_from, date_to
+
+
+def format_period(date_from, date_to):
+    """' (01.07.2024 — 15.07.2024)' для заголовка отчёта; '' без ограничений."""
+    if not date_from and not date_to:
+        return ''
+    start = _fmt_date(date_from) if date_from else '…'
+    end = _fmt_date(date_to) if date_to else 'сегодня'
+    return f' ({start} — {end})'
+
+
+def _fmt_date(day):
+    return datetime.strptime(day, '%Y-%m-%d').strftime('%d.%m.%Y')
+
+
+def _fmt_day(day):
+    return datetime.strptime(day, '%Y-%m-%d').strftime('%d.%m') if day else 'без даты'
+
+
+def build_report(rows, categories, title, top=TOP_CATEGORIES, max_days=MAX_DAYS_SHOWN):
+    """rows — StatsRepository.get_daily: (day, category_id, currency, spent, paid); categories — {id: name}."""
+    if not rows:
+        return f'{title}\n\nТрат за этот период нет'
+    totals = defaultdict(lambda: [0.0, 0.0])
+    by_category = defaultdict(float)
+    by_day = defaultdict(float)
+    for day, category_id, currency, spent, paid in rows:
+        totals[currency][0] += spent
+        totals[currency][1] += paid
+        by_category[(currency, category_id)] += spent
+        by_day[(currency, day)] += spent
+
+    lines = [title]
+    for currency in sorted(totals):
+        spent, paid = totals[currency]
+        lines.append(f'\n— {currency} —')
+        lines.append(f'Потрачено: {spent:.2f}, оплачено: {paid:.2f}')
+
+        cats = sorted(((total, cid) for (cur, cid), total in by_category.items() if cur == currency and round(total, 2)),
+                      reverse=True)
+        if cats:
+            lines.append('Топ категорий:')
+            for total, cid in cats[:top]:
+                name = categories.get(cid, 'Без категории')
+                share = total * 100 / spent if spent else 0
+                lines.append(f'  {name}: {total:.2f} ({share:.0f}%)')
+
+        days = sorted((day, total) for (cur, day), total in by_day.items() if cur == currency)
+        if days:
+            peak = max(abs(total) for _, total in days) or 1
+            lines.append('По дням:' if len(days) <= max_days else f'По дням (последние {max_days}):')
+            for day, total in days[-max_days:]:
+                bar = '▇' * max(round(abs(total) / peak * BAR_WIDTH), 1 if total else 0)
+                lines.append(f'  {_fmt_day(day)} {bar} {total:.2f}')
+    return '\n'.join(lines)
@@ -0,0 +1,2249 @@
+import asyncio
+import functools
+import os
+import sqlite3
+import logging
+import urllib.parse
+from itertools import groupby
+
+import debts_optimizer
+import diagnostics
+import journal
+import metrics
+import search
+import shares
+import stats
+
+# Слой хранения данных.
+# Обработчики bot.py и debts_optimizer больше не пишут SQL сами, а работают через репозитории:
+#   UserRepository    — пользователи и их платёжные данные
+#   ExpenseRepository — платежи, категории и доли участников
+#   LedgerRepository  — долги, балансы и применение плана переводов
+#   StatsRepository   — дневные сводки трат для /stats (см. stats.py)
+# Поиск платежей для /find (ExpenseRepository.search) в SQLite идёт по FTS5-индексу expense_fts, см. search.py.
+# Каждый расчёт /optimize записывается в журнал settlement_journal, см. journal.py. SQLite-база работает в режиме WAL:
+# читатели (в том числе снимки SqliteStorage.snapshot) не блокируют запись, а запись — чтение.
+# Есть две реализации: SQLite (по умолчанию, файл expenses.db) и PostgreSQL на asyncpg с пулом соединений.
+# Бэкенд выбирается в config.py:
+#   DB_BACKEND = 'sqlite' | 'postgres'
+#   DB_PATH = 'expenses.db'          # для sqlite
+#   POSTGRES_DSN = 'postgresql://...' # для postgres
+# Все методы репозиториев асинхронные, чтобы обе реализации были взаимозаменяемы. Запросы SQLite синхронные,
+# поэтому SqliteStorage выполняет их в потоках (asyncio.to_thread) и не блокирует цикл событий бота.
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DB_PATH = 'expenses.db'
+DEFAULT_EVENT_ID = 1
+DEFAULT_EVENT_NAME = 'Основное мероприятие'
+DEFAULT_CATEGORIES = ["Еда", "Транспорт", "Жилье", "Развлечения", "Прочее"]
+# без них не работают запросы долгов и оптимизатор; проверяются при открытии базы только для чтения
+CORE_TABLES = ('event', 'user', 'expense', 'expense_participant')
+
+# Архив: погашенные платежи закрытых мероприятий переносятся из горячих таблиц в *_archive с теми же колонками
+# (плюс archived_at), чтобы запросы долгов и оптимизатор работали с объёмом открытых долгов, а не всей истории.
+# (таблица, колонки, колонка со ссылкой на платёж)
+ARCHIVED_TABLES = [
+    ('expense', 'id, amount, currency, event_id, name, paid_date, user_id, message_id, category_id', 'id'),
+    ('expense_participant', 'id, amount, expense_id, is_paid, user_id', 'expense_id'),
+    ('expense_item', 'id, expense_id, position, name, quantity, price, amount, claimed_by', 'expense_id'),
+]
+
+
+def _check_item_claims(items, positions, user_id):
+    """Проверяет выбор позиций: items — {position: (id, position, name, amount, claimed_by)}.
+
+    Возвращает [(position, name, amount)] или бросает shares.ItemClaimError.
+    """
+    claimed = []
+    for pos in positions:
+        item = items.get(pos)
+        if item is None:
+            raise shares.ItemClaimError(f'Позиция #{pos} не найдена в чеке')
+        _, _, name, amount, claimed_by = item
+        if claimed_by is not None:
+            who = 'вами' if claimed_by == user_id else 'другим участником'
+            raise shares.ItemClaimError(f'Позиция #{pos} ({name}) уже выбрана {who}')
+        claimed.append((pos, name, amount))
+    return claimed
+
+
+class UserRepository:
+    async def get_or_create(self, user_id, user_name, username=None):
+        raise NotImplementedError
+
+    async def find_by_usernames(self, usernames):
+        """{username (в нижнем регистре, без @): (id, name)} для известных пользователей."""
+        raise NotImplementedError
+
+    async def set_payment_credentials(self, user_id, user_name, payment_credentials):
+        raise NotImplementedError
+
+    async def get_payment_credentials(self, user_id):
+        raise NotImplementedError
+
+    async def get_all(self):
+        """Список (id, name, payment_credentials) всех пользователей."""
+        raise NotImplementedError
+
+
+class ExpenseRepository:
+    async def get_categories(self):
+        """Список (id, name) категорий."""
+        raise NotImplementedError
+
+    async def create(self, payment_data, message_id=None):
+        """Сохраняет платёж (и позиции чека из payment_data['items'], если есть) и возвращает его id."""
+        raise NotImplementedError
+
+    async def get_items(self, payment_id):
+        """Позиции чека: (position, name, quantity, price, amount, claimed_by)."""
+        raise NotImplementedError
+
+    async def claim_items(self, payment_id, positions, user_id, user_name):
+        """Отдаёт позиции чека участнику и записывает его долю на их сумму одной транзакцией.
+
+        Возвращает [(position, name, amount)]. Бросает shares.ItemClaimError / shares.ShareLimitError.
+        """
+        raise NotImplementedError
+
+    async def create_many(self, payments):
+        """Пакетно сохраняет платежи вместе с долями одной транзакцией, возвращает список id.
+
+        Каждый payment — dict как для create() плюс 'shares': [(user_id, user_name, amount[, is_paid]), ...]
+        (например, из split.split_amount; is_paid по умолчанию False) и необязательный 'message_id'.
+        """
+        raise NotImplementedError
+
+    async def add_shares(self, payment_id, participant_shares):
+        """Записывает доли [(user_id, user_name, amount), ...] одной транзакцией.
+
+        Бросает shares.ShareLimitError, если вместе с уже записанными они превышают сумму платежа.
+        """
+        raise NotImplementedError
+
+    async def find_by_message_id(self, message_id):
+        """(id, currency, amount) платежа по id сообщения 'Платеж создан!' или None."""
+        raise NotImplementedError
+
+    async def get_shares_total(self, payment_id):
+        """Сумма всех записанных долей платежа (оплаченных и нет)."""
+        raise NotImplementedError
+
+    async def get_recent(self, limit=5):
+        """Последние платежи: (id, amount, currency, event_id, name, paid_date, user_id, message_id, category_id, payer_name, category_name)."""
+        raise NotImplementedError
+
+    async def get_shares(self, payment_id):
+        """Доли платежа: (id, amount, expense_id, is_paid, user_id, user_name)."""
+        raise NotImplementedError
+
+    def iter_export_rows(self, event_id=DEFAULT_EVENT_ID, batch_size=500):
+        """Асинхронный генератор всех платежей мероприятия с долями, по порядку, без загрузки всего в память:
+        (expense_id, paid_date, name, category_name, currency, amount, payer_id, payer_name,
+         participant_id, participant_name, share_amount, is_paid); у платежа без долей participant_* и share_* — None.
+        Платежи, перенесённые в архив (LedgerRepository.archive_settled), тоже выгружаются.
+        """
+        raise NotImplementedError
+
+    async def close_event(self, event_id):
+        """Помечает мероприятие закрытым (его погашенные платежи уходят в архив); False, если такого нет."""
+        raise NotImplementedError
+
+    async def search(self, terms, event_id=DEFAULT_EVENT_ID, date_from=None, date_to=None, weekday=None,
+                     amount_min=None, amount_max=None, limit=search.PAGE_SIZE, offset=0):
+        """Платежи мероприятия по словам (префиксы, все должны встретиться) и фильтрам search.SearchQuery.filters,
+        от новых к старым: (id, paid_date, name, amount, currency, payer_name, category_name).
+        """
+        raise NotImplementedError
+
+
+class LedgerRepository:
+    async def get_balance(self, user_id, event_id=DEFAULT_EVENT_ID):
+        """Список (currency, paid_total, debt_total)."""
+        raise NotImplementedError
+
+    async def get_user_debts(self, user_id):
+        """Неоплаченные доли пользователя: (expense_name, amount, currency, payer_name, payer_credentials)."""
+        raise NotImplementedError
+
+    async def get_total_debts(self):
+        """(debtor_name, payer_name, payer_credentials, total, currency) по всем активным долгам."""
+        raise NotImplementedError
+
+    async def get_user_debts_by_category(self, user_id):
+        """(category_name, currency, total)."""
+        raise NotImplementedError
+
+    async def get_total_debts_by_category(self):
+        """(category_name, currency, total)."""
+        raise NotImplementedError
+
+    async def get_unpaid_rows(self, event_id=None):
+        """Строки для оптимизатора: (ep_id, debtor_id, creditor_id, amount, currency, expense_id).
+
+        event_id — только доли платежей этого мероприятия; None — всех.
+        """
+        raise NotImplementedError
+
+    async def get_unpaid_event_ids(self):
+        """id мероприятий, в которых есть неоплаченные долги (доли не самого плательщика), по возрастанию."""
+        raise NotImplementedError
+
+    async def get_unpaid_totals(self, currency=None):
+        """Непогашенные долги, просуммированные по парам: (debtor_id, creditor_id, total, currency).
+
+        currency — только долги в этой валюте (нормализованной: 'USD').
+        """
+        raise NotImplementedError
+
+    async def apply_allocations(self, transfers_with_allocs, run_id=None):
+        """Атомарно помечает задействованные в плане доли как оплаченные.
+
+        run_id — запуск из журнала расчётов (journal_planned): запись applied добавляется в той же транзакции.
+        """
+        raise NotImplementedError
+
+    async def journal_planned(self, mode, transfers_with_allocs, event_id=None, chat_id=None, source='bot'):
+        """Открывает запуск в журнале расчётов записью planned с планом; возвращает run_id."""
+        raise NotImplementedError
+
+    async def journal_append(self, run_id, state, message_id=None, detail=None):
+        """Дописывает состояние запуска (journal.POSTED, FAILED, ABANDONED); detail — текст ошибки."""
+        raise NotImplementedError
+
+    async def get_open_runs(self):
+        """Незавершённые запуски после позиции восстановления: (run_id, последнее состояние, план JSON) по возрастанию."""
+        raise NotImplementedError
+
+    async def advance_journal_checkpoint(self):
+        """Сдвигает позицию восстановления до первого незавершённого запуска; возвращает новую позицию."""
+        raise NotImplementedError
+
+    async def get_recent_runs(self, limit=10):
+        """Последние запуски: (run_id, created_at, source, mode, event_id, число переводов, состояние, ошибка)."""
+        raise NotImplementedError
+
+    async def mark_all_paid(self):
+        raise NotImplementedError
+
+    async def compact_paid_shares(self):
+        """Сливает оплаченные фрагменты доли (их создаёт apply_allocations) в одну строку на (платёж, участник).
+
+        Возвращает число удалённых строк; суммы и статусы долей не меняются.
+        """
+        raise NotImplementedError
+
+    async def archive_settled(self):
+        """Переносит полностью погашенные платежи закрытых мероприятий с долями и позициями чека в *_archive.
+
+        Возвращает (число платежей, число долей).
+        """
+        raise NotImplementedError
+
+
+class StatsRepository:
+    async def get_daily(self, event_id=DEFAULT_EVENT_ID, user_id=None, date_from=None, date_to=None):
+        """Дневные сводки трат: (day, category_id, currency, spent, paid), по всем участникам, если user_id не задан.
+
+        day — 'YYYY-MM-DD' (stats.UNKNOWN_DAY, если дата платежа не распознана); date_from/date_to — включительно.
+        """
+        raise NotImplementedError
+
+    async def rebuild(self):
+        """Пересчитывает сводки с нуля по платежам и архиву; возвращает число строк сводок."""
+        raise NotImplementedError
+
+
+class Storage:
+    """Набор репозиториев одного бэкенда."""
+
+    users: UserRepository
+    expenses: ExpenseRepository
+    ledger: LedgerRepository
+    stats: StatsRepository
+
+    async def connect(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def init_schema(self):
+        raise NotImplementedError
+
+    async def missing_tables(self, tables=CORE_TABLES):
+        """Таблицы из tables, которых нет в базе; для открытия без init_schema (только чтение)."""
+        raise NotImplementedError
+
+    async def optimize(self, vacuum_free_ratio=0.2):
+        """Обновляет статистику планировщика; VACUUM — если свободно больше vacuum_free_ratio файла (SQLite).
+
+        Возвращает True, если был VACUUM.
+        """
+        raise NotImplementedError
+
+
+# =========================
+# SQLITE
+# =========================
+
+class _SharedConnection:
+    """Соединение SqliteStorage(shared_connection=True): репозитории закрывают его после каждого запроса,
+    но close() ничего не делает — соединение одно на всё время работы и закрывается в Storage.close().
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        pass
+
+
+def _in_thread(method):
+    """Синхронный метод SQLite-репозитория -> async-метод, который выполняется в потоке (SqliteStorage.run_sync)."""
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        return await self._storage.run_sync(method, self, *args, **kwargs)
+    return wrapper
+
+# платежи с суммами долей по участникам (включая архив) для пересчёта сводок; одинаков для SQLite и PostgreSQL
+_ROLLUP_SOURCE_SQL = '''
+    WITH e AS (
+        SELECT id, event_id, paid_date, user_id, category_id, currency, amount FROM expense
+        UNION ALL
+        SELECT id, event_id, paid_date, user_id, category_id, currency, amount FROM expense_archive
+    ), ep AS (
+        SELECT expense_id, user_id, amount FROM expense_participant
+        UNION ALL
+        SELECT expense_id, user_id, amount FROM expense_participant_archive
+    )
+    SELECT e.id, e.event_id, e.paid_date, e.user_id, e.category_id, e.currency, e.amount, ep.user_id, SUM(ep.amount)
+    FROM e
+    LEFT JOIN ep ON ep.expense_id = e.id
+    GROUP BY e.id, e.event_id, e.paid_date, e.user_id, e.category_id, e.currency, e.amount, ep.user_id
+    ORDER BY e.id
+'''
+
+
+def _rollups_from_source(rows):
+    """Строки _ROLLUP_SOURCE_SQL -> строки spending_daily."""
+    rollups = stats.merge_deltas([])
+    for _, group in groupby(rows, key=lambda r: r[0]):
+        group = list(group)
+        participant_shares = [(r[7], r[8]) for r in group if r[7] is not None]
+        stats.merge_deltas(stats.rollup_deltas(tuple(group[0][1:7]), participant_shares), rollups)
+    return [key + (round(spent, 2), round(paid, 2)) for key, (spent, paid) in rollups.items()]
+
+
+# журнал расчётов (journal.py): запуск — запись planned (p), остальные его записи ссылаются на неё через run_id;
+# одинаково для SQLite и PostgreSQL
+_JOURNAL_LAST_STATE = '''
+    COALESCE((SELECT s.state FROM settlement_journal s WHERE s.run_id = p.id ORDER BY s.id DESC LIMIT 1), p.state)
+'''
+_JOURNAL_LAST_ERROR = f'''
+    (SELECT s.payload FROM settlement_journal s WHERE s.run_id = p.id AND s.state = '{journal.FAILED}'
+     ORDER BY s.id DESC LIMIT 1)
+'''
+_JOURNAL_FINAL_STATES = ', '.join(f"'{state}'" for state in journal.FINAL_STATES)
+_JOURNAL_OPEN_RUN = f'''
+    p.state = '{journal.PLANNED}' AND NOT EXISTS (
+        SELECT 1 FROM settlement_journal t WHERE t.run_id = p.id AND t.state IN ({_JOURNAL_FINAL_STATES}))
+'''
+
+
+def _recent_runs(rows):
+    """Строки get_recent_runs с планом JSON -> с числом переводов (взаимозачёты с нулевой суммой не считаются)."""
+    return [(run_id, created_at, source, mode, event_id,
+             sum(1 for t in journal.load_plan(payload) if t['amount'] > 0), state, detail)
+            for run_id, created_at, source, mode, event_id, payload, state, detail in rows]
+
+
+# paid_date хранится как 'DD.MM.YYYY HH:MM' — для сравнения дат переводится в 'YYYY-MM-DD'
+_SEARCH_DAY_SQL = "substr(e.paid_date, 7, 4) || '-' || substr(e.paid_date, 4, 2) || '-' || substr(e.paid_date, 1, 2)"
+
+
+def _search_filters(filters, placeholder, weekday_sql):
+    """Условия WHERE и параметры для фильтров поиска; placeholder(n) -> '?' или '$n'."""
+    where = []
+    params = []
+    for sql, value in (
+        (f'{_SEARCH_DAY_SQL} >=', filters['date_from']),
+        (f'{_SEARCH_DAY_SQL} <=', filters['date_to']),
+        (f'{weekday_sql} =', filters['weekday']),
+        ('e.amount >=', filters['amount_min']),
+        ('e.amount <=', filters['amount_max']),
+    ):
+        if value is not None:
+            params.append(value)
+            where.append(f'{sql} {placeholder(len(params))}')
+    return where, params
+
+
+_SQLITE_FTS_TRIGGERS = [
+    '''
+    CREATE TRIGGER IF NOT EXISTS expense_fts_insert AFTER INSERT ON expense BEGIN
+        INSERT INTO expense_fts (rowid, name, category, payer) VALUES (
+            new.id, new.name,
+            (SELECT name FROM category WHERE id = new.category_id),
+            (SELECT name FROM user WHERE id = new.user_id));
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS expense_fts_update AFTER UPDATE OF name, category_id, user_id ON expense BEGIN
+        UPDATE expense_fts SET
+            name = new.name,
+            category = (SELECT name FROM category WHERE id = new.category_id),
+            payer = (SELECT name FROM user WHERE id = new.user_id)
+        WHERE rowid = new.id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS expense_fts_delete AFTER DELETE ON expense BEGIN
+        DELETE FROM expense_fts WHERE rowid = old.id;
+    END
+    ''',
+    # платёж может быть записан раньше, чем плательщик (импорт)
+    '''
+    CREATE TRIGGER IF NOT EXISTS user_fts_insert AFTER INSERT ON user BEGIN
+        UPDATE expense_fts SET payer = new.name WHERE rowid IN (SELECT id FROM expense WHERE user_id = new.id);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS user_fts_rename AFTER UPDATE OF name ON user WHEN old.name IS NOT new.name BEGIN
+        UPDATE expense_fts SET payer = new.name WHERE rowid IN (SELECT id FROM expense WHERE user_id = new.id);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS category_fts_rename AFTER UPDATE OF name ON category WHEN old.name IS NOT new.name BEGIN
+        UPDATE expense_fts SET category = new.name WHERE rowid IN (SELECT id FROM expense WHERE category_id = new.id);
+    END
+    ''',
+]
+
+
+_SQLITE_ROLLUP_UPSERT = '''
+    INSERT INTO spending_daily (event_id, day, user_id, category_id, currency, spent, paid)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (event_id, day, user_id, category_id, currency)
+    DO UPDATE SET spent = ROUND(spent + excluded.spent, 2), paid = ROUND(paid + excluded.paid, 2)
+'''
+
+
+def _sqlite_expense_rollup_key(cursor, payment_id):
+    """(event_id, paid_date, payer_id, category_id, currency, amount) платежа для stats.rollup_deltas или None."""
+    cursor.execute('''
+        SELECT event_id, paid_date, user_id, category_id, currency, amount FROM expense WHERE id = ?
+    ''', (payment_id,))
+    return cursor.fetchone()
+
+
+class SqliteUserRepository(UserRepository):
+    def __init__(self, storage):
+        self._storage = storage
+
+    @_in_thread
+    def get_or_create(self, user_id, user_name, username=None):
+        conn = self._storage.connect_sync()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('INSERT OR IGNORE INTO user (id, name) VALUES (?, ?)', (user_id, user_name))
+            if username:
+                cursor.execute('UPDATE user SET username = ? WHERE id = ?', (username.lower(), user_id))
+            conn.commit()
+            return user_id
+        finally:
+            conn.close()
+
+    @_in_thread
+    def find_by_usernames(self, usernames):
+        usernames = sorted({u.lower().lstrip('@') for u in usernames})
+        if not usernames:
+            return {}
+        conn = self._storage.connect_sync()
+        try:
+            cursor = conn.cursor()
+            placeholders = ','.join('?' * len(usernames))
+            cursor.execute(f'SELECT username, id, name FROM user WHERE username IN ({placeholders})', usernames)
+            rows = cursor.fetchall()
+            return {r[0]: (r[1], r[2]) for r in rows}
+        finally:
+            conn.close()
+
+    @_in_thread
+    def set_payment_credentials(self, user_id, user_name, payment_credentials):
+        conn = self._storage.connect_sync()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO user (id, name, payment_credentials) VALUES (?, ?, ?)
+                ON CONFLICT DO UPDATE
+                SET payment_credentials = ?
+            ''', (user_id, user_name, payment_credentials, payment_credentials))
+            conn.commit()
+        finally:
+            conn.close()
+
+    @_in_thread
+    def get_payment_credentials(self, user_id):
+        conn = self._storage.connect_sync()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT payment_credentials FROM user WHERE id = ?', (user_id,))
+            row = cursor.fetchone()
+            return row[0] if row else None
+        finally:
+            conn.close()
+
+    @_in_thread
+    def get_all(self):
+        conn = self._storage.connect_sync()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT id, name, payment_credentials FROM user')
+            rows = cursor.fetchall()
+            return [(r[0], r[1], r[2]) for r in rows]
+        finally:
+            conn.close()
+
+
+class SqliteExpenseRepository(ExpenseRepository):
+    def __init__(self, storage):
+        self._storage = storage
+
+    @_in_thread
+    def get_categories(self):
+        conn = self._storage.connect_sync()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT id, name FROM category ORDER BY id')
+            rows = cursor.fetchall()
+            return rows
+        finally:
+            conn.close()
+
+    @_in_thread
+    def create(self, payment_data, message_id=None):
+        conn = self._storage.connect_sync()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO expense (event_id, name, user_id, paid_date, amount, currency, message_id, category_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                payment_data.get('event_id', DEFAULT_EVENT_ID),
+                payment_data['description'],
+                payment_data['user_id'],
+                payment_data['timestamp'],
+                payment_data['amount'],
+                payment_data.get('currency', 'RUB'),
+                message_id,
+                payment_data.get('category_id')
+            ))
+            payment_id = cursor.lastrowid
+            cursor.executemany('''
+                INSERT INTO expense_item (expense_id, position, name, quantity, price, amount)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', [(payment_id, pos, it['name'], it['quantity'], it['price'], it['amount'])
+                  for pos, it in enumerate(payment_data.get('items') or [], start=1)])
+            cursor.executemany(_SQLITE_ROLLUP_UPSERT, stats.rollup_deltas(_sqlite_expense_rollup_key(cursor, payment_id), []))
+            conn.commit()
+            return payment_id
+        finally:
+            conn.close()
+
+    @_in_thread
+    def get_items(self, payment_id):
+        conn = self._storage.connect_sync()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT position, name, quantity, price, amount, claimed_by
+                FROM expense_item WHERE expense_id = ? ORDER BY position
+            ''', (payment_id,))
+            rows = cursor.fetchall()
+            return rows
+        finally:
+            conn.close()
+
+    @_in_thread
+    def claim_items(self, payment_id, positions, user_id, user_name):
+        conn = self._storage.connect_sync()
+        cursor = conn.cursor()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            placeholders = ','.join('?' * len(positions))
+            cursor.execute(f'''
+                SELECT id, position, name, amount, claimed_by FROM expense_item
+                WHERE expense_id = ? AND position IN ({placeholders})
+            ''', [payment_id, *positions])
+            items = {r[1]: r for r in cursor.fetchall()}
+            claimed = _check_item_claims(items, positions, user_id)
+            expense = _sqlite_expense_rollup_key(cursor, payment_id)
+            if not expense:
+                raise Exception(f'Платёж id={payment_id} не найден')
+            total = expense[5]
+            cursor.execute('SELECT COALESCE(SUM(amount), 0) FROM expense_participant WHERE expense_id = ?', (payment_id,))
+            existing = cursor.fetchone()[0]
+            share = sum(amount for _, _, amount in claimed)
+            shares.check_share_limit(total, existing, [share])
+            cursor.executemany('UPDATE expense_item SET claimed_by = ? WHERE id = ?',
+                               [(user_id, items[pos][0]) for pos, _, _ in claimed])
+            cursor.execute('INSERT OR IGNORE INTO user (id, name) VALUES (?, ?)', (user_id, user_name))
+            cursor.execute('''
+                INSERT INTO expense_participant (expense_id, user_id, amount, is_paid)
+                VALUES (?, ?, ?, ?)
+            ''', (payment_id, user_id, round(share, 2), 0))
+            cursor.executemany(_SQLITE_ROLLUP_UPSERT,
+                               stats.rollup_deltas(expense, [(user_id, round(share, 2))], include_payment=False))
+            conn.commit()
+            return claimed
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    @_in_thread
+    def create_many(self, payments):
+        conn = self._storage.connect_sync()
+        cursor = conn.cursor()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            ids = []
+            users = {}
+            share_rows = []
+            rollups = stats.merge_deltas([])
+            for p in payments:
+                participant_shares = p.get('shares', [])
+                shares.check_share_limit(p['amount'], 0, [share[2] for share in participant_shares])
+                users.setdefault(p['user_id'], p.get('created_by') or str(p['user_id']))
+                cursor.execute('''
+                    INSERT INTO expense (event_id, name, user_id, paid_date, amount, currency, message_id, category_id)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (
+                    p.get('event_id', DEFAULT_EVENT_ID),
+                    p['description'],
+                    p['user_id'],
+                    p['timestamp'],
+                    p['amount'],
+                    p.get('currency', 'RUB'),
+                    p.get('message_id', 0),
+                    p.get('category_id')
+                ))
+                payment_id = cursor.lastrowid
+                ids.append(payment_id)
+                for user_id, user_name, amount, *paid in participant_shares:
+                    users.setdefault(user_id, user_name)
+                    share_rows.append((payment_id, user_id, amount, int(bool(paid and paid[0]))))
+                stats.merge_deltas(stats.rollup_deltas(
+                    (p.get('event_id', DEFAULT_EVENT_ID), p['timestamp'], p['user_id'], p.get('category_id'),
+                     p.get('currency', 'RUB'), p['amount']),
+                    [(share[0], share[2]) for share in participant_shares]), rollups)
+            cursor.executemany('INSERT OR IGNORE INTO user (id, name) VALUES (?, ?)', list(users.items()))
+            cursor.executemany('''
+                INSERT INTO expense_participant (expense_id, user_id, amount, is_paid)
+                VALUES (?, ?, ?, ?)
+            ''', share_rows)
+            cursor.executemany(_SQLITE_ROLLUP_UPSERT,
+                               [key + (round(spent, 2), round(paid, 2)) for key, (spent, paid) in rollups.items()])
+            conn.commit()
+            return ids
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    @_in_thread
+    def add_shares(self, payment_id, participant_shares):
+        conn = self._storage.connect_sync()
+        cursor = conn.cursor()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            expense = _sqlite_expense_rollup_key(cursor, payment_id)
+            if not expense:
+                raise Exception(f'Платёж id={payment_id} не найден')
+            cursor.execute('SELECT COALESCE(SUM(amount), 0) FROM expense_participant WHERE expense_id = ?', (payment_id,))
+            existing = cursor.fetchone()[0]
+            shares.check_share_limit(expense[5], existing, [amount for _, _, amount in participant_shares])
+            cursor.executemany('INSERT OR IGNORE INTO user (id, name) VALUES (?, ?)',
+                               [(user_id, user_name) for user_id, user_name, _ in participant_shares])
+            cursor.executemany('''
+                INSERT INTO expense_participant (expense_id, user_id, amount, is_paid)
+                VALUES (?, ?, ?, ?)
+            ''', [(payment_id, user_id, amount, 0) for user_id, _, amount in participant_shares])
+            cursor.executemany(_SQLITE_ROLLUP_UPSERT, stats.rollup_deltas(
+                expense, [(user_id, amount) for user_id, _, amount in participant_shares], include_payment=False))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    @_in_thread
+    def find_by_message_id(self, message_id):
+        conn = self._storage.connect_sync()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT id, currency, amount FROM expense WHERE message_id = ? LIMIT 1', (message_id,))
+            row = cursor.fetchone()
+            return row
+        finally:
+            conn.close()
+
+    @_in_thread
+    def get_shares_total(self, payment_id):
+        conn = self._storage.connect_sync()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT COALESCE(SUM(amount), 0) FROM expense_participant WHERE expense_id = ?', (payment_id,))
+            total = cursor.fetchone()[0]
+            return total
+        finally:
+            conn.close()
+
+    @_in_thread
+    def get_recent(self, limit=5):
+        conn = self._storage.connect_sync()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT e.id, e.amount, e.currency, e.event_id, e.name, e.paid_date, e.user_id, e.message_id, e.category_id,
+                       u.name, c.name
+                FROM expense e
+                JOIN user u ON e.user_id = u.id
+                LEFT JOIN category c ON e.category_id = c.id
+                ORDER BY e.paid_date DESC LIMIT ?
+            ''', (limit,))
+            rows = cursor.fetchall()
+            return rows
+        finally:
+            conn.close()
+
+    @_in_thread
+    def get_shares(self, payment_id):
+        conn = self._storage.connect_sync()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT ep.id, ep.amount, ep.expense_id, ep.is_paid, ep.user_id, u.name
+                FROM expense_participant ep
+                JOIN user u ON ep.user_id = u.id
+                WHERE ep.expense_id = ?
+            ''', (payment_id,))
+            rows = cursor.fetchall()
+            return rows
+        finally:
+            conn.close()
+
+    async def iter_export_rows(self, event_id=DEFAULT_EVENT_ID, batch_size=500):
+        conn = await self._storage.run_sync(self._storage.connect_sync)
+        try:
+            cursor = conn.cursor()
+            await self._storage.run_sync(cursor.execute, '''
+                WITH e AS (
+                    SELECT id, paid_date, name, category_id, currency, amount, user_id, event_id FROM expense
+                    UNION ALL
+                    SELECT id, paid_date, name, category_id, currency, amount, user_id, event_id FROM expense_archive
+                ), ep AS (
+                    SELECT id, expense_id, user_id, amount, is_paid FROM expense_participant
+                    UNION ALL
+                    SELECT id, expense_id, user_id, amount, is_paid FROM expense_participant_archive
+                )
+                SELECT e.id, e.paid_date, e.name, c.name, e.currency, e.amount, e.user_id, u.name,
+                       ep.user_id, pu.name, ep.amount, ep.is_paid
+                FROM e
+                JOIN user u ON e.user_id = u.id
+                LEFT JOIN category c ON e.category_id = c.id
+                LEFT JOIN ep ON ep.expense_id = e.id
+                LEFT JOIN user pu ON ep.user_id = pu.id
+                WHERE e.event_id = ?
+                ORDER BY e.id, ep.id
+            ''', (event_id,))
+            while True:
+                # пачки читаются в потоке; между ними цикл событий свободен, пока получатель отправляет строки
+                rows = await self._storage.run_sync(cursor.fetchmany, batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row[:11] + (None if row[11] is None else bool(row[11]),)
+        finally:
+            conn.close()
+
+    @_in_thread
+    def close_event(self, event_id):
+        conn = self._storage.connect_sync()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('UPDATE event SET closed_at = COALESCE(closed_at, CURRENT_TIMESTAMP) WHERE id = ?', (event_id,))
+            found = cursor.rowcount > 0
+            conn.commit()
+            return found
+        finally:
+            conn.close()
+
+    @_in_thread
+    def search(self, terms, event_id=DEFAULT_EVENT_ID, date_from=None, date_to=None, weekday=None,
+                     amount_min=None, amount_max=None, limit=search.PAGE_SIZE, offset=0):
+        filters = dict(date_from=date_from, date_to=date_to, weekday=weekday, amount_min=amount_min, amount_max=amount_max)
+        where, params = _search_filters(filters, lambda n: '?', f"CAST(strftime('%w', {_SEARCH_DAY_SQL}) AS INTEGER)")
+        source = 'expense e'
+        if terms and self._storage.fts_enabled:
+            source = 'expense_fts JOIN expense e ON e.id = expense_fts.rowid'
+            where.insert(0, 'expense_fts MATCH ?')
+            params.insert(0, search.fts_match(terms))
+        elif terms:
+            # SQLite без FTS5: полный просмотр, LIKE без учёта регистра только для латиницы
+            for term in terms:
+                where.append('(e.name LIKE ? OR c.name LIKE ? OR u.name LIKE ?)')
+                params += [f'%{term}%'] * 3
+        where.append('e.event_id = ?')
+        params += [event_id, limit, offset]
+        conn = self._storage.connect_sync()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT e.id, e.paid_date, e.name, e.amount, e.currency, u.name, c.name
+                FROM {source}
+                LEFT JOIN user u ON e.user_id = u.id
+                LEFT JOIN category c ON e.category_id = c.id
+                WHERE {' AND '.join(where)}
+                ORDER BY e.id DESC
+                LIMIT ? OFFSET ?
+            ''', params)
+            rows = cursor.fetchall()
+            return rows
+        finally:
+            conn.close()
+
+
+class SqliteLedgerRepository(LedgerRepository):
+    def __init__(self, storage):
+        self._storage = storage
+
+    def _fetchall(self, sql, params=()):
+        conn = self._storage.connect_sync()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+            return rows
+        finally:
+            conn.close()
+
+    @_in_thread
+    def get_balance(self, user_id, event_id=DEFAULT_EVENT_ID):
+        return self._fetchall('''
+            SELECT e.currency,
+                   SUM(CASE WHEN e.user_id = ? THEN e.amount ELSE 0 END) as paid_total,
+                   SUM(CASE WHEN ep.user_id = ? THEN ep.amount ELSE 0 END) as debt_total
+            FROM expense e
+            LEFT JOIN expense_participant ep ON e.id = ep.expense_id AND ep.is_paid = 0
+            WHERE e.event_id = ?
+            GROUP BY e.currency
+        ''', (user_id, user_id, event_id))
+
+    @_in_thread
+    def get_user_debts(self, user_id):
+        return self._fetchall('''
+            SELECT e.name, ep.amount, e.currency, u_payer.name, u_payer.payment_credentials
+            FROM expense_participant ep
+            JOIN expense e ON ep.expense_id = e.id
+            JOIN user u_payer ON e.user_id = u_payer.id
+            WHERE ep.user_id = ? AND ep.is_paid = 0
+            ORDER BY e.paid_date DESC, e.id DESC
+        ''', (user_id,))
+
+    @_in_thread
+    def get_total_debts(self):
+        return self._fetchall('''
+            SELECT u_debtor.name, u_payer.name, u_payer.payment_credentials, SUM(ep.amount) as total_debt, e.currency
+            FROM expense_participant ep
+            JOIN user u_debtor ON ep.user_id = u_debtor.id
+            JOIN expense e ON ep.expense_id = e.id
+            JOIN user u_payer ON e.user_id = u_payer.id
+            WHERE ep.is_paid = 0
+            GROUP BY u_debtor.id, u_debtor.name, u_payer.id, u_payer.name, e.currency
+            ORDER BY u_debtor.name, u_payer.name
+        ''')
+
+    @_in_thread
+    def get_user_debts_by_category(self, user_id):
+        return self._fetchall('''
+            SELECT COALESCE(c.name, 'Без категории') as cat_name, e.currency, SUM(ep.amount)
+            FROM expense_participant ep
+            JOIN expense e ON ep.expense_id = e.id
+            LEFT JOIN category c ON e.category_id = c.id
+            WHERE ep.user_id = ? AND ep.is_paid = 0
+            GROUP BY cat_name, e.currency
+            ORDER BY cat_name, e.currency
+        ''', (user_id,))
+
+    @_in_thread
+    def get_total_debts_by_category(self):
+        return self._fetchall('''
+            SELECT COALESCE(c.name, 'Без категории') as cat_name, e.currency, SUM(ep.amount)
+            FROM expense_participant ep
+            JOIN expense e ON ep.expense_id = e.id
+            LEFT JOIN category c ON e.category_id = c.id
+            WHERE ep.is_paid = 0
+            GROUP BY cat_name, e.currency
+            ORDER BY cat_name, e.currency
+        ''')
+
+    @_in_thread
+    def get_unpaid_rows(self, event_id=None):
+        return self._fetchall('''
+            SELECT ep.id as ep_id, ep.user_id as debtor_id, e.user_id as creditor_id, ep.amount,
+                   COALESCE(UPPER(TRIM(e.currency)), 'RUB') as currency, ep.expense_id
+            FROM expense_participant ep
+            JOIN expense e ON ep.expense_id = e.id
+            WHERE ep.is_paid = 0 AND (? IS NULL OR e.event_id = ?)
+        ''', (event_id, event_id))
+
+    @_in_thread
+    def get_unpaid_event_ids(self):
+        return [r[0] for r in self._fetchall('''
+            SELECT DISTINCT e.event_id
+            FROM expense_participant ep
+            JOIN expense e ON ep.expense_id = e.id
+            WHERE ep.is_paid = 0 AND ep.user_id != e.user_id
+            ORDER BY 1
+        ''')]
+
+    @_in_thread
+    def get_unpaid_totals(self, currency=None):
+        return self._fetchall('''
+            SELECT ep.user_id, e.user_id, SUM(ep.amount), COALESCE(UPPER(TRIM(e.currency)), 'RUB') as currency
+            FROM expense_participant ep
+            JOIN expense e ON ep.expense_id = e.id
+            WHERE ep.is_paid = 0 AND (? IS NULL OR COALESCE(UPPER(TRIM(e.currency)), 'RUB') = ?)
+            GROUP BY ep.user_id, e.user_id, 4
+        ''', (currency, currency))
+
+    @_in_thread
+    def apply_allocations(self, transfers_with_allocs, run_id=None):
+        ep_ids = sorted({a[0] for t in transfers_with_allocs for a in t.get('allocs', [])})
+        conn = self._storage.connect_sync()
+        cursor = conn.cursor()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            current = {}
+            # читаем задействованные строки пачками, чтобы не упереться в лимит параметров SQLite
+            for i in range(0, len(ep_ids), 500):
+                chunk = ep_ids[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                cursor.execute(f'SELECT id, amount, is_paid, user_id FROM expense_participant WHERE id IN ({placeholders})', chunk)
+                for ep_id, amount, is_paid, user_id in cursor.fetchall():
+                    current[ep_id] = (amount, bool(is_paid), user_id)
+            updates, inserts = debts_optimizer.plan_allocation_updates(current, transfers_with_allocs)
+            cursor.executemany('UPDATE expense_participant SET amount = ?, is_paid = ? WHERE id = ?',
+                               [(amount, int(is_paid), ep_id) for amount, is_paid, ep_id in updates])
+            cursor.executemany('INSERT INTO expense_participant (expense_id, user_id, amount, is_paid) VALUES (?, ?, ?, ?)',
+                               [(expense_id, user_id, amount, 1) for expense_id, user_id, amount in inserts])
+            if run_id is not None:
+                cursor.execute('INSERT INTO settlement_journal (run_id, state) VALUES (?, ?)', (run_id, journal.APPLIED))
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logger.error('apply_allocations error: %s', e)
+            raise
+        finally:
+            conn.close()
+
+    @_in_thread
+    def journal_planned(self, mode, transfers_with_allocs, event_id=None, chat_id=None, source='bot'):
+        conn = self._storage.connect_sync()
+        try:
+            cursor = conn.execute('''
+                INSERT INTO settlement_journal (state, source, mode, event_id, chat_id, payload)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (journal.PLANNED, source, mode, event_id, chat_id, journal.dump_plan(transfers_with_allocs)))
+            conn.commit()
+            return cursor.lastrowid
+        finally:
+            conn.close()
+
+    @_in_thread
+    def journal_append(self, run_id, state, message_id=None, detail=None):
+        conn = self._storage.connect_sync()
+        try:
+            conn.execute('INSERT INTO settlement_journal (run_id, state, message_id, payload) VALUES (?, ?, ?, ?)',
+                         (run_id, state, message_id, detail))
+            conn.commit()
+        finally:
+            conn.close()
+
+    @_in_thread
+    def get_open_runs(self):
+        return self._fetchall(f'''
+            SELECT p.id, {_JOURNAL_LAST_STATE}, p.payload
+            FROM settlement_journal p
+            WHERE p.id > (SELECT journal_id FROM settlement_checkpoint WHERE id = 1) AND {_JOURNAL_OPEN_RUN}
+            ORDER BY p.id
+        ''')
+
+    @_in_thread
+    def advance_journal_checkpoint(self):
+        conn = self._storage.connect_sync()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            checkpoint = conn.execute('SELECT journal_id FROM settlement_checkpoint WHERE id = 1').fetchone()[0]
+            first_open = conn.execute(f'''
+                SELECT MIN(p.id) FROM settlement_journal p WHERE p.id > ? AND {_JOURNAL_OPEN_RUN}
+            ''', (checkpoint,)).fetchone()[0]
+            if first_open is not None:
+                checkpoint = first_open - 1
+            else:
+                checkpoint = conn.execute('SELECT COALESCE(MAX(id), ?) FROM settlement_journal', (checkpoint,)).fetchone()[0]
+            conn.execute('UPDATE settlement_checkpoint SET journal_id = ? WHERE id = 1', (checkpoint,))
+            conn.commit()
+            return checkpoint
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    @_in_thread
+    def get_recent_runs(self, limit=10):
+        return _recent_runs(self._fetchall(f'''
+            SELECT p.id, p.created_at, p.source, p.mode, p.event_id, p.payload,
+                   {_JOURNAL_LAST_STATE}, {_JOURNAL_LAST_ERROR}
+            FROM settlement_journal p
+            WHERE p.state = ?
+            ORDER BY p.id DESC
+            LIMIT ?
+        ''', (journal.PLANNED, limit)))
+
+    @_in_thread
+    def mark_all_paid(self):
+        conn = self._storage.connect_sync()
+        try:
+            conn.execute('UPDATE expense_participant SET is_paid = 1 WHERE is_paid = 0')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    @_in_thread
+    def compact_paid_shares(self):
+        conn = self._storage.connect_sync()
+        cursor = conn.cursor()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            cursor.execute('''
+                CREATE TEMP TABLE paid_merge AS
+                SELECT expense_id, user_id, MIN(id) AS keep_id, ROUND(SUM(amount), 2) AS total
+                FROM expense_participant
+                WHERE is_paid = 1
+                GROUP BY expense_id, user_id
+                HAVING COUNT(*) > 1
+            ''')
+            cursor.execute('''
+                UPDATE expense_participant
+                SET amount = (SELECT total FROM paid_merge WHERE keep_id = expense_participant.id)
+                WHERE id IN (SELECT keep_id FROM paid_merge)
+            ''')
+            cursor.execute('''
+                DELETE FROM expense_participant
+                WHERE is_paid = 1
+                  AND (expense_id, user_id) IN (SELECT expense_id, user_id FROM paid_merge)
+                  AND id NOT IN (SELECT keep_id FROM paid_merge)
+            ''')
+            removed = cursor.rowcount
+            cursor.execute('DROP TABLE paid_merge')
+            conn.commit()
+            return removed
+        except Exception as e:
+            conn.rollback()
+            logger.error('compact_paid_shares error: %s', e)
+            raise
+        finally:
+            conn.close()
+
+    @_in_thread
+    def archive_settled(self):
+        conn = self._storage.connect_sync()
+        cursor = conn.cursor()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            cursor.execute('''
+                CREATE TEMP TABLE archive_ids AS
+                SELECT e.id FROM expense e
+                JOIN event ev ON ev.id = e.event_id
+                WHERE ev.closed_at IS NOT NULL
+                  AND NOT EXISTS (SELECT 1 FROM expense_participant ep WHERE ep.expense_id = e.id AND ep.is_paid = 0)
+            ''')
+            moved = {}
+            for table, columns, ref in ARCHIVED_TABLES:
+                cursor.execute(f'''
+                    INSERT INTO {table}_archive ({columns})
+                    SELECT {columns} FROM {table} WHERE {ref} IN (SELECT id FROM archive_ids)
+                ''')
+                moved[table] = cursor.rowcount
+            # сначала ссылающиеся таблицы, потом сами платежи
+            for table, _, ref in reversed(ARCHIVED_TABLES):
+                cursor.execute(f'DELETE FROM {table} WHERE {ref} IN (SELECT id FROM archive_ids)')
+            cursor.execute('DROP TABLE archive_ids')
+            conn.commit()
+            return moved['expense'], moved['expense_participant']
+        except Exception as e:
+            conn.rollback()
+            logger.error('archive_settled error: %s', e)
+            raise
+        finally:
+            conn.close()
+
+
+class SqliteStatsRepository(StatsRepository):
+    def __init__(self, storage):
+        self._storage = storage
+
+    @_in_thread
+    def get_daily(self, event_id=DEFAULT_EVENT_ID, user_id=None, date_from=None, date_to=None):
+        where = ['event_id = ?']
+        params = [event_id]
+        if user_id is not None:
+            where.append('user_id = ?')
+            params.append(user_id)
+        if date_from:
+            where.append('day >= ?')
+            params.append(date_from)
+        if date_to:
+            where.append('day <= ?')
+            params.append(date_to)
+        conn = self._storage.connect_sync()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT day, category_id, currency, ROUND(SUM(spent), 2), ROUND(SUM(paid), 2)
+                FROM spending_daily
+                WHERE {' AND '.join(where)}
+                GROUP BY day, category_id, currency
+                ORDER BY day
+            ''', params)
+            rows = cursor.fetchall()
+            return rows
+        finally:
+            conn.close()
+
+    @_in_thread
+    def rebuild(self):
+        conn = self._storage.connect_sync()
+        cursor = conn.cursor()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            rows = _rollups_from_source(cursor.execute(_ROLLUP_SOURCE_SQL))
+            cursor.execute('DELETE FROM spending_daily')
+            cursor.executemany(_SQLITE_ROLLUP_UPSERT, rows)
+            conn.commit()
+            return len(rows)
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+
+def _count_statement(sql):
+    # trace callback вызывается до выполнения и без длительности, поэтому здесь только счётчик по типу оператора;
+    # время запросов меряется на уровне методов репозиториев (см. create_storage)
+    op = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ''
+    metrics.inc('db_statements_total', op=op)
+
+
+class SqliteStorage(Storage):
+    def __init__(self, db_path=DEFAULT_DB_PATH, shared_connection=False, read_only=False):
+        """shared_connection=True — одно соединение на все запросы (пакетные прогоны, python -m debts_optimizer);
+        read_only=True — файл открывается только для чтения (mode=ro), init_schema не вызывается.
+        """
+        self.db_path = db_path
+        self.fts_enabled = True
+        self.shared_connection = shared_connection
+        self.read_only = read_only
+        self._shared = None
+        # одно соединение нельзя использовать из нескольких потоков одновременно — запросы к нему идут по очереди
+        self._shared_lock = asyncio.Lock() if shared_connection else None
+        self.users = SqliteUserRepository(self)
+        self.expenses = SqliteExpenseRepository(self)
+        self.ledger = SqliteLedgerRepository(self)
+        self.stats = SqliteStatsRepository(self)
+
+    def connect_sync(self):
+        if self._shared is not None:
+            return self._shared
+        if self.read_only:
+            path, uri = f'file:{urllib.parse.quote(os.path.abspath(self.db_path))}?mode=ro', True
+        else:
+            path, uri = self.db_path, False
+        # запросы выполняются в потоках run_sync: соединение создаётся в одном потоке, а используется в другом
+        # (общее соединение, постраничная выгрузка iter_export_rows)
+        if diagnostics.slow_query_enabled():
+            conn = sqlite3.connect(path, factory=diagnostics.ProfiledConnection, uri=uri, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(path, uri=uri, check_same_thread=False)
+        if metrics.enabled():
+            conn.set_trace_callback(_count_statement)
+        if self.shared_connection:
+            self._shared = _SharedConnection(conn)
+            return self._shared
+        return conn
+
+    async def run_sync(self, func, *args, **kwargs):
+        """Выполняет синхронную работу с базой в потоке, чтобы не блокировать цикл событий."""
+        if self._shared_lock is None:
+            return await asyncio.to_thread(func, *args, **kwargs)
+        async with self._shared_lock:
+            return await asyncio.to_thread(func, *args, **kwargs)
+
+    async def close(self):
+        if self._shared is not None:
+            self._shared._conn.close()
+            self._shared = None
+
+    async def missing_tables(self, tables=CORE_TABLES):
+        return await self.run_sync(self._missing_tables_sync, tables)
+
+    def _missing_tables_sync(self, tables):
+        conn = self.connect_sync()
+        try:
+            existing = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        finally:
+            conn.close()
+        return [t for t in tables if t not in existing]
+
+    async def init_schema(self):
+        if await self.run_sync(self._init_schema_sync):
+            logger.info('Строю дневные сводки трат: %s строк', await self.stats.rebuild())
+
+    def _init_schema_sync(self):
+        """Создаёт и мигрирует схему; возвращает True, если таблицу сводок нужно заполнить."""
+        conn = self.connect_sync()
+        try:
+            return self._migrate_sync(conn)
+        finally:
+            conn.close()
+
+    def _migrate_sync(self, conn):
+        cursor = conn.cursor()
+
+        # WAL (запоминается в самом файле базы): снимки и другие читатели не ждут запись и не задерживают её
+        mode = cursor.execute('PRAGMA journal_mode=WAL').fetchone()[0]
+        if mode.lower() != 'wal':
+            logger.warning('SQLite: режим WAL недоступен (%s), на время снимка базы запись будет ждать', mode)
+
+        # events
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS event (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL
+            )
+        ''')
+
+        # users
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                payment_credentials TEXT
+            )
+        ''')
+
+        # categories
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS category (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL UNIQUE
+            )
+        ''')
+
+        # expenses
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS expense (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                amount REAL NOT NULL,
+                currency TEXT NOT NULL DEFAULT 'RUB',
+                event_id INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                paid_date TEXT,
+                user_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                category_id INTEGER,
+                FOREIGN KEY (event_id) REFERENCES event (id),
+                FOREIGN KEY (user_id) REFERENCES user (id),
+                FOREIGN KEY (category_id) REFERENCES category (id)
+            )
+        ''')
+
+        # add category_id to expense if missing (migration)
+        cursor.execute("PRAGMA table_info(expense)")
+        cols = [r[1] for r in cursor.fetchall()]
+        if 'category_id' not in cols:
+            try:
+                cursor.execute("ALTER TABLE expense ADD COLUMN category_id INTEGER")
+            except Exception as e:
+                logger.warning("ALTER TABLE expense add category_id failed: %s", e)
+
+        # add username to user if missing (migration) — нужен для долей вида "@anna 500"
+        cursor.execute("PRAGMA table_info(user)")
+        cols = [r[1] for r in cursor.fetchall()]
+        if 'username' not in cols:
+            try:
+                cursor.execute("ALTER TABLE user ADD COLUMN username TEXT")
+            except Exception as e:
+                logger.warning("ALTER TABLE user add username failed: %s", e)
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_username ON user (username)')
+
+        # participants
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS expense_participant (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                amount REAL NOT NULL,
+                expense_id INTEGER NOT NULL,
+                is_paid BOOLEAN,
+                user_id INTEGER NOT NULL,
+                FOREIGN KEY (expense_id) REFERENCES expense (id),
+                FOREIGN KEY (user_id) REFERENCES user (id)
+            )
+        ''')
+
+        # receipt line items
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS expense_item (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                expense_id INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                quantity REAL NOT NULL DEFAULT 1,
+                price REAL NOT NULL,
+                amount REAL NOT NULL,
+                claimed_by INTEGER,
+                FOREIGN KEY (expense_id) REFERENCES expense (id),
+                FOREIGN KEY (claimed_by) REFERENCES user (id)
+            )
+        ''')
+        cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_expense_item_position ON expense_item (expense_id, position)')
+
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_ep_expense ON expense_participant (expense_id, user_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_ep_unpaid ON expense_participant (user_id) WHERE is_paid = 0')
+
+        # closed_at у event (migration) — погашенные платежи закрытых мероприятий уходят в архив
+        cursor.execute("PRAGMA table_info(event)")
+        cols = [r[1] for r in cursor.fetchall()]
+        if 'closed_at' not in cols:
+            try:
+                cursor.execute("ALTER TABLE event ADD COLUMN closed_at TEXT")
+            except Exception as e:
+                logger.warning("ALTER TABLE event add closed_at failed: %s", e)
+
+        # archive
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS expense_archive (
+                id INTEGER PRIMARY KEY,
+                amount REAL NOT NULL,
+                currency TEXT NOT NULL,
+                event_id INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                paid_date TEXT,
+                user_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                category_id INTEGER,
+                archived_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS expense_participant_archive (
+                id INTEGER PRIMARY KEY,
+                amount REAL NOT NULL,
+                expense_id INTEGER NOT NULL,
+                is_paid BOOLEAN,
+                user_id INTEGER NOT NULL,
+                archived_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS expense_item_archive (
+                id INTEGER PRIMARY KEY,
+                expense_id INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                quantity REAL NOT NULL,
+                price REAL NOT NULL,
+                amount REAL NOT NULL,
+                claimed_by INTEGER,
+                archived_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_expense_archive_event ON expense_archive (event_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_ep_archive_expense ON expense_participant_archive (expense_id)')
+
+        # журнал расчётов (journal.py): записи только добавляются
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS settlement_journal (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                run_id INTEGER,
+                state TEXT NOT NULL,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                source TEXT,
+                mode TEXT,
+                event_id INTEGER,
+                chat_id INTEGER,
+                message_id INTEGER,
+                payload TEXT
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_settlement_journal_run ON settlement_journal (run_id)')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS settlement_checkpoint (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                journal_id INTEGER NOT NULL
+            )
+        ''')
+        cursor.execute('INSERT OR IGNORE INTO settlement_checkpoint (id, journal_id) VALUES (1, 0)')
+
+        # daily spending rollups (stats.py)
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'spending_daily'")
+        rollups_missing = cursor.fetchone() is None
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS spending_daily (
+                event_id INTEGER NOT NULL,
+                day TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                category_id INTEGER NOT NULL,
+                currency TEXT NOT NULL,
+                spent REAL NOT NULL DEFAULT 0,
+                paid REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (event_id, day, user_id, category_id, currency)
+            )
+        ''')
+
+        # полнотекстовый индекс платежей для /find (search.py)
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_expense_user ON expense (user_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_expense_category ON expense (category_id)')
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'expense_fts'")
+        fts_missing = cursor.fetchone() is None
+        try:
+            cursor.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS expense_fts USING fts5 (
+                    name, category, payer,
+                    tokenize = 'unicode61 remove_diacritics 2',
+                    prefix = '2 3'
+                )
+            ''')
+        except sqlite3.OperationalError as e:
+            logger.warning('SQLite без FTS5, /find будет искать без индекса: %s', e)
+            self.fts_enabled = False
+        if self.fts_enabled:
+            for trigger in _SQLITE_FTS_TRIGGERS:
+                cursor.execute(trigger)
+            if fts_missing:
+                cursor.execute('''
+                    INSERT INTO expense_fts (rowid, name, category, payer)
+                    SELECT e.id, e.name, c.name, u.name
+                    FROM expense e
+                    LEFT JOIN category c ON e.category_id = c.id
+                    LEFT JOIN user u ON e.user_id = u.id
+                ''')
+
+        # default event
+        cursor.execute('SELECT id FROM event WHERE id = ?', (DEFAULT_EVENT_ID,))
+        if not cursor.fetchone():
+            cursor.execute('INSERT INTO event (id, name) VALUES (?, ?)', (DEFAULT_EVENT_ID, DEFAULT_EVENT_NAME))
+
+        # default categories
+        cursor.execute('SELECT COUNT(*) FROM category')
+        cnt = cursor.fetchone()[0]
+        if cnt == 0:
+            cursor.executemany('INSERT INTO category (name) VALUES (?)', [(n,) for n in DEFAULT_CATEGORIES])
+
+        conn.commit()
+        return rollups_missing
+
+    async def optimize(self, vacuum_free_ratio=0.2):
+        return await self.run_sync(self._optimize_sync, vacuum_free_ratio)
+
+    def _optimize_sync(self, vacuum_free_ratio):
+        conn = self.connect_sync()
+        try:
+            conn.execute('ANALYZE')
+            page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+            freelist_count = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            # VACUUM переписывает весь файл и на это время блокирует базу — только если есть что вернуть
+            if page_count and freelist_count / page_count > vacuum_free_ratio:
+                conn.execute('VACUUM')
+                return True
+            return False
+        finally:
+            conn.close()
+
+    async def snapshot(self, path):
+        """Согласованная копия базы в файл path, не останавливающая запись; возвращает размер файла в байтах.
+
+        Есть только у SQLite: PostgreSQL копируется средствами сервера (pg_dump, pg_basebackup).
+        """
+        # копирование идёт в отдельном потоке, чтобы цикл событий бота продолжал обрабатывать апдейты
+        return await asyncio.to_thread(self._snapshot_sync, path)
+
+    def _snapshot_sync(self, path):
+        tmp_path = path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        # своё соединение, а не connect_sync: оно используется в другом потоке и не должно попадать в метрики
+        source = sqlite3.connect(self.db_path)
+        target = sqlite3.connect(tmp_path)
+        try:
+            # вся база копируется за один шаг backup, то есть в одной транзакции чтения: в режиме WAL она видит
+            # согласованное состояние на момент начала и не мешает писателям. При пошаговом копировании (pages=N)
+            # любая запись из другого соединения между шагами перезапускала бы копирование с начала.
+            source.backup(target)
+            check = target.execute('PRAGMA quick_check').fetchone()[0]
+        finally:
+            target.close()
+            source.close()
+        if check != 'ok':
+            os.remove(tmp_path)
+            raise Exception(f'Снимок базы не прошёл проверку: {check}')
+        # файл снимка появляется целиком или не появляется вовсе
+        os.replace(tmp_path, path)
+        return os.path.getsize(path)
+
+
+# =========================
+# POSTGRESQL (asyncpg)
+# =========================
+# Таблица user в PostgreSQL — зарезервированное слово, поэтому везде "user" в кавычках.
+# is_paid хранится как BOOLEAN, суммы — DOUBLE PRECISION (как REAL в SQLite).
+
+_PG_ROLLUP_UPSERT = '''
+    INSERT INTO spending_daily (event_id, day, user_id, category_id, currency, spent, paid)
+    VALUES ($1, $2, $3, $4, $5, $6, $7)
+    ON CONFLICT (event_id, day, user_id, category_id, currency)
+    DO UPDATE SET spent = ROUND((spending_daily.spent + EXCLUDED.spent)::numeric, 2),
+                  paid = ROUND((spending_daily.paid + EXCLUDED.paid)::numeric, 2)
+'''
+
+
+async def _pg_expense_rollup_key(conn, payment_id):
+    """Блокирует платёж (FOR UPDATE) и возвращает (event_id, paid_date, payer_id, category_id, currency, amount) или None."""
+    row = await conn.fetchrow('''
+        SELECT event_id, paid_date, user_id, category_id, currency, amount FROM expense WHERE id = $1 FOR UPDATE
+    ''', payment_id)
+    return tuple(row) if row else None
+
+
+class PostgresUserRepository(UserRepository):
+    def __init__(self, storage):
+        self._storage = storage
+
+    async def get_or_create(self, user_id, user_name, username=None):
+        await self._storage.pool.execute('''
+            INSERT INTO "user" (id, name, username) VALUES ($1, $2, $3)
+            ON CONFLICT (id) DO UPDATE SET username = COALESCE(EXCLUDED.username, "user".username)
+        ''', user_id, user_name, username.lower() if username else None)
+        return user_id
+
+    async def find_by_usernames(self, usernames):
+        usernames = sorted({u.lower().lstrip('@') for u in usernames})
+        if not usernames:
+            return {}
+        rows = await self._storage.pool.fetch(
+            'SELECT username, id, name FROM "user" WHERE username = ANY($1::text[])', usernames)
+        return {r[0]: (r[1], r[2]) for r in rows}
+
+    async def set_payment_credentials(self, user_id, user_name, payment_credentials):
+        await self._storage.pool.execute('''
+            INSERT INTO "user" (id, name, payment_credentials) VALUES ($1, $2, $3)
+            ON CONFLICT (id) DO UPDATE
+            SET payment_credentials = EXCLUDED.payment_credentials
+        ''', user_id, user_name, payment_credentials)
+
+    async def get_payment_credentials(self, user_id):
+        return await self._storage.pool.fetchval('SELECT payment_credentials FROM "user" WHERE id = $1', user_id)
+
+    async def get_all(self):
+        rows = await self._storage.pool.fetch('SELECT id, name, payment_credentials FROM "user"')
+        return [(r[0], r[1], r[2]) for r in rows]
+
+
+class PostgresExpenseRepository(ExpenseRepository):
+    def __init__(self, storage):
+        self._storage = storage
+
+    async def get_categories(self):
+        rows = await self._storage.pool.fetch('SELECT id, name FROM category ORDER BY id')
+        return [tuple(r) for r in rows]
+
+    async def create(self, payment_data, message_id=None):
+        async with self._storage.pool.acquire() as conn:
+            async with conn.transaction():
+                payment_id = await conn.fetchval('''
+                    INSERT INTO expense (event_id, name, user_id, paid_date, amount, currency, message_id, category_id)
+                    VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+                    RETURNING id
+                ''',
+                    payment_data.get('event_id', DEFAULT_EVENT_ID),
+                    payment_data['description'],
+                    payment_data['user_id'],
+                    payment_data['timestamp'],
+                    float(payment_data['amount']),
+                    payment_data.get('currency', 'RUB'),
+                    message_id,
+                    payment_data.get('category_id')
+                )
+                await conn.executemany('''
+                    INSERT INTO expense_item (expense_id, position, name, quantity, price, amount)
+                    VALUES ($1, $2, $3, $4, $5, $6)
+                ''', [(payment_id, pos, it['name'], float(it['quantity']), float(it['price']), float(it['amount']))
+                      for pos, it in enumerate(payment_data.get('items') or [], start=1)])
+                await conn.executemany(_PG_ROLLUP_UPSERT, stats.rollup_deltas(
+                    await _pg_expense_rollup_key(conn, payment_id), []))
+                return payment_id
+
+    async def get_items(self, payment_id):
+        rows = await self._storage.pool.fetch('''
+            SELECT position, name, quantity, price, amount, claimed_by
+            FROM expense_item WHERE expense_id = $1 ORDER BY position
+        ''', payment_id)
+        return [tuple(r) for r in rows]
+
+    async def claim_items(self, payment_id, positions, user_id, user_name):
+        async with self._storage.pool.acquire() as conn:
+            async with conn.transaction():
+                expense = await _pg_expense_rollup_key(conn, payment_id)
+                if not expense:
+                    raise Exception(f'Платёж id={payment_id} не найден')
+                total = expense[5]
+                rows = await conn.fetch('''
+                    SELECT id, position, name, amount, claimed_by FROM expense_item
+                    WHERE expense_id = $1 AND position = ANY($2::int[])
+                    FOR UPDATE
+                ''', payment_id, positions)
+                items = {r[1]: tuple(r) for r in rows}
+                claimed = _check_item_claims(items, positions, user_id)
+                existing = await conn.fetchval(
+                    'SELECT COALESCE(SUM(amount), 0) FROM expense_participant WHERE expense_id = $1', payment_id)
+                share = sum(amount for _, _, amount in claimed)
+                shares.check_share_limit(total, existing, [share])
+                await conn.executemany('UPDATE expense_item SET claimed_by = $1 WHERE id = $2',
+                                       [(user_id, items[pos][0]) for pos, _, _ in claimed])
+                await conn.execute(
+                    'INSERT INTO "user" (id, name) VALUES ($1, $2) ON CONFLICT (id) DO NOTHING', user_id, user_name)
+                await conn.execute('''
+                    INSERT INTO expense_participant (expense_id, user_id, amount, is_paid)
+                    VALUES ($1, $2, $3, FALSE)
+                ''', payment_id, user_id, round(float(share), 2))
+                await conn.executemany(_PG_ROLLUP_UPSERT, stats.rollup_deltas(
+                    expense, [(user_id, round(float(share), 2))], include_payment=False))
+                return claimed
+
+    async def create_many(self, payments):
+        users = {}
+        for p in payments:
+            shares.check_share_limit(p['amount'], 0, [share[2] for share in p.get('shares', [])])
+            users.setdefault(p['user_id'], p.get('created_by') or str(p['user_id']))
+            for user_id, user_name, *_ in p.get('shares', []):
+                users.setdefault(user_id, user_name)
+        async with self._storage.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.executemany(
+                    'INSERT INTO "user" (id, name) VALUES ($1, $2) ON CONFLICT (id) DO NOTHING', list(users.items()))
+                # id заранее берём из последовательности, чтобы связать доли с платежами без построчных INSERT
+                ids = [r[0] for r in await conn.fetch(
+                    "SELECT nextval(pg_get_serial_sequence('expense', 'id')) FROM generate_series(1, $1)", len(payments))]
+                await conn.executemany('''
+                    INSERT INTO expense (id, event_id, name, user_id, paid_date, amount, currency, message_id, category_id)
+                    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+                ''', [(
+                    payment_id,
+                    p.get('event_id', DEFAULT_EVENT_ID),
+                    p['description'],
+                    p['user_id'],
+                    p['timestamp'],
+                    float(p['amount']),
+                    p.get('currency', 'RUB'),
+                    p.get('message_id', 0),
+                    p.get('category_id')
+                ) for payment_id, p in zip(ids, payments)])
+                await conn.executemany('''
+                    INSERT INTO expense_participant (expense_id, user_id, amount, is_paid)
+                    VALUES ($1, $2, $3, $4)
+                ''', [(payment_id, user_id, float(amount), bool(paid and paid[0]))
+                      for payment_id, p in zip(ids, payments)
+                      for user_id, _, amount, *paid in p.get('shares', [])])
+                rollups = stats.merge_deltas([])
+                for p in payments:
+                    stats.merge_deltas(stats.rollup_deltas(
+                        (p.get('event_id', DEFAULT_EVENT_ID), p['timestamp'], p['user_id'], p.get('category_id'),
+                         p.get('currency', 'RUB'), float(p['amount'])),
+                        [(share[0], float(share[2])) for share in p.get('shares', [])]), rollups)
+                await conn.executemany(_PG_ROLLUP_UPSERT,
+                                       [key + (round(spent, 2), round(paid, 2)) for key, (spent, paid) in rollups.items()])
+                return ids
+
+    async def add_shares(self, payment_id, participant_shares):
+        async with self._storage.pool.acquire() as conn:
+            async with conn.transaction():
+                # блокируем платёж, чтобы параллельные ответы не превысили его сумму
+                expense = await _pg_expense_rollup_key(conn, payment_id)
+                if expense is None:
+                    raise Exception(f'Платёж id={payment_id} не найден')
+                existing = await conn.fetchval(
+                    'SELECT COALESCE(SUM(amount), 0) FROM expense_participant WHERE expense_id = $1', payment_id)
+                shares.check_share_limit(expense[5], existing, [amount for _, _, amount in participant_shares])
+                await conn.executemany(
+                    'INSERT INTO "user" (id, name) VALUES ($1, $2) ON CONFLICT (id) DO NOTHING',
+                    [(user_id, user_name) for user_id, user_name, _ in participant_shares])
+                await conn.executemany('''
+                    INSERT INTO expense_participant (expense_id, user_id, amount, is_paid)
+                    VALUES ($1, $2, $3, FALSE)
+                ''', [(payment_id, user_id, float(amount)) for user_id, _, amount in participant_shares])
+                await conn.executemany(_PG_ROLLUP_UPSERT, stats.rollup_deltas(
+                    expense, [(user_id, float(amount)) for user_id, _, amount in participant_shares], include_payment=False))
+
+    async def find_by_message_id(self, message_id):
+        row = await self._storage.pool.fetchrow(
+            'SELECT id, currency, amount FROM expense WHERE message_id = $1 LIMIT 1', message_id)
+        return tuple(row) if row else None
+
+    async def get_shares_total(self, payment_id):
+        return await self._storage.pool.fetchval(
+            'SELECT COALESCE(SUM(amount), 0) FROM expense_participant WHERE expense_id = $1', payment_id)
+
+    async def get_recent(self, limit=5):
+        rows = await self._storage.pool.fetch('''
+            SELECT e.id, e.amount, e.currency, e.event_id, e.name, e.paid_date, e.user_id, e.message_id, e.category_id,
+                   u.name, c.name
+            FROM expense e
+            JOIN "user" u ON e.user_id = u.id
+            LEFT JOIN category c ON e.category_id = c.id
+            ORDER BY e.paid_date DESC LIMIT $1
+        ''', limit)
+        return [tuple(r) for r in rows]
+
+    async def get_shares(self, payment_id):
+        rows = await self._storage.pool.fetch('''
+            SELECT ep.id, ep.amount, ep.expense_id, ep.is_paid, ep.user_id, u.name
+            FROM expense_participant ep
+            JOIN "user" u ON ep.user_id = u.id
+            WHERE ep.expense_id = $1
+        ''', payment_id)
+        return [tuple(r) for r in rows]
+
+    async def iter_export_rows(self, event_id=DEFAULT_EVENT_ID, batch_size=500):
+        # серверный курсор: строки приходят пачками по batch_size, курсор asyncpg работает только в транзакции
+        async with self._storage.pool.acquire() as conn:
+            async with conn.transaction():
+                async for r in conn.cursor('''
+                    WITH e AS (
+                        SELECT id, paid_date, name, category_id, currency, amount, user_id FROM expense
+                        WHERE event_id = $1
+                        UNION ALL
+                        SELECT id, paid_date, name, category_id, currency, amount, user_id FROM expense_archive
+                        WHERE event_id = $1
+                    ), ep AS (
+                        SELECT id, expense_id, user_id, amount, is_paid FROM expense_participant
+                        UNION ALL
+                        SELECT id, expense_id, user_id, amount, is_paid FROM expense_participant_archive
+                    )
+                    SELECT e.id, e.paid_date, e.name, c.name, e.currency, e.amount, e.user_id, u.name,
+                           ep.user_id, pu.name, ep.amount, ep.is_paid
+                    FROM e
+                    JOIN "user" u ON e.user_id = u.id
+                    LEFT JOIN category c ON e.category_id = c.id
+                    LEFT JOIN ep ON ep.expense_id = e.id
+                    LEFT JOIN "user" pu ON ep.user_id = pu.id
+                    ORDER BY e.id, ep.id
+                ''', event_id, prefetch=batch_size):
+                    yield tuple(r)
+
+    async def close_event(self, event_id):
+        status = await self._storage.pool.execute(
+            'UPDATE event SET closed_at = COALESCE(closed_at, NOW()) WHERE id = $1', event_id)
+        return status != 'UPDATE 0'
+
+    async def search(self, terms, event_id=DEFAULT_EVENT_ID, date_from=None, date_to=None, weekday=None,
+                     amount_min=None, amount_max=None, limit=search.PAGE_SIZE, offset=0):
+        filters = dict(date_from=date_from, date_to=date_to, weekday=weekday, amount_min=amount_min, amount_max=amount_max)
+        weekday_sql = (r"CASE WHEN e.paid_date ~ '^\d{2}\.\d{2}\.\d{4}' "
+                       f"THEN EXTRACT(DOW FROM ({_SEARCH_DAY_SQL})::date)::int END")
+        where, params = _search_filters(filters, lambda n: f'${n}', weekday_sql)
+        if terms:
+            params.append(search.pg_tsquery(terms))
+            where.append(f'''to_tsvector('simple', e.name || ' ' || COALESCE(c.name, '') || ' ' || COALESCE(u.name, ''))
+                             @@ to_tsquery('simple', ${len(params)})''')
+        params += [event_id, limit, offset]
+        where.append(f'e.event_id = ${len(params) - 2}')
+        rows = await self._storage.pool.fetch(f'''
+            SELECT e.id, e.paid_date, e.name, e.amount, e.currency, u.name, c.name
+            FROM expense e
+            LEFT JOIN "user" u ON e.user_id = u.id
+            LEFT JOIN category c ON e.category_id = c.id
+            WHERE {' AND '.join(where)}
+            ORDER BY e.id DESC
+            LIMIT ${len(params) - 1} OFFSET ${len(params)}
+        ''', *params)
+        return [tuple(r) for r in rows]
+
+
+class PostgresLedgerRepository(LedgerRepository):
+    def __init__(self, storage):
+        self._storage = storage
+
+    async def _fetchall(self, sql, *params):
+        rows = await self._storage.pool.fetch(sql, *params)
+        return [tuple(r) for r in rows]
+
+    async def get_balance(self, user_id, event_id=DEFAULT_EVENT_ID):
+        return await self._fetchall('''
+            SELECT e.currency,
+                   SUM(CASE WHEN e.user_id = $1 THEN e.amount ELSE 0 END) as paid_total,
+                   SUM(CASE WHEN ep.user_id = $1 THEN ep.amount ELSE 0 END) as debt_total
+            FROM expense e
+            LEFT JOIN expense_participant ep ON e.id = ep.expense_id AND NOT ep.is_paid
+            WHERE e.event_id = $2
+            GROUP BY e.currency
+        ''', user_id, event_id)
+
+    async def get_user_debts(self, user_id):
+        return await self._fetchall('''
+            SELECT e.name, ep.amount, e.currency, u_payer.name, u_payer.payment_credentials
+            FROM expense_participant ep
+            JOIN expense e ON ep.expense_id = e.id
+            JOIN "user" u_payer ON e.user_id = u_payer.id
+            WHERE ep.user_id = $1 AND NOT ep.is_paid
+            ORDER BY e.paid_date DESC, e.id DESC
+        ''', user_id)
+
+    async def get_total_debts(self):
+        return await self._fetchall('''
+            SELECT u_debtor.name, u_payer.name, u_payer.payment_credentials, SUM(ep.amount) as total_debt, e.currency
+            FROM expense_participant ep
+            JOIN "user" u_debtor ON ep.user_id = u_debtor.id
+            JOIN expense e ON ep.expense_id = e.id
+            JOIN "user" u_payer ON e.user_id = u_payer.id
+            WHERE NOT ep.is_paid
+            GROUP BY u_debtor.id, u_debtor.name, u_payer.id, u_payer.name, u_payer.payment_credentials, e.currency
+            ORDER BY u_debtor.name, u_payer.name
+        ''')
+
+    async def get_user_debts_by_category(self, user_id):
+        return await self._fetchall('''
+            SELECT COALESCE(c.name, 'Без категории') as cat_name, e.currency, SUM(ep.amount)
+            FROM expense_participant ep
+            JOIN expense e ON ep.expense_id = e.id
+            LEFT JOIN category c ON e.category_id = c.id
+            WHERE ep.user_id = $1 AND NOT ep.is_paid
+            GROUP BY cat_name, e.currency
+            ORDER BY cat_name, e.currency
+        ''', user_id)
+
+    async def get_total_debts_by_category(self):
+        return await self._fetchall('''
+            SELECT COALESCE(c.name, 'Без категории') as cat_name, e.currency, SUM(ep.amount)
+            FROM expense_participant ep
+            JOIN expense e ON ep.expense_id = e.id
+            LEFT JOIN category c ON e.category_id = c.id
+            WHERE NOT ep.is_paid
+            GROUP BY cat_name, e.currency
+            ORDER BY cat_name, e.currency
+        ''')
+
+    async def get_unpaid_rows(self, event_id=None):
+        return await self._fetchall('''
+            SELECT ep.id as ep_id, ep.user_id as debtor_id, e.user_id as creditor_id, ep.amount,
+                   COALESCE(UPPER(TRIM(e.currency)), 'RUB') as currency, ep.expense_id
+            FROM expense_participant ep
+            JOIN expense e ON ep.expense_id = e.id
+            WHERE NOT ep.is_paid AND ($1::int IS NULL OR e.event_id = $1)
+        ''', event_id)
+
+    async def get_unpaid_event_ids(self):
+        return [r[0] for r in await self._fetchall('''
+            SELECT DISTINCT e.event_id
+            FROM expense_participant ep
+            JOIN expense e ON ep.expense_id = e.id
+            WHERE NOT ep.is_paid AND ep.user_id != e.user_id
+            ORDER BY 1
+        ''')]
+
+    async def get_unpaid_totals(self, currency=None):
+        return await self._fetchall('''
+            SELECT ep.user_id, e.user_id, SUM(ep.amount), COALESCE(UPPER(TRIM(e.currency)), 'RUB') as currency
+            FROM expense_participant ep
+            JOIN expense e ON ep.expense_id = e.id
+            WHERE NOT ep.is_paid AND ($1::text IS NULL OR COALESCE(UPPER(TRIM(e.currency)), 'RUB') = $1)
+            GROUP BY ep.user_id, e.user_id, 4
+        ''', currency)
+
+    async def apply_allocations(self, transfers_with_allocs, run_id=None):
+        ep_ids = sorted({a[0] for t in transfers_with_allocs for a in t.get('allocs', [])})
+        async with self._storage.pool.acquire() as conn:
+            async with conn.transaction():
+                rows = await conn.fetch('''
+                    SELECT id, amount, is_paid, user_id FROM expense_participant
+                    WHERE id = ANY($1::int[])
+                    FOR UPDATE
+                ''', ep_ids)
+                current = {r['id']: (r['amount'], bool(r['is_paid']), r['user_id']) for r in rows}
+                updates, inserts = await asyncio.to_thread(
+                    debts_optimizer.plan_allocation_updates, current, transfers_with_allocs)
+                await conn.executemany('UPDATE expense_participant SET amount = $1, is_paid = $2 WHERE id = $3', updates)
+                await conn.executemany('''
+                    INSERT INTO expense_participant (expense_id, user_id, amount, is_paid)
+                    VALUES ($1, $2, $3, TRUE)
+                ''', inserts)
+                if run_id is not None:
+                    await conn.execute('INSERT INTO settlement_journal (run_id, state) VALUES ($1, $2)',
+                                       run_id, journal.APPLIED)
+
+    async def journal_planned(self, mode, transfers_with_allocs, event_id=None, chat_id=None, source='bot'):
+        return await self._storage.pool.fetchval('''
+            INSERT INTO settlement_journal (state, source, mode, event_id, chat_id, payload)
+            VALUES ($1, $2, $3, $4, $5, $6)
+            RETURNING id
+        ''', journal.PLANNED, source, mode, event_id, chat_id, journal.dump_plan(transfers_with_allocs))
+
+    async def journal_append(self, run_id, state, message_id=None, detail=None):
+        await self._storage.pool.execute(
+            'INSERT INTO settlement_journal (run_id, state, message_id, payload) VALUES ($1, $2, $3, $4)',
+            run_id, state, message_id, detail)
+
+    async def get_open_runs(self):
+        rows = await self._storage.pool.fetch(f'''
+            SELECT p.id, {_JOURNAL_LAST_STATE}, p.payload
+            FROM settlement_journal p
+            WHERE p.id > (SELECT journal_id FROM settlement_checkpoint WHERE id = 1) AND {_JOURNAL_OPEN_RUN}
+            ORDER BY p.id
+        ''')
+        return [tuple(r) for r in rows]
+
+    async def advance_journal_checkpoint(self):
+        async with self._storage.pool.acquire() as conn:
+            async with conn.transaction():
+                # id выдаются до фиксации транзакции: блокировка дожидается незафиксированных записей с меньшими id,
+                # иначе позиция могла бы перескочить через запуск, который ещё не виден
+                await conn.execute('LOCK TABLE settlement_journal IN EXCLUSIVE MODE')
+                checkpoint = await conn.fetchval('SELECT journal_id FROM settlement_checkpoint WHERE id = 1')
+                first_open = await conn.fetchval(f'''
+                    SELECT MIN(p.id) FROM settlement_journal p WHERE p.id > $1 AND {_JOURNAL_OPEN_RUN}
+                ''', checkpoint)
+                if first_open is not None:
+                    checkpoint = first_open - 1
+                else:
+                    checkpoint = await conn.fetchval('SELECT COALESCE(MAX(id), $1) FROM settlement_journal', checkpoint)
+                await conn.execute('UPDATE settlement_checkpoint SET journal_id = $1 WHERE id = 1', checkpoint)
+                return checkpoint
+
+    async def get_recent_runs(self, limit=10):
+        rows = await self._storage.pool.fetch(f'''
+            SELECT p.id, to_char(p.created_at, 'YYYY-MM-DD HH24:MI:SS'), p.source, p.mode, p.event_id, p.payload,
+                   {_JOURNAL_LAST_STATE}, {_JOURNAL_LAST_ERROR}
+            FROM settlement_journal p
+            WHERE p.state = $1
+            ORDER BY p.id DESC
+            LIMIT $2
+        ''', journal.PLANNED, limit)
+        return _recent_runs(rows)
+
+    async def mark_all_paid(self):
+        await self._storage.pool.execute('UPDATE expense_participant SET is_paid = TRUE WHERE NOT is_paid')
+
+    async def compact_paid_shares(self):
+        async with self._storage.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute('''
+                    CREATE TEMP TABLE paid_merge ON COMMIT DROP AS
+                    SELECT expense_id, user_id, MIN(id) AS keep_id,
+                           ROUND(SUM(amount)::numeric, 2)::double precision AS total
+                    FROM expense_participant
+                    WHERE is_paid
+                    GROUP BY expense_id, user_id
+                    HAVING COUNT(*) > 1
+                ''')
+                await conn.execute('''
+                    UPDATE expense_participant ep SET amount = m.total
+                    FROM paid_merge m WHERE ep.id = m.keep_id
+                ''')
+                status = await conn.execute('''
+                    DELETE FROM expense_participant ep
+                    USING paid_merge m
+                    WHERE ep.is_paid AND ep.expense_id = m.expense_id AND ep.user_id = m.user_id AND ep.id <> m.keep_id
+                ''')
+                return int(status.split()[-1])
+
+    async def archive_settled(self):
+        async with self._storage.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute('''
+                    CREATE TEMP TABLE archive_ids ON COMMIT DROP AS
+                    SELECT e.id FROM expense e
+                    JOIN event ev ON ev.id = e.event_id
+                    WHERE ev.closed_at IS NOT NULL
+                      AND NOT EXISTS (SELECT 1 FROM expense_participant ep WHERE ep.expense_id = e.id AND NOT ep.is_paid)
+                ''')
+                moved = {}
+                for table, columns, ref in ARCHIVED_TABLES:
+                    status = await conn.execute(f'''
+                        INSERT INTO {table}_archive ({columns})
+                        SELECT {columns} FROM {table} WHERE {ref} IN (SELECT id FROM archive_ids)
+                    ''')
+                    moved[table] = int(status.split()[-1])
+                for table, _, ref in reversed(ARCHIVED_TABLES):
+                    await conn.execute(f'DELETE FROM {table} WHERE {ref} IN (SELECT id FROM archive_ids)')
+                return moved['expense'], moved['expense_participant']
+
+
+class PostgresStatsRepository(StatsRepository):
+    def __init__(self, storage):
+        self._storage = storage
+
+    async def get_daily(self, event_id=DEFAULT_EVENT_ID, user_id=None, date_from=None, date_to=None):
+        rows = await self._storage.pool.fetch('''
+            SELECT day, category_id, currency, ROUND(SUM(spent)::numeric, 2)::double precision,
+                   ROUND(SUM(paid)::numeric, 2)::double precision
+            FROM spending_daily
+            WHERE event_id = $1
+              AND ($2::bigint IS NULL OR user_id = $2)
+              AND ($3::text IS NULL OR day >= $3)
+              AND ($4::text IS NULL OR day <= $4)
+            GROUP BY day, category_id, currency
+            ORDER BY day
+        ''', event_id, user_id, date_from, date_to)
+        return [tuple(r) for r in rows]
+
+    async def rebuild(self):
+        async with self._storage.pool.acquire() as conn:
+            async with conn.transaction():
+                # запись платежей ждёт конца пересчёта, иначе новые доли могли бы не попасть в сводки
+                await conn.execute('LOCK TABLE expense, expense_participant IN SHARE MODE')
+                rows = _rollups_from_source(await conn.fetch(_ROLLUP_SOURCE_SQL))
+                await conn.execute('DELETE FROM spending_daily')
+                await conn.executemany(_PG_ROLLUP_UPSERT, rows)
+                return len(rows)
+
+
+class PostgresStorage(Storage):
+    def __init__(self, dsn, min_size=1, max_size=10, read_only=False):
+        """read_only=True — все транзакции пула только для чтения (default_transaction_read_only)."""
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.read_only = read_only
+        self.pool = None
+        self.users = PostgresUserRepository(self)
+        self.expenses = PostgresExpenseRepository(self)
+        self.ledger = PostgresLedgerRepository(self)
+        self.stats = PostgresStatsRepository(self)
+
+    async def connect(self):
+        import asyncpg
+        if self.pool is None:
+            server_settings = {'default_transaction_read_only': 'on'} if self.read_only else None
+            self.pool = await asyncpg.create_pool(
+                self.dsn, min_size=self.min_size, max_size=self.max_size, init=self._init_connection,
+                server_settings=server_settings)
+
+    async def _init_connection(self, conn):
+        # журнал медленных запросов (diagnostics.py); add_query_logger есть в asyncpg начиная с 0.29
+        if diagnostics.slow_query_enabled() and hasattr(conn, 'add_query_logger'):
+            conn.add_query_logger(diagnostics.asyncpg_query_logger)
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    async def optimize(self, vacuum_free_ratio=0.2):
+        # обычный VACUUM не блокирует запись и только помечает место свободным; файл не переписывается,
+        # поэтому vacuum_free_ratio здесь не нужен. VACUUM нельзя выполнять внутри транзакции.
+        await self.pool.execute('VACUUM (ANALYZE) expense_participant, expense, expense_item')
+        return True
+
+    async def missing_tables(self, tables=CORE_TABLES):
+        return [t for t in tables if await self.pool.fetchval('SELECT to_regclass($1) IS NULL', f'"{t}"')]
+
+    async def init_schema(self):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute('''
+                    CREATE TABLE IF NOT EXISTS event (
+                        id SERIAL PRIMARY KEY,
+                        name TEXT NOT NULL
+                    )
+                ''')
+                await conn.execute('''
+                    CREATE TABLE IF NOT EXISTS "user" (
+                        id BIGINT PRIMARY KEY,
+                        name TEXT NOT NULL,
+                        payment_credentials TEXT
+                    )
+                ''')
+                await conn.execute('ALTER TABLE "user" ADD COLUMN IF NOT EXISTS username TEXT')
+                await conn.execute('CREATE INDEX IF NOT EXISTS idx_user_username ON "user" (username)')
+                await conn.execute('''
+                    CREATE TABLE IF NOT EXISTS category (
+                        id SERIAL PRIMARY KEY,
+                        name TEXT NOT NULL UNIQUE
+                    )
+                ''')
+                await conn.execute('''
+                    CREATE TABLE IF NOT EXISTS expense (
+                        id SERIAL PRIMARY KEY,
+                        amount DOUBLE PRECISION NOT NULL,
+                        currency TEXT NOT NULL DEFAULT 'RUB',
+                        event_id INTEGER NOT NULL REFERENCES event (id),
+                        name TEXT NOT NULL,
+                        paid_date TEXT,
+                        user_id BIGINT NOT NULL REFERENCES "user" (id),
+                        message_id BIGINT NOT NULL,
+                        category_id INTEGER REFERENCES category (id)
+                    )
+                ''')
+                await conn.execute('''
+                    CREATE TABLE IF NOT EXISTS expense_participant (
+                        id SERIAL PRIMARY KEY,
+                        amount DOUBLE PRECISION NOT NULL,
+                        expense_id INTEGER NOT NULL REFERENCES expense (id),
+                        is_paid BOOLEAN NOT NULL DEFAULT FALSE,
+                        user_id BIGINT NOT NULL REFERENCES "user" (id)
+                    )
+                ''')
+                await conn.execute('''
+                    CREATE TABLE IF NOT EXISTS expense_item (
+                        id SERIAL PRIMARY KEY,
+                        expense_id INTEGER NOT NULL REFERENCES expense (id),
+                        position INTEGER NOT NULL,
+                        name TEXT NOT NULL,
+                        quantity DOUBLE PRECISION NOT NULL DEFAULT 1,
+                        price DOUBLE PRECISION NOT NULL,
+                        amount DOUBLE PRECISION NOT NULL,
+                        claimed_by BIGINT REFERENCES "user" (id),
+                        UNIQUE (expense_id, position)
+                    )
+                ''')
+                await conn.execute('CREATE INDEX IF NOT EXISTS idx_expense_message_id ON expense (message_id)')
+                await conn.execute('CREATE INDEX IF NOT EXISTS idx_ep_unpaid ON expense_participant (user_id) WHERE NOT is_paid')
+                await conn.execute('CREATE INDEX IF NOT EXISTS idx_ep_expense ON expense_participant (expense_id, user_id)')
+                await conn.execute('ALTER TABLE event ADD COLUMN IF NOT EXISTS closed_at TIMESTAMP')
+
+                # архив: те же колонки без внешних ключей на горячие таблицы
+                await conn.execute('''
+                    CREATE TABLE IF NOT EXISTS expense_archive (
+                        id INTEGER PRIMARY KEY,
+                        amount DOUBLE PRECISION NOT NULL,
+                        currency TEXT NOT NULL,
+                        event_id INTEGER NOT NULL,
+                        name TEXT NOT NULL,
+                        paid_date TEXT,
+                        user_id BIGINT NOT NULL,
+                        message_id BIGINT NOT NULL,
+                        category_id INTEGER,
+                        archived_at TIMESTAMP NOT NULL DEFAULT NOW()
+                    )
+                ''')
+                await conn.execute('''
+                    CREATE TABLE IF NOT EXISTS expense_participant_archive (
+                        id INTEGER PRIMARY KEY,
+                        amount DOUBLE PRECISION NOT NULL,
+                        expense_id INTEGER NOT NULL,
+                        is_paid BOOLEAN NOT NULL,
+                        user_id BIGINT NOT NULL,
+                        archived_at TIMESTAMP NOT NULL DEFAULT NOW()
+                    )
+                ''')
+                await conn.execute('''
+                    CREATE TABLE IF NOT EXISTS expense_item_archive (
+                        id INTEGER PRIMARY KEY,
+                        expense_id INTEGER NOT NULL,
+                        position INTEGER NOT NULL,
+                        name TEXT NOT NULL,
+                        quantity DOUBLE PRECISION NOT NULL,
+                        price DOUBLE PRECISION NOT NULL,
+                        amount DOUBLE PRECISION NOT NULL,
+                        claimed_by BIGINT,
+                        archived_at TIMESTAMP NOT NULL DEFAULT NOW()
+                    )
+                ''')
+                await conn.execute('CREATE INDEX IF NOT EXISTS idx_expense_archive_event ON expense_archive (event_id)')
+                await conn.execute('CREATE INDEX IF NOT EXISTS idx_ep_archive_expense ON expense_participant_archive (expense_id)')
+
+                # журнал расчётов (journal.py)
+                await conn.execute('''
+                    CREATE TABLE IF NOT EXISTS settlement_journal (
+                        id BIGSERIAL PRIMARY KEY,
+                        run_id BIGINT,
+                        state TEXT NOT NULL,
+                        created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                        source TEXT,
+                        mode TEXT,
+                        event_id INTEGER,
+                        chat_id BIGINT,
+                        message_id BIGINT,
+                        payload TEXT
+                    )
+                ''')
+                await conn.execute('CREATE INDEX IF NOT EXISTS idx_settlement_journal_run ON settlement_journal (run_id)')
+                await conn.execute('''
+                    CREATE TABLE IF NOT EXISTS settlement_checkpoint (
+                        id INTEGER PRIMARY KEY CHECK (id = 1),
+                        journal_id BIGINT NOT NULL
+                    )
+                ''')
+                await conn.execute(
+                    'INSERT INTO settlement_checkpoint (id, journal_id) VALUES (1, 0) ON CONFLICT (id) DO NOTHING')
+
+                # дневные сводки трат (stats.py)
+                rollups_missing = await conn.fetchval("SELECT to_regclass('spending_daily') IS NULL")
+                await conn.execute('''
+                    CREATE TABLE IF NOT EXISTS spending_daily (
+                        event_id INTEGER NOT NULL,
+                        day TEXT NOT NULL,
+                        user_id BIGINT NOT NULL,
+                        category_id INTEGER NOT NULL,
+                        currency TEXT NOT NULL,
+                        spent DOUBLE PRECISION NOT NULL DEFAULT 0,
+                        paid DOUBLE PRECISION NOT NULL DEFAULT 0,
+                        PRIMARY KEY (event_id, day, user_id, category_id, currency)
+                    )
+                ''')
+
+                await conn.execute(
+                    'INSERT INTO event (id, name) VALUES ($1, $2) ON CONFLICT (id) DO NOTHING',
+                    DEFAULT_EVENT_ID, DEFAULT_EVENT_NAME)
+                await conn.execute(
+                    "SELECT setval(pg_get_serial_sequence('event', 'id'), (SELECT MAX(id) FROM event))")
+
+                cnt = await conn.fetchval('SELECT COUNT(*) FROM category')
+                if cnt == 0:
+                    await conn.executemany('INSERT INTO category (name) VALUES ($1)', [(n,) for n in DEFAULT_CATEGORIES])
+        if rollups_missing:
+            logger.info('Строю дневные сводки трат: %s строк', await self.stats.rebuild())
+
+
+def create_storage(cfg=None):
+    """Создаёт хранилище по настройкам из config.py (DB_BACKEND, DB_PATH, POSTGRES_DSN)."""
+    backend = str(getattr(cfg, 'DB_BACKEND', 'sqlite')).lower()
+    if backend in ('postgres', 'postgresql'):
+        storage = PostgresStorage(
+            getattr(cfg, 'POSTGRES_DSN'),
+            min_size=getattr(cfg, 'POSTGRES_POOL_MIN', 1),
+            max_size=getattr(cfg, 'POSTGRES_POOL_MAX', 10),
+        )
+    elif backend == 'sqlite':
+        storage = SqliteStorage(getattr(cfg, 'DB_PATH', DEFAULT_DB_PATH))
+    else:
+        raise ValueError(f'Неизвестный DB_BACKEND: {backend}')
+    if metrics.enabled():
+        metrics.instrument(storage.users, 'db_query_seconds', 'users')
+        metrics.instrument(storage.expenses, 'db_query_seconds', 'expenses')
+        metrics.instrument(storage.ledger, 'db_query_seconds', 'ledger')
+        metrics.instrument(storage.stats, 'db_query_seconds', 'stats')
+    return storage
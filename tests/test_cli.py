@@ -0,0 +1,62 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+
+import debts_optimizer
+import storage
+
+
+def _make_db(path):
+    async def fill():
+        st = storage.SqliteStorage(str(path))
+        await st.init_schema()
+        for uid in (1, 2, 3):
+            await st.users.get_or_create(uid, f'U{uid}')
+        payment_id = await st.expenses.create({'description': 'ужин', 'user_id': 1, 'timestamp': '01.07.2024 20:00',
+                                               'amount': 90.0, 'currency': 'RUB'}, message_id=1)
+        await st.expenses.add_shares(payment_id, [(2, 'U2', 30.0), (3, 'U3', 30.0)])
+    asyncio.run(fill())
+    # чекпоинт WAL, чтобы всё состояние было в самом файле
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    conn.close()
+
+
+def _digest(path):
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def test_dry_run_does_not_touch_database(tmp_path, capsys):
+    path = tmp_path / 'expenses.db'
+    _make_db(path)
+    before = _digest(path)
+    assert debts_optimizer.main(['--db', str(path), '--all-events', '--dry-run', '--json']) == 0
+    record = json.loads(capsys.readouterr().out.splitlines()[0])
+    assert record['dry_run'] and not record['applied']
+    assert sum(t['amount'] for t in record['transfers']) == 60.0
+    assert _digest(path) == before
+
+
+def test_dry_run_refuses_database_without_schema(tmp_path, capsys):
+    path = tmp_path / 'empty.db'
+    sqlite3.connect(path).close()
+    try:
+        debts_optimizer.main(['--db', str(path), '--all-events', '--dry-run'])
+    except SystemExit as e:
+        assert 'expense_participant' in str(e)
+    else:
+        raise AssertionError('ожидался SystemExit')
+    conn = sqlite3.connect(path)
+    assert conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0] == 0
+
+
+def test_run_applies_and_journals(tmp_path, capsys):
+    path = tmp_path / 'expenses.db'
+    _make_db(path)
+    assert debts_optimizer.main(['--db', str(path), '--all-events', '--json']) == 0
+    record = json.loads(capsys.readouterr().out.splitlines()[0])
+    assert record['applied']
+    conn = sqlite3.connect(path)
+    assert conn.execute('SELECT COUNT(*) FROM expense_participant WHERE is_paid = 0 AND user_id != 1').fetchone()[0] == 0
+    assert [r[0] for r in conn.execute('SELECT state FROM settlement_journal ORDER BY id')] == ['planned', 'applied']
@@ -0,0 +1,62 @@
+import asyncio
+import sqlite3
+import time
+
+import diagnostics
+
+
+def _conn():
+    conn = sqlite3.connect(':memory:', factory=diagnostics.ProfiledConnection)
+    conn.execute('CREATE TABLE t (a INTEGER, b TEXT)')
+    return conn
+
+
+def test_executemany_passes_iterable_through_when_log_is_off(monkeypatch):
+    monkeypatch.setattr(diagnostics, '_slow_query_seconds', None)
+    conn = _conn()
+    consumed = []
+
+    def rows():
+        for i in range(3):
+            consumed.append(i)
+            yield (i, str(i))
+
+    conn.executemany('INSERT INTO t VALUES (?, ?)', rows())
+    assert consumed == [0, 1, 2]
+    assert conn.execute('SELECT COUNT(*) FROM t').fetchone()[0] == 3
+
+
+def test_executemany_records_count_and_first_params(monkeypatch):
+    monkeypatch.setattr(diagnostics, '_slow_query_seconds', 0.0)
+    diagnostics.SLOW_QUERIES.clear()
+    conn = _conn()
+    conn.executemany('INSERT INTO t VALUES (?, ?)', ((i, str(i)) for i in range(5)))
+    entry = diagnostics.SLOW_QUERIES[-1]
+    assert entry['params'].startswith('executemany x5 ')
+    assert conn.execute('SELECT COUNT(*) FROM t').fetchone()[0] == 5
+
+
+def _busy_worker(seconds):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        sum(range(1000))
+
+
+def test_profiler_samples_to_thread_workers(tmp_path):
+    async def workload():
+        await asyncio.to_thread(_busy_worker, 0.3)
+
+    diagnostics.start_profiling(interval=0.002)
+    try:
+        asyncio.run(workload())
+    finally:
+        path, sampler = diagnostics.stop_profiling(str(tmp_path))
+    assert sampler.samples > 0
+    worker_stacks = [stack for stack in sampler.stacks if '_busy_worker' in stack]
+    assert worker_stacks
+    # стек рабочего потока начинается с его имени, а не с основного потока
+    assert all(stack.split(';', 1)[0].startswith('asyncio_') for stack in worker_stacks)
+    assert not any(stack.startswith('profiler;') for stack in sampler.stacks)
+    assert any(thread.startswith('asyncio_') for (thread, _), _ in sampler.top_functions())
+    with open(path, encoding='utf-8') as f:
+        assert any('_busy_worker' in line for line in f)
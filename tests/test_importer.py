@@ -0,0 +1,177 @@
+import asyncio
+import io
+
+import pytest
+
+import export
+import importer
+import storage
+
+SPLITWISE_HEADER = 'Date,Description,Category,Cost,Currency,Anna,Bob,Carl\n'
+
+
+def _csv(text):
+    return io.BytesIO(text.encode('utf-8'))
+
+
+def _run(tmp_path, test, name='test.db'):
+    async def main():
+        st = storage.SqliteStorage(str(tmp_path / name))
+        await st.init_schema()
+        return await test(st)
+    return asyncio.run(main())
+
+
+async def _users(st):
+    await st.users.get_or_create(1, 'Anna')
+    await st.users.get_or_create(2, 'Борис', 'boris')
+    await st.users.get_or_create(3, 'Carl')
+
+
+def test_detect_format():
+    assert importer.detect_format(export.SHARE_FIELDS) == 'native'
+    assert importer.detect_format(SPLITWISE_HEADER.strip().split(',')) == 'splitwise'
+    with pytest.raises(importer.ImportFormatError):
+        importer.detect_format(importer.SPLITWISE_FIXED)
+    with pytest.raises(importer.ImportFormatError):
+        importer.detect_format(['date', 'amount'])
+
+
+def test_parse_mapping():
+    assert importer.parse_mapping('Anna=@anna, Bob = boris;Carl Jr=@CJ') == {
+        'anna': 'anna', 'bob': 'boris', 'carl jr': 'cj'}
+    assert importer.parse_mapping(None) == {}
+
+
+def test_native_round_trip(tmp_path):
+    async def source(st):
+        await _users(st)
+        categories = dict((name, cid) for cid, name in await st.expenses.get_categories())
+        await st.expenses.create_many([
+            {'description': 'Ужин, "у Ашота"', 'user_id': 1, 'timestamp': '05.07.2024 20:00', 'amount': 90.0,
+             'currency': 'RUB', 'category_id': categories['Еда'],
+             'shares': [(2, 'Борис', 30.0), (3, 'Carl', 30.0, True)]},
+            {'description': 'Такси', 'user_id': 2, 'timestamp': '06.07.2024 01:10', 'amount': 12.5, 'currency': 'USD',
+             'shares': []},
+        ])
+        files, count = await export.export_event(st)
+        assert count == 3
+        data = dict(files)['expenses.csv'].read()
+        for _, buf in files:
+            buf.close()
+        return data, [row async for row in st.expenses.iter_export_rows()]
+
+    data, rows = _run(tmp_path, source, 'source.db')
+
+    async def target(st):
+        result = await importer.import_csv(st, io.BytesIO(data))
+        assert (result.payments, result.shares, result.rejected) == (2, 2, [])
+        return [row async for row in st.expenses.iter_export_rows()]
+
+    imported = _run(tmp_path, target, 'target.db')
+    # всё, кроме id платежей, совпадает: участники, доли, статусы оплаты, категории
+    assert [r[1:] for r in imported] == [r[1:] for r in rows]
+
+
+def test_native_rejected_rows(tmp_path):
+    header = ','.join(export.SHARE_FIELDS) + '\n'
+    text = header + (
+        '1,05.07.2024 20:00,Ок,,RUB,50,1,Anna,2,Борис,20,False\n'
+        '2,05.07.2024 20:00,Мало,,RUB,10,1,Anna,2,Борис,20,False\n'   # доли больше суммы
+        '3,05.07.2024 20:00,Текст,,RUB,abc,1,Anna,,,,\n'
+        '4,05.07.2024 20:00,Валюта,,RUBLES,5,1,Anna,,,,\n'
+        '5,,Без даты,,RUB,5,1,Anna,,,,\n'
+        '6,05.07.2024 20:00,Плательщик,,RUB,5,x,Anna,,,,\n'
+        '7,05.07.2024 20:00,Две строки,,RUB,5,1,Anna,2,Борис,-1,False\n'
+        '7,05.07.2024 20:00,Две строки,,RUB,5,1,Anna,3,Carl,1,False\n'
+    )
+
+    async def test(st):
+        await _users(st)
+        return await importer.import_csv(st, _csv(text))
+
+    result = _run(tmp_path, test)
+    assert (result.payments, result.shares) == (1, 1)
+    assert [line for line, _ in result.rejected] == [3, 4, 5, 6, 7, 8, 9]
+    reasons = dict(result.rejected)
+    assert 'не число "abc"' in reasons[4]
+    assert 'валюта' in reasons[5]
+    assert reasons[8] == reasons[9] == 'доля должна быть больше 0'
+    summary = result.summary()
+    assert 'Отклонено строк: 7' in summary and 'строка 4:' in summary
+
+
+def test_splitwise_balances_become_payments(tmp_path):
+    text = SPLITWISE_HEADER + (
+        '2024-01-15,Dinner,Еда,90,RUB,60,-30,-30\n'
+        '2024-01-16,Taxi,Unknown category,10,usd,-3.33,6.67,-3.33\n'  # сумма -1 копейка: в пределах допуска
+        '2024-01-17,Broken,,10,RUB,5,-3,-1\n'                          # не сходится в ноль
+        '2024-01-18,Short,,10\n'
+        'not a date,Bad,,10,RUB,1,-1,0\n'
+        ',Total balance,,,RUB,57,-23,-33\n'
+    )
+
+    async def test(st):
+        await _users(st)
+        # Bob сопоставляется по подписи, Anna и Carl — по совпадению имени
+        result = await importer.import_csv(st, _csv(text), 'Bob=@boris')
+        payments = await st.expenses.get_recent(limit=10)
+        shares = {p[4]: sorted((r[4], r[1]) for r in await st.expenses.get_shares(p[0])) for p in payments}
+        return result, {p[4]: (p[6], p[1], p[2], p[5]) for p in payments}, shares
+
+    result, payments, shares = _run(tmp_path, test)
+    assert (result.payments, result.shares) == (2, 4)
+    assert [line for line, _ in result.rejected] == [4, 5, 6]
+    assert 'не сходятся' in dict(result.rejected)[4]
+    assert payments == {'Dinner': (1, 60.0, 'RUB', '15.01.2024 00:00'), 'Taxi': (2, 6.66, 'USD', '16.01.2024 00:00')}
+    assert shares == {'Dinner': [(2, 30.0), (3, 30.0)], 'Taxi': [(1, 3.33), (3, 3.33)]}
+
+
+def test_splitwise_unmapped_members(tmp_path):
+    async def test(st):
+        await _users(st)
+        await st.users.get_or_create(4, 'Carl')  # два Carl — по имени не сопоставить
+        with pytest.raises(importer.ImportFormatError, match='Bob, Carl'):
+            await importer.import_csv(st, _csv(SPLITWISE_HEADER + '2024-01-15,X,,1,RUB,1,-1,0\n'))
+        # подпись с неизвестным username тоже не сопоставляет
+        with pytest.raises(importer.ImportFormatError, match=': Carl\\.'):
+            await importer.import_csv(st, _csv(SPLITWISE_HEADER + '2024-01-15,X,,1,RUB,1,-1,0\n'),
+                                      'Bob=@boris, Carl=@nobody')
+        assert await st.expenses.get_recent() == []
+    _run(tmp_path, test)
+
+
+def test_empty_file(tmp_path):
+    async def test(st):
+        with pytest.raises(importer.ImportFormatError, match='Пустой'):
+            await importer.import_csv(st, _csv(''))
+    _run(tmp_path, test)
+
+
+class _FailingExpenses:
+    """Заглушка ExpenseRepository: create_many падает на пачке с платежом 'bad'."""
+
+    def __init__(self):
+        self.saved = []
+
+    async def get_categories(self):
+        return []
+
+    async def create_many(self, payments):
+        if any(p['description'] == 'bad' for p in payments):
+            raise RuntimeError('disk I/O error')
+        self.saved.extend(payments)
+        return list(range(len(payments)))
+
+
+def test_failed_chunk_rejects_all_its_rows():
+    header = ','.join(export.SHARE_FIELDS) + '\n'
+    rows = [f'{i},05.07.2024 20:00,{name},,RUB,10,1,Anna,2,Борис,5,False\n'
+            for i, name in enumerate(['ok1', 'ok2', 'ok3', 'bad', 'ok5'], start=1)]
+    st = type('Storage', (), {'expenses': _FailingExpenses()})()
+    result = asyncio.run(importer.import_csv(st, _csv(header + ''.join(rows)), chunk_size=2))
+    # пачки: [ok1, ok2], [ok3, bad] — откатывается целиком, [ok5]
+    assert [p['description'] for p in st.expenses.saved] == ['ok1', 'ok2', 'ok5']
+    assert (result.payments, result.shares) == (3, 3)
+    assert [line for line, _ in result.rejected] == [4, 5]
+    assert all(reason == 'ошибка записи: disk I/O error' for _, reason in result.rejected)
@@ -0,0 +1,125 @@
+import asyncio
+import types
+
+import pytest
+
+import live_plan
+
+DELAY = 0.05
+
+
+class FakeLedger:
+    """Суммы долгов по парам (debtor, creditor, amount, currency); считает запросы по валютам."""
+
+    def __init__(self, totals):
+        self.totals = list(totals)
+        self.calls = []
+
+    async def get_unpaid_totals(self, currency=None):
+        self.calls.append(currency)
+        return [t for t in self.totals if currency is None or t[3] == currency]
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+        self.edits = []
+        self.pinned = []
+        self.fail_edit_in = set()
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+        return types.SimpleNamespace(message_id=100 + len(self.sent))
+
+    async def pin_chat_message(self, chat_id, message_id):
+        self.pinned.append((chat_id, message_id))
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        if chat_id in self.fail_edit_in:
+            raise RuntimeError('message to edit not found')
+        self.edits.append((chat_id, message_id, text))
+
+
+async def render(transfers):
+    return '\n'.join(f"{t['from']}->{t['to']} {t['amount']:.2f} {t['currency']}" for t in transfers) or 'пусто'
+
+
+async def _live(totals, chats=(1,)):
+    ledger = FakeLedger(totals)
+    bot = FakeBot()
+    plan = live_plan.LivePlan(ledger, render, delay=DELAY)
+    for chat_id in chats:
+        await plan.enable(bot, chat_id)
+    ledger.calls.clear()
+    return plan, ledger, bot
+
+
+def test_enable_sends_and_pins():
+    async def main():
+        plan, ledger, bot = await _live([(2, 1, 30.0, 'RUB')])
+        assert bot.sent == [(1, '2->1 30.00 RUB')] and bot.pinned == [(1, 101)]
+        assert plan.enabled(1) and not plan.enabled(2)
+    asyncio.run(main())
+
+
+def test_touches_in_window_give_one_recompute_and_one_edit():
+    async def main():
+        plan, ledger, bot = await _live([(2, 1, 30.0, 'RUB'), (3, 1, 5.0, 'USD')], chats=(1, 2))
+        for amount in (10.0, 20.0, 40.0):
+            ledger.totals[0] = (2, 1, amount, 'RUB')
+            plan.touch('rub ')
+            await asyncio.sleep(DELAY / 10)
+        assert bot.edits == []
+        await asyncio.sleep(DELAY * 2)
+        # одно окно — один запрос по валюте и одна правка в каждом чате, с последним состоянием
+        assert ledger.calls == ['RUB']
+        assert bot.edits == [(chat, 100 + chat, '2->1 40.00 RUB\n3->1 5.00 USD') for chat in (1, 2)]
+        # новое окно после пересчёта
+        ledger.totals[1] = (3, 1, 7.0, 'USD')
+        plan.touch('USD')
+        await asyncio.sleep(DELAY * 2)
+        assert ledger.calls == ['RUB', 'USD']
+        assert len(bot.edits) == 4
+        plan.close()
+    asyncio.run(main())
+
+
+def test_unchanged_plan_is_not_edited_and_other_currencies_come_from_cache():
+    async def main():
+        plan, ledger, bot = await _live([(2, 1, 30.0, 'RUB'), (3, 1, 5.0, 'USD')])
+        plan.touch('RUB')
+        await asyncio.sleep(DELAY * 2)
+        assert ledger.calls == ['RUB'] and bot.edits == []
+        # долг в USD погашен: пересчитывается только USD, RUB остаётся из кэша
+        ledger.totals = [(2, 1, 30.0, 'RUB')]
+        assert await plan.refresh({'USD'}) == 1
+        assert plan.plans == {'RUB': [(2, 1, 30.0, 'RUB')]}
+        assert bot.edits[-1][2] == '2->1 30.00 RUB'
+        # None — пересчёт всех валют одним запросом
+        ledger.calls.clear()
+        ledger.totals.append((4, 2, 1.5, 'EUR'))
+        plan.touch()
+        await asyncio.sleep(DELAY * 2)
+        assert ledger.calls == [None]
+        assert set(plan.plans) == {'RUB', 'EUR'}
+    asyncio.run(main())
+
+
+def test_failed_edit_disables_chat_and_last_chat_resets_cache():
+    async def main():
+        plan, ledger, bot = await _live([(2, 1, 30.0, 'RUB')], chats=(1, 2))
+        bot.fail_edit_in.add(2)
+        ledger.totals[0] = (2, 1, 10.0, 'RUB')
+        assert await plan.refresh({'RUB'}) == 1
+        assert plan.enabled(1) and not plan.enabled(2)
+        assert plan.disable(1) == 101
+        assert plan.plans is None
+        # без чатов touch ничего не планирует
+        plan.touch('RUB')
+        assert plan._task is None
+    asyncio.run(main())
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        live_plan.LivePlan(FakeLedger([]), render, mode='greedy')
@@ -0,0 +1,121 @@
+import asyncio
+import re
+import time
+
+import pytest
+from hypothesis import given, settings, strategies as st
+from telegram.error import RetryAfter
+
+import messaging
+
+words = st.text(alphabet='абвгдежзabc0123456789.,:', min_size=1, max_size=15)
+mentions = st.builds(lambda uid, name: f'<a href="tg://user?id={uid}">{name}</a>',
+                     st.integers(1, 10 ** 10), st.sampled_from(['Анна', 'Борис Петров', 'Вера Ивановна Сидорова']))
+lines = st.lists(st.one_of(words, mentions), max_size=30).map(' '.join)
+texts = st.lists(lines, max_size=15).map('\n'.join)
+
+
+def _content(text):
+    return ''.join(text.split())
+
+
+@given(texts, st.integers(min_value=100, max_value=300))
+@settings(max_examples=300)
+def test_split_message_properties(text, limit):
+    # limit больше любого упоминания: элемент длиннее самого limit целым не поместить
+    parts = messaging.split_message(text, limit)
+    assert parts
+    assert all(len(part) <= limit for part in parts)
+    # текст не теряется и не переставляется: отличия только в пробелах на местах разрезов
+    assert _content(''.join(parts)) == _content(text)
+    for part in parts:
+        # упоминание целиком в одной части
+        assert part.count('<a ') == part.count('</a>')
+        assert all(re.fullmatch(r'<a href="tg://user\?id=\d+">[^<]*</a>', m) for m in re.findall(r'<a [^<]*</a>', part))
+
+
+def test_split_message_by_lines():
+    text = '\n'.join(f'строка {i}' for i in range(1000))
+    parts = messaging.split_message(text)
+    assert len(parts) > 1
+    assert all(len(p) <= messaging.MAX_MESSAGE_LENGTH for p in parts)
+    assert '\n'.join(parts) == text
+    assert messaging.split_message('') == ['']
+    assert messaging.split_message('короткий') == ['короткий']
+
+
+def test_cut_position_skips_mentions():
+    line = 'долг ' + '<a href="tg://user?id=1">Анна Петрова</a>' + ' 100'
+    cut = messaging._cut_position(line, line.index('Петрова'))
+    assert cut == 4
+    # пробела вне упоминания нет — режется по limit
+    assert messaging._cut_position('x' * 50, 20) == 20
+
+
+def _retry_after():
+    return RetryAfter(0)
+
+
+def test_retry_after_is_retried_up_to_max_retries():
+    async def main():
+        limiter = messaging.TokenBucketRateLimiter(max_retries=2)
+        calls = []
+
+        async def flaky(fail_times):
+            calls.append(time.monotonic())
+            if len(calls) <= fail_times:
+                raise _retry_after()
+            return 'ok'
+
+        assert await limiter.process_request(flaky, (2,), {}, 'sendMessage', {}, None) == 'ok'
+        assert len(calls) == 3
+        calls.clear()
+        with pytest.raises(RetryAfter):
+            await limiter.process_request(flaky, (5,), {}, 'sendMessage', {}, None)
+        assert len(calls) == 3
+        # rate_limit_args запроса переопределяет max_retries
+        calls.clear()
+        with pytest.raises(RetryAfter):
+            await limiter.process_request(flaky, (5,), {}, 'sendMessage', {}, 0)
+        assert len(calls) == 1
+    asyncio.run(main())
+
+
+def test_retry_after_pauses_other_requests():
+    async def main():
+        limiter = messaging.TokenBucketRateLimiter()
+        order = []
+
+        async def limited():
+            order.append('limited')
+            if order.count('limited') == 1:
+                raise _retry_after()
+
+        async def other():
+            order.append('other')
+
+        first = asyncio.create_task(limiter.process_request(limited, (), {}, 'sendMessage', {'chat_id': 1}, None))
+        await asyncio.sleep(0.02)
+        # пауза после 429 уже идёт: другой запрос ждёт её окончания
+        await limiter.process_request(other, (), {}, 'sendMessage', {'chat_id': '2'}, None)
+        await first
+        return order
+    assert asyncio.run(main()) == ['limited', 'limited', 'other']
+
+
+def test_token_bucket_limits_rate():
+    async def main():
+        bucket = messaging.TokenBucket(rate=50, capacity=2)
+        started = time.monotonic()
+        for _ in range(4):
+            await bucket.acquire()
+        return time.monotonic() - started
+    # два токена сразу, ещё два — по 1/50 с
+    assert asyncio.run(main()) >= 0.035
+
+
+def test_chat_buckets_by_chat_type():
+    limiter = messaging.TokenBucketRateLimiter()
+    assert limiter._chat_bucket(-100).capacity == messaging.GROUP_BURST
+    assert limiter._chat_bucket('@channel').capacity == messaging.GROUP_BURST
+    assert limiter._chat_bucket(42).capacity == messaging.PRIVATE_BURST
@@ -0,0 +1,131 @@
+from datetime import datetime
+
+import pytest
+
+import ocr
+
+QR = 't=20240115T1305&s={}&fn=9289000100514832&i=25106&fp=3513452356&n=1'
+
+
+def test_fiscal_payload():
+    receipt = ocr.parse_fiscal_payload(QR.format('1234.50'))
+    assert receipt['total'] == 1234.5
+    assert receipt['timestamp'] == datetime(2024, 1, 15, 13, 5)
+    assert (receipt['fn'], receipt['i'], receipt['fp'], receipt['n']) == ('9289000100514832', '25106', '3513452356', '1')
+    assert ocr.parse_fiscal_payload(QR.format('99,9').replace('T1305', 'T130512'))['timestamp'].second == 12
+
+
+@pytest.mark.parametrize('payload', [
+    None, '', 'https://example.com', 's=100&fn=1',
+    QR.format('0'), QR.format('-5'), QR.format('abc'),
+    QR.format('nan'), QR.format('inf'), QR.format('-inf'), QR.format('1e400'),
+    QR.format('100').replace('20240115T1305', '2024-01-15'),
+])
+def test_fiscal_payload_rejected(payload):
+    assert ocr.parse_fiscal_payload(payload) is None
+
+
+# =========================
+# RECEIPT LINES AND TOTAL SCORING
+# =========================
+
+def _data(lines, conf=90):
+    """Словарь как pytesseract.image_to_data(output_type=DICT): lines — [[слово | (слово, conf, left)], ...].
+
+    Без явного left слова идут слева направо; строки — по 30 пикселей сверху вниз.
+    """
+    data = {k: [] for k in ('text', 'conf', 'left', 'top', 'width', 'height', 'block_num', 'par_num', 'line_num')}
+    for line_num, words in enumerate(lines, start=1):
+        left = 10
+        for word in words:
+            text, word_conf, word_left = word if isinstance(word, tuple) else (word, conf, left)
+            for key, value in (('text', text), ('conf', word_conf), ('left', word_left), ('top', line_num * 30),
+                               ('width', len(text) * 10), ('height', 20), ('block_num', 1), ('par_num', 1),
+                               ('line_num', line_num)):
+                data[key].append(value)
+            left = word_left + len(text) * 10 + 10
+    return data
+
+
+RECEIPT = [
+    ['ООО', 'Ромашка'],
+    ['ИНН', '7701234567'],
+    ['Кассовый', 'чек', '№', '123'],
+    ['Пицца', 'Маргарита', ('450.00', 90, 400)],
+    ['Капучино', '2', 'x', '150.00', ('300.00', 90, 400)],
+    ['Чизкейк', 'Нью-Йорк'],
+    ['с', 'ягодами', ('280.50', 90, 400)],
+    ['ИТОГО', ('1030.50', 90, 400)],
+    ['В', 'т.ч.', 'НДС', '20%', ('171.75', 90, 400)],
+    ['Получено', ('2000.00', 90, 400)],
+    ['Штрихкод', ('46070123456.78', 95, 300)],
+]
+
+
+def test_iter_data_lines_groups_words():
+    data = _data([['Пицца', '', '450.00'], ['ИТОГО', '450.00']])
+    data['text'][1] = '  '
+    lines = list(ocr.iter_data_lines(data))
+    assert [[w['text'] for w in words] for words in lines] == [['Пицца', '450.00'], ['ИТОГО', '450.00']]
+    assert isinstance(lines[0][0]['conf'], float)
+    assert list(ocr.iter_data_lines(_data([]))) == []
+
+
+def test_parse_receipt_lines_consistent():
+    parsed = ocr.parse_receipt_lines(ocr.iter_data_lines(_data(RECEIPT)))
+    assert parsed['items'] == [
+        {'name': 'Пицца Маргарита', 'quantity': 1.0, 'price': 450.0, 'amount': 450.0},
+        {'name': 'Капучино', 'quantity': 2.0, 'price': 150.0, 'amount': 300.0},
+        {'name': 'Чизкейк Нью-Йорк с ягодами', 'quantity': 1.0, 'price': 280.5, 'amount': 280.5},
+    ]
+    assert parsed['total'] == 1030.5
+    assert parsed['consistent']
+
+
+def test_parse_receipt_lines_inconsistent_and_total_on_next_line():
+    lines = [['Пицца', '450.00'], ['Капучино', '150.00'], ['ИТОГО', 'К', 'ОПЛАТЕ'], ['650.00']]
+    parsed = ocr.parse_receipt_lines(ocr.iter_data_lines(_data(lines)))
+    assert parsed['total'] == 650.0
+    assert [i['amount'] for i in parsed['items']] == [450.0, 150.0]
+    assert not parsed['consistent']
+    assert not ocr.parse_receipt_lines(ocr.iter_data_lines(_data([['ИТОГО', '10.00']])))['consistent']
+
+
+def test_total_beats_inn_barcode_and_cash_received():
+    candidates = ocr.score_amount_candidates([_data(RECEIPT)])
+    amounts = [c['amount'] for c in candidates]
+    assert amounts[0] == 1030.5
+    # штрихкод с длинной целой частью — не кандидат; "Получено" и НДС штрафуются
+    assert 46070123456.78 not in amounts
+    assert amounts.index(2000.0) > 0 and amounts.index(171.75) > 0
+    assert ocr.select_total([_data(RECEIPT)])['amount'] == 1030.5
+
+
+def test_digits_glued_to_amount_are_not_a_candidate():
+    data = _data([['ИНН', ('7701234567.89', 95, 400)], ['ИТОГО', ('99.00', 60, 400)]])
+    assert [c['amount'] for c in ocr.score_amount_candidates([data])] == [99.0]
+    assert ocr.select_total([_data([['Спасибо', 'за', 'покупку']])]) is None
+
+
+def test_agreement_across_passes():
+    # второй проход прочитал итог неверно; сумма, встреченная в двух проходах из трёх, выигрывает
+    passes = [_data([['ИТОГО', ('1234.50', 80, 400)]]),
+              _data([['ИТОГО', ('1284.50', 85, 400)]]),
+              _data([['ИТОГО', ('1234.50', 80, 400)]])]
+    candidates = ocr.score_amount_candidates(passes)
+    assert [(c['amount'], c['passes']) for c in candidates] == [(1234.5, 2), (1284.5, 1)]
+    agreed = ocr.select_total(passes)['confidence']
+    assert agreed > ocr.select_total(passes[:2])['confidence']
+    assert 0 < agreed <= 1
+
+
+def test_analyze_passes_confirms_total_by_items():
+    confirmed = ocr.analyze_passes([_data(RECEIPT)])
+    assert confirmed['total'] == 1030.5 and confirmed['consistent'] and confirmed['confidence'] >= 0.95
+    assert len(confirmed['items']) == 3
+    # позиции не сходятся с итогом — их нет в результате, уверенность только по оценке кандидатов
+    broken = [line for line in RECEIPT if line[0] != 'Капучино']
+    unconfirmed = ocr.analyze_passes([_data(broken)])
+    assert unconfirmed['total'] == 1030.5
+    assert not unconfirmed['consistent'] and unconfirmed['items'] == []
+    assert unconfirmed['confidence'] == ocr.select_total([_data(broken)])['confidence']
@@ -0,0 +1,121 @@
+import asyncio
+import threading
+from collections import defaultdict
+
+import pytest
+from hypothesis import given, settings, strategies as st
+
+import debts_optimizer
+
+# (ep_id, debtor_id, creditor_id, amount, currency, expense_id)
+ROWS = [(1, 2, 1, 30.0, 'RUB', 1), (2, 3, 1, 30.0, 'RUB', 1), (3, 1, 2, 10.0, 'RUB', 2)]
+
+
+class Ledger:
+    async def get_unpaid_rows(self, event_id=None):
+        return ROWS
+
+
+def test_plan_is_computed_off_the_loop(monkeypatch):
+    expected = {mode: debts_optimizer.plan_settlement(ROWS, mode) for mode in debts_optimizer.SETTLEMENT_MODES}
+    expected_transfers = debts_optimizer.compute_transfers(ROWS)
+    threads = []
+    compute_transfers = debts_optimizer.compute_transfers
+    compute_direct_settlement = debts_optimizer.compute_direct_settlement
+
+    def recording(fn):
+        def wrapper(*args):
+            threads.append(threading.current_thread())
+            return fn(*args)
+        return wrapper
+    monkeypatch.setattr(debts_optimizer, 'compute_transfers', recording(compute_transfers))
+    monkeypatch.setattr(debts_optimizer, 'compute_direct_settlement', recording(compute_direct_settlement))
+
+    for mode, plan in expected.items():
+        assert asyncio.run(debts_optimizer.optimize_transfers_with_allocations(Ledger(), mode)) == plan
+    assert asyncio.run(debts_optimizer.optimize_transfers(Ledger())) == expected_transfers
+    assert threads and threading.main_thread() not in threads
+
+
+# =========================
+# DIRECT SETTLEMENT
+# =========================
+
+row_lists = st.lists(
+    st.tuples(st.integers(1, 5), st.integers(1, 5), st.integers(1, 50_000), st.sampled_from(['RUB', 'usd ', 'USD'])),
+    max_size=30,
+).map(lambda recs: [(ep_id, debtor, creditor, cents / 100, cur, ep_id % 7 + 1)
+                    for ep_id, (debtor, creditor, cents, cur) in enumerate(recs, start=1)])
+
+
+def _balances(entries):
+    """(from, to, копейки, валюта) -> {(валюта, uid): копейки}, без нулей."""
+    bal = defaultdict(int)
+    for frm, to, cents, cur in entries:
+        bal[(cur, frm)] -= cents
+        bal[(cur, to)] += cents
+    return {k: v for k, v in bal.items() if v}
+
+
+@given(row_lists)
+@settings(max_examples=300, deadline=None)
+def test_direct_settlement_properties(rows):
+    plan = debts_optimizer.compute_direct_settlement(rows)
+    debt_rows = [r for r in rows if r[1] != r[2]]
+    # балансы плана совпадают с балансами долгов
+    assert _balances([(t['from'], t['to'], round(t['amount'] * 100), t['currency']) for t in plan]) == _balances(
+        [(r[1], r[2], round(r[3] * 100), r[4].strip().upper()) for r in debt_rows])
+    # каждая строка, кроме долга самому себе, гасится ровно один раз и целиком
+    allocated = [a for t in plan for a in t['allocs']]
+    assert sorted(a[0] for a in allocated) == sorted(r[0] for r in debt_rows)
+    assert all(a[1] == a[3] for a in allocated)
+    # переводы только по существующим парам должник -> кредитор и не больше чистого долга пары
+    owed = defaultdict(int)
+    for _, debtor, creditor, amount, cur, _ in debt_rows:
+        owed[(cur.strip().upper(), debtor, creditor)] += round(amount * 100)
+    for t in plan:
+        if t['amount'] > 0:
+            key = (t['currency'], t['from'], t['to'])
+            assert round(t['amount'] * 100) <= owed[key] - owed.get((key[0], t['to'], t['from']), 0)
+
+
+def test_direct_settlement_cycles_close_with_zero():
+    rows = [(1, 1, 2, 100.0, 'RUB', 1), (2, 2, 3, 100.0, 'RUB', 2), (3, 3, 1, 100.0, 'RUB', 3),
+            (4, 4, 5, 50.0, 'RUB', 4), (5, 5, 4, 50.0, 'RUB', 5)]
+    plan = debts_optimizer.compute_direct_settlement(rows)
+    assert len(plan) == 4
+    assert all(t['amount'] == 0 for t in plan)
+    assert sorted(a[0] for t in plan for a in t['allocs']) == [1, 2, 3, 4, 5]
+    # цикл с перекосом: гасится общая часть, остаток идёт по существующему ребру
+    plan = debts_optimizer.compute_direct_settlement([(1, 1, 2, 100.0, 'RUB', 1), (2, 2, 3, 100.0, 'RUB', 2),
+                                                      (3, 3, 1, 60.0, 'RUB', 3)])
+    assert sorted((t['from'], t['to'], t['amount']) for t in plan if t['amount']) == [(1, 2, 40.0), (2, 3, 40.0)]
+
+
+def test_min_cost_flow_prefers_cheapest_paths():
+    # A может заплатить C напрямую или через B; прямой путь дешевле
+    flows = debts_optimizer.min_cost_flow({('a', 'b'): 1000, ('b', 'c'): 1000, ('a', 'c'): 600}, {'a': 1000, 'c': -1000})
+    assert flows == {('a', 'c'): 600, ('a', 'b'): 400, ('b', 'c'): 400}
+    assert debts_optimizer.min_cost_flow({('a', 'b'): 5}, {}) == {}
+    with pytest.raises(Exception, match='существующим парам'):
+        debts_optimizer.min_cost_flow({('a', 'b'): 5}, {'a': 10, 'b': -10})
+
+
+@given(st.dictionaries(st.tuples(st.integers(1, 6), st.integers(1, 6)).filter(lambda e: e[0] != e[1]),
+                       st.integers(1, 10_000), max_size=12))
+@settings(max_examples=300, deadline=None)
+def test_min_cost_flow_respects_capacities_and_supply(capacities):
+    # supply по полным рёбрам всегда выполним: весь граф — допустимый поток
+    supply = defaultdict(int)
+    for (u, v), cap in capacities.items():
+        supply[u] += cap
+        supply[v] -= cap
+    flows = debts_optimizer.min_cost_flow(capacities, dict(supply))
+    assert all(0 < cents <= capacities[edge] for edge, cents in flows.items())
+    net = defaultdict(int)
+    for (u, v), cents in flows.items():
+        net[u] += cents
+        net[v] -= cents
+    assert {k: v for k, v in net.items() if v} == {k: v for k, v in supply.items() if v}
+    # стоимость (объём переводов) не больше исходного графа
+    assert sum(flows.values()) <= sum(capacities.values())
@@ -0,0 +1,121 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+from telegram import Chat, Message, Update
+
+import scheduler
+
+_next_id = iter(range(1, 10 ** 6))
+
+
+def _update(chat_id):
+    update_id = next(_next_id)
+    return Update(update_id, message=Message(update_id, datetime.now(), Chat(chat_id, Chat.GROUP)))
+
+
+class Recorder:
+    """Корутины-обработчики, которые записывают начало и конец и следят за параллельностью."""
+
+    def __init__(self):
+        self.events = []
+        self.running = 0
+        self.max_running = 0
+
+    async def handler(self, name, delay=0.01, gate=None):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        self.events.append(('start', name))
+        try:
+            if gate is not None:
+                await gate.wait()
+            await asyncio.sleep(delay)
+        finally:
+            self.running -= 1
+            self.events.append(('end', name))
+
+    def started(self):
+        return [name for kind, name in self.events if kind == 'start']
+
+
+def _submit(processor, chat_id, coroutine):
+    return asyncio.create_task(processor.do_process_update(_update(chat_id), coroutine))
+
+
+def test_per_chat_order_and_worker_limit():
+    async def main():
+        processor = scheduler.FairUpdateProcessor(workers=2)
+        rec = Recorder()
+        tasks = [_submit(processor, chat, rec.handler((chat, i)))
+                 for i in range(3) for chat in (1, 2, 3)]
+        await asyncio.gather(*tasks)
+        return processor, rec
+
+    processor, rec = asyncio.run(main())
+    assert rec.max_running == 2
+    for chat in (1, 2, 3):
+        chat_events = [(kind, name[1]) for kind, name in rec.events if name[0] == chat]
+        # апдейты чата — строго по одному и по порядку
+        assert chat_events == [('start', 0), ('end', 0), ('start', 1), ('end', 1), ('start', 2), ('end', 2)]
+    assert processor.pending == 0 and processor.chats == 0
+
+
+def test_round_robin_does_not_starve_quiet_chat():
+    async def main():
+        processor = scheduler.FairUpdateProcessor(workers=1)
+        rec = Recorder()
+        tasks = [_submit(processor, 1, rec.handler(('noisy', i))) for i in range(5)]
+        await asyncio.sleep(0)
+        tasks.append(_submit(processor, 2, rec.handler(('quiet', 0))))
+        await asyncio.gather(*tasks)
+        return rec
+
+    rec = asyncio.run(main())
+    assert rec.max_running == 1
+    # тихий чат ждёт только текущий апдейт шумного, а не всю его очередь
+    assert rec.started()[:3] == [('noisy', 0), ('quiet', 0), ('noisy', 1)]
+
+
+def test_chat_queue_limit_drops_updates():
+    async def main():
+        processor = scheduler.FairUpdateProcessor(workers=1, chat_queue_limit=2)
+        rec = Recorder()
+        gate = asyncio.Event()
+        first = _submit(processor, 1, rec.handler(('chat', 0), gate=gate))
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        queued = [_submit(processor, 1, rec.handler(('chat', i))) for i in (1, 2, 3)]
+        # другой чат не упирается в лимит первого
+        other = _submit(processor, 2, rec.handler(('other', 0)))
+        await asyncio.sleep(0)
+        assert processor.dropped == 1
+        gate.set()
+        await asyncio.gather(first, other, *queued)
+        return processor, rec
+
+    processor, rec = asyncio.run(main())
+    assert processor.dropped == 1
+    assert sorted(rec.started()) == [('chat', 0), ('chat', 1), ('chat', 2), ('other', 0)]
+
+
+def test_handler_error_reaches_caller_and_chat_continues():
+    async def main():
+        processor = scheduler.FairUpdateProcessor(workers=2)
+        rec = Recorder()
+
+        async def failing():
+            raise RuntimeError('boom')
+
+        failed = _submit(processor, 1, failing())
+        after = _submit(processor, 1, rec.handler(('chat', 1)))
+        with pytest.raises(RuntimeError, match='boom'):
+            await failed
+        await after
+        return rec
+
+    assert asyncio.run(main()).started() == [('chat', 1)]
+
+
+def test_workers_must_be_positive():
+    with pytest.raises(ValueError):
+        scheduler.FairUpdateProcessor(workers=0)
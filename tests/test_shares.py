@@ -0,0 +1,27 @@
+import pytest
+
+import shares
+
+
+@pytest.mark.parametrize('text, expected', [('500', 500.0), ('1 200,50', 1200.5), ('0.1', 0.1)])
+def test_parse_amount(text, expected):
+    assert shares.parse_amount(text) == expected
+
+
+@pytest.mark.parametrize('text', ['nan', 'NaN', 'inf', '-inf', 'Infinity', '1e400', 'abc', ''])
+def test_parse_amount_rejects_non_finite_and_garbage(text):
+    with pytest.raises(ValueError):
+        shares.parse_amount(text)
+    assert not shares.is_single_amount(text)
+
+
+def test_parse_share_text():
+    assert shares.parse_share_text('@anna 500, @boris x2, я') == [
+        ('@anna', 500.0, 1), ('@boris', None, 2.0), (shares.SELF, None, 1)]
+    assert shares.parse_share_text('@anna 700,50') == [('@anna', 700.5, 1)]
+
+
+def test_parse_share_text_errors():
+    for text in ('@anna 500 600', '@anna 0', '@anna, @anna', ''):
+        with pytest.raises(shares.ShareParseError):
+            shares.parse_share_text(text)
@@ -0,0 +1,68 @@
+from fractions import Fraction
+
+import pytest
+from hypothesis import given, strategies as st
+
+import shares
+import split
+
+keys = st.lists(st.text(min_size=1, max_size=5), min_size=1, max_size=30, unique=True)
+# веса как их пишут пользователи: целые и десятичные дроби (x2, x1.5, x0.1)
+weights = st.one_of(st.integers(min_value=1, max_value=100),
+                    st.decimals(min_value='0.01', max_value='100', places=2).map(float))
+
+
+@given(total=st.integers(min_value=0, max_value=10 ** 9), data=st.data(), participants=keys)
+def test_split_cents_sums_to_total(total, data, participants):
+    ws = [(k, data.draw(weights)) for k in participants]
+    result = split.split_cents(total, ws)
+    assert [k for k, _ in result] == participants
+    assert sum(c for _, c in result) == total
+    assert all(c >= 0 for _, c in result)
+
+
+@given(total=st.integers(min_value=0, max_value=10 ** 9), data=st.data(), participants=keys)
+def test_split_cents_is_fair(total, data, participants):
+    ws = [(k, data.draw(weights)) for k in participants]
+    total_weight = sum(Fraction(str(w)) for _, w in ws)
+    # каждая доля отличается от точной меньше чем на копейку
+    for (_, w), (_, c) in zip(ws, split.split_cents(total, ws)):
+        assert abs(c - total * Fraction(str(w)) / total_weight) < 1
+
+
+@given(total=st.decimals(min_value='0', max_value='10000000', places=2).map(float), data=st.data(), participants=keys)
+def test_split_amount_sums_to_total(total, data, participants):
+    ws = {k: data.draw(weights) for k in participants}
+    result = split.split_amount(total, participants, ws)
+    assert sum(split.to_cents(a) for _, a in result) == split.to_cents(total)
+    assert all(a > 0 for _, a in result)
+    order = {k: i for i, k in enumerate(participants)}
+    assert [order[k] for k, _ in result] == sorted(order[k] for k, _ in result)
+
+
+def test_split_remainder_is_deterministic():
+    assert split.split_cents(100, [('a', 1), ('b', 1), ('c', 1)]) == [('a', 34), ('b', 33), ('c', 33)]
+    assert split.split_amount(100, ['a', 'b', 'c'], {'a': 2}) == [('a', 50.0), ('b', 25.0), ('c', 25.0)]
+
+
+def test_decimal_weights_are_exact():
+    # Fraction(0.1) : Fraction(0.3) — не ровно 1:3 (двоичные значения float), Fraction('0.1') : Fraction('0.3') — ровно
+    assert Fraction(0.1) * 400 / (Fraction(0.1) + Fraction(0.3)) != 100
+    assert split.split_cents(400, [('a', 0.1), ('b', 0.3)]) == [('a', 100), ('b', 300)]
+    assert split.split_cents(1, [('a', 0.1), ('b', 0.1), ('c', 0.1)]) == [('a', 1), ('b', 0), ('c', 0)]
+
+
+def test_split_errors():
+    with pytest.raises(ValueError):
+        split.split_cents(-1, [('a', 1)])
+    with pytest.raises(ValueError):
+        split.split_cents(100, [])
+    with pytest.raises(ValueError):
+        split.split_cents(100, [('a', 0)])
+
+
+@given(total=st.integers(min_value=1, max_value=10 ** 7), data=st.data(), participants=keys)
+def test_resolve_amounts_fills_remainder_exactly(total, data, participants):
+    items = [(k, None, data.draw(weights)) for k in participants]
+    resolved = shares.resolve_amounts(items, split.from_cents(total), 0)
+    assert sum(split.to_cents(a) for _, a in resolved) == total
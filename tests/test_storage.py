@@ -0,0 +1,327 @@
+import asyncio
+import os
+import threading
+
+import pytest
+
+import debts_optimizer
+import journal
+import shares
+import storage
+
+# Каждый метод репозиториев на всех бэкендах. PostgreSQL проверяется, если задан TEST_POSTGRES_DSN;
+# все таблицы в этой базе удаляются перед каждым тестом — нужна отдельная пустая база.
+PG_DSN = os.environ.get('TEST_POSTGRES_DSN')
+
+BACKENDS = [
+    'sqlite',
+    'sqlite-shared',
+    pytest.param('postgres', marks=pytest.mark.skipif(not PG_DSN, reason='TEST_POSTGRES_DSN не задан')),
+]
+
+
+async def _reset_postgres(st):
+    tables = await st.pool.fetch('SELECT tablename FROM pg_tables WHERE schemaname = current_schema()')
+    if tables:
+        await st.pool.execute('DROP TABLE ' + ', '.join(f'"{r[0]}"' for r in tables) + ' CASCADE')
+
+
+@pytest.fixture(params=BACKENDS)
+def run(request, tmp_path):
+    """run(test) — выполняет async test(storage) на свежей базе со схемой."""
+    def run(test):
+        async def main():
+            if request.param == 'postgres':
+                st = storage.PostgresStorage(PG_DSN, max_size=4)
+                await st.connect()
+                await _reset_postgres(st)
+            else:
+                st = storage.SqliteStorage(str(tmp_path / 'test.db'), shared_connection=request.param == 'sqlite-shared')
+            try:
+                await st.init_schema()
+                return await test(st)
+            finally:
+                await st.close()
+        return asyncio.run(main())
+    return run
+
+
+PAYMENT = {'description': 'Ужин в ресторане', 'user_id': 1, 'timestamp': '05.07.2024 20:00', 'amount': 90.0,
+           'currency': 'RUB'}
+
+
+async def _seed(st):
+    """Анна (1) платит 90 за ужин, Борис (2) и Вера (3) должны по 30."""
+    await st.users.get_or_create(1, 'Анна', 'Anna')
+    await st.users.get_or_create(2, 'Борис', 'boris')
+    await st.users.get_or_create(3, 'Вера')
+    payment_id = await st.expenses.create(PAYMENT, message_id=100)
+    await st.expenses.add_shares(payment_id, [(2, 'Борис', 30.0), (3, 'Вера', 30.0)])
+    return payment_id
+
+
+def test_users(run):
+    async def test(st):
+        assert await st.users.get_or_create(1, 'Анна', 'Anna') == 1
+        await st.users.get_or_create(1, 'Анна')
+        await st.users.set_payment_credentials(2, 'Борис', 'карта 1234')
+        assert await st.users.get_payment_credentials(2) == 'карта 1234'
+        assert await st.users.get_payment_credentials(1) is None
+        assert await st.users.get_payment_credentials(42) is None
+        assert await st.users.find_by_usernames(['@ANNA', 'nobody']) == {'anna': (1, 'Анна')}
+        assert await st.users.find_by_usernames([]) == {}
+        assert sorted(await st.users.get_all()) == [(1, 'Анна', None), (2, 'Борис', 'карта 1234')]
+    run(test)
+
+
+def test_create_and_read_payment(run):
+    async def test(st):
+        categories = await st.expenses.get_categories()
+        assert [name for _, name in categories] == storage.DEFAULT_CATEGORIES
+        payment_id = await _seed(st)
+        assert tuple(await st.expenses.find_by_message_id(100)) == (payment_id, 'RUB', 90.0)
+        assert await st.expenses.find_by_message_id(999) is None
+        assert await st.expenses.get_shares_total(payment_id) == 60.0
+        recent = await st.expenses.get_recent()
+        assert [(r[0], r[4], r[9]) for r in recent] == [(payment_id, 'Ужин в ресторане', 'Анна')]
+        rows = await st.expenses.get_shares(payment_id)
+        assert sorted((r[4], r[1], bool(r[3]), r[5]) for r in rows) == [(2, 30.0, False, 'Борис'), (3, 30.0, False, 'Вера')]
+    run(test)
+
+
+def test_add_shares_limits(run):
+    async def test(st):
+        payment_id = await _seed(st)
+        with pytest.raises(shares.ShareLimitError):
+            await st.expenses.add_shares(payment_id, [(1, 'Анна', 30.01)])
+        with pytest.raises(Exception, match='не найден'):
+            await st.expenses.add_shares(12345, [(2, 'Борис', 1.0)])
+        await st.expenses.add_shares(payment_id, [(1, 'Анна', 30.0)])
+        assert await st.expenses.get_shares_total(payment_id) == 90.0
+    run(test)
+
+
+def test_receipt_items(run):
+    async def test(st):
+        await st.users.get_or_create(1, 'Анна')
+        items = [{'name': 'Пицца', 'quantity': 1, 'price': 50.0, 'amount': 50.0},
+                 {'name': 'Чай', 'quantity': 2, 'price': 10.0, 'amount': 20.0}]
+        payment_id = await st.expenses.create(dict(PAYMENT, amount=70.0, items=items), message_id=1)
+        assert [tuple(r) for r in await st.expenses.get_items(payment_id)] == [
+            (1, 'Пицца', 1, 50.0, 50.0, None), (2, 'Чай', 2, 10.0, 20.0, None)]
+        assert await st.expenses.claim_items(payment_id, [2], 2, 'Борис') == [(2, 'Чай', 20.0)]
+        with pytest.raises(shares.ItemClaimError):
+            await st.expenses.claim_items(payment_id, [2], 3, 'Вера')
+        with pytest.raises(shares.ItemClaimError):
+            await st.expenses.claim_items(payment_id, [7], 3, 'Вера')
+        with pytest.raises(Exception, match='не найден'):
+            await st.expenses.claim_items(12345, [], 3, 'Вера')
+        assert [r[5] for r in await st.expenses.get_items(payment_id)] == [None, 2]
+        assert await st.expenses.get_shares_total(payment_id) == 20.0
+    run(test)
+
+
+def test_create_many(run):
+    async def test(st):
+        payments = [dict(PAYMENT, message_id=i, shares=[(2, 'Борис', 10.0 * i), (3, 'Вера', 5.0, True)])
+                    for i in (1, 2)]
+        ids = await st.expenses.create_many(payments)
+        assert len(ids) == 2
+        assert [await st.expenses.get_shares_total(i) for i in ids] == [15.0, 25.0]
+        with pytest.raises(shares.ShareLimitError):
+            await st.expenses.create_many([dict(PAYMENT, shares=[(2, 'Борис', 100.0)])])
+        # неудачный пакет откатывается целиком
+        assert len(await st.expenses.get_recent(limit=10)) == 2
+    run(test)
+
+
+def test_export_rows(run):
+    async def test(st):
+        payment_id = await _seed(st)
+        rows = [row async for row in st.expenses.iter_export_rows(batch_size=1)]
+        assert [(r[0], r[7], r[9], r[10], r[11]) for r in rows] == [
+            (payment_id, 'Анна', 'Борис', 30.0, False), (payment_id, 'Анна', 'Вера', 30.0, False)]
+        assert [row async for row in st.expenses.iter_export_rows(event_id=999)] == []
+    run(test)
+
+
+def test_search(run):
+    async def test(st):
+        payment_id = await _seed(st)
+        await st.expenses.create(dict(PAYMENT, description='Такси', amount=15.0), message_id=101)
+        assert [r[0] for r in await st.expenses.search(['ужин'])] == [payment_id]
+        assert [r[0] for r in await st.expenses.search(['рест', 'анна'])] == [payment_id]
+        assert len(await st.expenses.search([], amount_min=10, amount_max=20)) == 1
+        assert len(await st.expenses.search([], date_from='2024-07-05', date_to='2024-07-05')) == 2
+        assert await st.expenses.search([], date_from='2024-07-06') == []
+    run(test)
+
+
+def test_debts_queries(run):
+    async def test(st):
+        await _seed(st)
+        await st.users.set_payment_credentials(1, 'Анна', 'карта 1')
+        assert [tuple(r) for r in await st.ledger.get_user_debts(2)] == [
+            ('Ужин в ресторане', 30.0, 'RUB', 'Анна', 'карта 1')]
+        assert sorted(tuple(r) for r in await st.ledger.get_total_debts()) == [
+            ('Борис', 'Анна', 'карта 1', 30.0, 'RUB'), ('Вера', 'Анна', 'карта 1', 30.0, 'RUB')]
+        assert [tuple(r) for r in await st.ledger.get_user_debts_by_category(2)] == [('Без категории', 'RUB', 30.0)]
+        assert [tuple(r) for r in await st.ledger.get_total_debts_by_category()] == [('Без категории', 'RUB', 60.0)]
+        assert [tuple(r) for r in await st.ledger.get_balance(2)] == [('RUB', 0, 30.0)]
+        assert len(await st.ledger.get_unpaid_rows()) == 2
+        assert await st.ledger.get_unpaid_rows(event_id=999) == []
+        assert await st.ledger.get_unpaid_event_ids() == [storage.DEFAULT_EVENT_ID]
+        assert sorted(tuple(r) for r in await st.ledger.get_unpaid_totals()) == [(2, 1, 30.0, 'RUB'), (3, 1, 30.0, 'RUB')]
+        assert await st.ledger.get_unpaid_totals(currency='USD') == []
+        await st.ledger.mark_all_paid()
+        assert await st.ledger.get_unpaid_rows() == []
+        assert await st.ledger.get_total_debts() == []
+    run(test)
+
+
+def test_apply_allocations_and_journal(run):
+    async def test(st):
+        await _seed(st)
+        transfers = await debts_optimizer.optimize_transfers_with_allocations(st.ledger)
+        assert sum(t['amount'] for t in transfers) == 60.0
+        run_id = await st.ledger.journal_planned('net', transfers, chat_id=5)
+        await st.ledger.journal_append(run_id, journal.POSTED, message_id=7)
+        assert [(r[0], r[1]) for r in await st.ledger.get_open_runs()] == [(run_id, journal.POSTED)]
+        await st.ledger.apply_allocations(journal.load_plan(journal.dump_plan(transfers)), run_id)
+        assert await st.ledger.get_unpaid_rows() == []
+        assert await st.ledger.get_open_runs() == []
+        assert await st.ledger.advance_journal_checkpoint() == run_id + 2
+        runs = await st.ledger.get_recent_runs()
+        assert [(r[0], r[3], r[5], r[6]) for r in runs] == [(run_id, 'net', 2, journal.APPLIED)]
+        # повторное применение того же плана — доли уже оплачены
+        with pytest.raises(Exception):
+            await st.ledger.apply_allocations(transfers)
+    run(test)
+
+
+def test_journal_recover(run):
+    async def test(st):
+        await _seed(st)
+        transfers = await debts_optimizer.optimize_transfers_with_allocations(st.ledger)
+        abandoned = await st.ledger.journal_planned('net', transfers)
+        posted = await st.ledger.journal_planned('net', transfers)
+        await st.ledger.journal_append(posted, journal.POSTED, message_id=1)
+        assert await journal.recover(st.ledger) == [(abandoned, journal.ABANDONED), (posted, journal.APPLIED)]
+        assert await st.ledger.get_unpaid_rows() == []
+        failed = await st.ledger.journal_planned('net', transfers)
+        await st.ledger.journal_append(failed, journal.FAILED, detail='сеть')
+        assert (await st.ledger.get_recent_runs(limit=1))[0][6:] == (journal.FAILED, 'сеть')
+    run(test)
+
+
+def test_compact_and_archive(run):
+    async def test(st):
+        payment_id = await _seed(st)
+        transfers = await debts_optimizer.optimize_transfers_with_allocations(st.ledger)
+        await st.ledger.apply_allocations(transfers)
+        assert await st.ledger.compact_paid_shares() == 0
+        assert await st.ledger.archive_settled() == (0, 0)
+        assert await st.expenses.close_event(storage.DEFAULT_EVENT_ID)
+        assert not await st.expenses.close_event(999)
+        assert await st.ledger.archive_settled() == (1, 2)
+        assert await st.expenses.get_recent() == []
+        # выгрузка и сводки учитывают архив
+        assert [r[0] for r in [row async for row in st.expenses.iter_export_rows()]] == [payment_id, payment_id]
+        assert await st.stats.rebuild() == 3
+    run(test)
+
+
+def test_stats(run):
+    async def test(st):
+        await _seed(st)
+        assert [tuple(r) for r in await st.stats.get_daily()] == [('2024-07-05', 0, 'RUB', 90.0, 90.0)]
+        assert [tuple(r) for r in await st.stats.get_daily(user_id=2)] == [('2024-07-05', 0, 'RUB', 30.0, 0)]
+        assert await st.stats.get_daily(date_from='2024-07-06') == []
+        before = sorted(tuple(r) for r in await st.stats.get_daily())
+        await st.stats.rebuild()
+        assert sorted(tuple(r) for r in await st.stats.get_daily()) == before
+    run(test)
+
+
+def test_storage_maintenance(run, tmp_path):
+    async def test(st):
+        await _seed(st)
+        assert await st.missing_tables() == []
+        assert await st.missing_tables(('expense', 'no_such_table')) == ['no_such_table']
+        assert await st.optimize() in (True, False)
+        # снимки — возможность только SQLite (/snapshot проверяет тип хранилища)
+        if isinstance(st, storage.SqliteStorage):
+            assert await st.snapshot(str(tmp_path / 'snapshot.db')) > 0
+        else:
+            assert not hasattr(st, 'snapshot')
+    run(test)
+
+
+def test_sqlite_queries_run_off_the_loop(tmp_path):
+    async def main():
+        st = storage.SqliteStorage(str(tmp_path / 'test.db'))
+        await st.init_schema()
+        calls = []
+        connect = st.connect_sync
+
+        def connect_sync():
+            calls.append(threading.current_thread())
+            return connect()
+        st.connect_sync = connect_sync
+        await _seed(st)
+        # пока запрос выполняется в потоке, цикл событий обслуживает другие задачи
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0)
+        task = asyncio.create_task(ticker())
+        await asyncio.gather(*(st.ledger.get_total_debts() for _ in range(20)))
+        task.cancel()
+        assert calls and threading.main_thread() not in calls
+        assert ticks > 0
+    asyncio.run(main())
+
+
+def test_sqlite_connections_closed_on_error(tmp_path):
+    async def main():
+        st = storage.SqliteStorage(str(tmp_path / 'test.db'))
+        await st.init_schema()
+        opened = []
+        connect = st.connect_sync
+
+        class Conn:
+            def __init__(self, conn):
+                self._conn = conn
+                self.closed = False
+
+            def __getattr__(self, name):
+                return getattr(self._conn, name)
+
+            def close(self):
+                self.closed = True
+                self._conn.close()
+
+        def connect_sync():
+            opened.append(Conn(connect()))
+            return opened[-1]
+        st.connect_sync = connect_sync
+        bad = object()  # sqlite3 не умеет такой параметр — запрос падает после открытия соединения
+        failing = [
+            st.users.get_or_create(bad, 'Анна'),
+            st.users.get_payment_credentials(bad),
+            st.expenses.create({'user_id': 1}),
+            st.expenses.get_items(bad),
+            st.expenses.close_event(bad),
+            st.expenses.search([], event_id=bad),
+            st.ledger.get_user_debts(bad),
+            st.stats.get_daily(bad),
+        ]
+        for call in failing:
+            with pytest.raises(Exception):
+                await call
+        assert len(opened) == len(failing)
+        assert all(c.closed for c in opened)
+    asyncio.run(main())